@@ -37,8 +37,10 @@ See the psychopy documentation for information on using the built in gamma
 correction.
 """
 
+import os
 import os.path
 import pickle
+from concurrent.futures import ThreadPoolExecutor
 
 import configparser
 import matplotlib.pyplot as plt
@@ -63,13 +65,23 @@ class GammaValues(object):
     """
     Class to hold values for gamma correcting and returning calculations.
 
+    Splines are only evaluated once, to build a dense lookup table per
+    channel spanning [-1, 1]; corrections are then vectorized table lookups.
+    Large arrays are corrected in chunks, in parallel on a thread pool.
+
     :param tuple r: Tuple of spline, slope, intercept for red gun
     :param tuple g: Tuple of spline, slope, intercept for green gun
     :param tuple b: Tuple of spline, slope, intercept for blue gun
     """
+    #: Number of entries in each channel's lookup table.
+    lut_size = 65536
+    #: Number of values per chunk when correcting large arrays.
+    chunk_size = 2 ** 18
+
     def __init__(self, r, g, b):
         """
-        Instantiates class, pulls values out of tuples.
+        Instantiates class, pulls values out of tuples, and builds lookup
+        tables.
         """
         self.r_spline = r[0]
         self.r_slope = r[1]
@@ -83,48 +95,121 @@ class GammaValues(object):
         self.b_slope = b[1]
         self.b_int = b[2]
 
-    def r_correct(self, r, q=None):
+        self.make_luts()
+
+    def __getstate__(self):
         """
-        Method to gamma correct red channel.
+        Lookup tables are rebuilt when loaded, so don't pickle them.
+        """
+        state = self.__dict__.copy()
+        state.pop('luts', None)
+        return state
 
-        :return: corrected red color
+    def __setstate__(self, state):
+        """
+        Builds lookup tables when loaded from a pickled gamma table file.
+        """
+        self.__dict__.update(state)
+        self.make_luts()
+
+    def make_luts(self):
+        """
+        Evaluates the splines over an evenly spaced grid of [-1, 1] to make a
+        (3 x lut_size) lookup table, in RGB order.
+        """
+        grid = numpy.linspace(-1, 1, self.lut_size)
+
+        self.luts = numpy.empty((3, self.lut_size), dtype=numpy.float32)
+        self.luts[0] = self.r_spline(grid * self.r_slope + self.r_int)
+        self.luts[1] = self.g_spline(grid * self.g_slope + self.g_int)
+        self.luts[2] = self.b_spline(grid * self.b_slope + self.b_int)
+
+    def correct(self, color, channel, out=None):
+        """
+        Gamma corrects values with the lookup table of a single channel.
+
+        :param color: single value or array of values, scaled from -1 to 1.
+        :param int channel: color channel of lookup table to use.
+        :param out: optional array to place corrected values in, can be the
+         same as color to correct in place.
+        :return: corrected values
         """
-        r_adj = self.r_spline(r * self.r_slope + self.r_int)
+        color = numpy.asarray(color)
+        if out is None:
+            out = numpy.empty(color.shape, dtype=numpy.float32)
 
-        if q is None:
-            return r_adj
+        # chunk along first axis, so that views of textures stay views
+        if color.ndim == 0 or color.size <= self.chunk_size:
+            self._lookup(color, channel, out)
         else:
-            q.put(r_adj)
+            step = max(1, self.chunk_size * len(color) // color.size)
+            jobs = [(color[i:i + step], channel, out[i:i + step])
+                    for i in range(0, len(color), step)]
+            list(get_pool().map(lambda job: self._lookup(*job), jobs))
+
+        return out
+
+    def _lookup(self, color, channel, out):
+        """
+        Nearest neighbour lookup of values in a channel's table. Table
+        indices are computed in out, then overwritten by the looked up
+        values, so the only temporary is the integer index array.
+        """
+        scale = (self.lut_size - 1) / 2.
+
+        # index rounded half up, out of range indices are clipped by take
+        numpy.multiply(color, scale, out=out)
+        out += scale + 0.5
+        index = out.astype(numpy.intp)
+
+        numpy.take(self.luts[channel], index, out=out, mode='clip')
 
-    def g_correct(self, g, q=None):
+    def r_correct(self, r):
+        """
+        Method to gamma correct red channel.
+
+        :return: corrected red color
+        """
+        return self.correct(r, 0)
+
+    def g_correct(self, g):
         """
         Method to gamma correct green channel.
 
         :return: corrected green color
         """
-        # print g
-        # print type(g)
-        g_adj = self.g_spline(g * self.g_slope + self.g_int)
+        return self.correct(g, 1)
 
-        if q is None:
-            return g_adj
-        else:
-            q.put(g_adj)
-
-    def b_correct(self, b, q=None):
+    def b_correct(self, b):
         """
         Method to gamma correct blue channel.
 
         :return: corrected blue color
         """
-        b_adj = self.b_spline(b * self.b_slope + self.b_int)
+        return self.correct(b, 2)
+
+    def correct_rgb(self, color):
+        """
+        Gamma corrects the first 3 channels of the last axis of an array in
+        place, with chunks of every channel corrected in parallel.
+
+        :param color: float array with RGB(A) values along the last axis.
+        :return: the same array, corrected
+        """
+        if color.size <= self.chunk_size:
+            for i in range(3):
+                self._lookup(color[..., i], i, color[..., i])
 
-        if q is None:
-            return b_adj
         else:
-            q.put(b_adj)
+            step = max(1, self.chunk_size * len(color) // color.size)
+            jobs = [(color[j:j + step, ..., i], i, color[j:j + step, ..., i])
+                    for i in range(3)
+                    for j in range(0, len(color), step)]
+            list(get_pool().map(lambda job: self._lookup(*job), jobs))
 
-    def __call__(self, color, channel=None):
+        return color
+
+    def __call__(self, color, channel=None, copy=True):
         """
         Calculates adjusted color value. Allows getting corrected values by
         making calls to instance.
@@ -133,6 +218,8 @@ class GammaValues(object):
          from a single channel.
         :param int channel: If color is passed as a single number, channel is
          the color channel.
+        :param bool copy: If False and color is a float array, textures and
+         arrays of colors are corrected in place.
         :return: Adjusted list of RGB values, or single adjusted color.
         """
         channel = None if channel == 3 else channel
@@ -140,87 +227,21 @@ class GammaValues(object):
         if channel is None:
             # if entire texture
             if len(numpy.shape(color)) == 3:
-                has_alpha = bool(numpy.shape(color)[2] == 4)
-
-                adj_color = numpy.copy(color)
-
-                size_x = adj_color.shape[0]
-                size_y = adj_color.shape[1]
-
-                if has_alpha:
-                    r, g, b, a = numpy.dsplit(adj_color, 4)
-                else:
-                    r, g, b = numpy.dsplit(adj_color, 3)
-
-                r = r.flatten()
-                g = g.flatten()
-                b = b.flatten()
-                # print 'red correcting.....',
-                r = self.r_correct(r)
-                # print 'done'
-                # print 'green correcting...',
-                g = self.g_correct(g)
-                # print 'done'
-                # print 'blue correcting....',
-                b = self.b_correct(b)
-                # print 'done\n'
-
-                '''
-                q = Queue()
-                r_proc = Process(target=self.r_correct, args=(r, q))
-                r_proc.start()
-                g_proc = Process(target=self.g_correct, args=(g, q))
-                g_proc.start()
-                b_proc = Process(target=self.b_correct, args=(b, q))
-                b_proc.start()
-
-                r = q.get()
-                g = q.get()
-                b = q.get()
-
-                r_proc.join()
-                g_proc.join()
-                b_proc.join()
-                '''
-
-                r = r.reshape(size_x, size_y, 1)
-                g = g.reshape(size_x, size_y, 1)
-                b = b.reshape(size_x, size_y, 1)
-
-                if has_alpha:
-                    adj_color = numpy.dstack([r, g, b, a])
-                else:
-                    adj_color = numpy.dstack([r, g, b])
+                adj_color = numpy.array(color) if copy else numpy.asarray(color)
+                if adj_color.dtype.kind != 'f':
+                    adj_color = adj_color.astype(numpy.float32)
+
+                self.correct_rgb(adj_color)
 
             # if single color
             elif len(numpy.shape(color)) == 1:
                 # ignore alpha
-                r = color[0]
-                g = color[1]
-                b = color[2]
-
-                # print 'red correcting.....',
-                r_adj = self.r_correct(r)
-                # print 'done'
-                # print 'green correcting...',
-                g_adj = self.g_correct(g)
-                # print 'done'
-                # print 'blue correcting....',
-                b_adj = self.b_correct(b)
-                # print 'done\n'
-
-                adj_color = color[:]
-
-                adj_color[0] = r_adj
-                adj_color[1] = g_adj
-                adj_color[2] = b_adj
+                adj_color = numpy.array(color, dtype=numpy.float64)
+                for i in range(3):
+                    adj_color[i] = self.correct(adj_color[i], i)
 
                 # add ceiling/floor
-                for i in range(len(color)):
-                    if adj_color[i] >= 1:
-                        adj_color[i] = 1.0
-                    elif adj_color[i] <= -1:
-                        adj_color[i] = -1.0
+                adj_color = numpy.clip(adj_color, -1, 1)
 
             elif len(numpy.shape(color)) == 2:
 
@@ -231,50 +252,43 @@ class GammaValues(object):
 
                 # if noise checkerboard
                 elif numpy.shape(color)[1] == 3:
-                    r, g, b = numpy.hsplit(color, 3)
-
-                    r = r.flatten()
-                    g = g.flatten()
-                    b = b.flatten()
+                    adj_color = numpy.array(color) if copy else \
+                        numpy.asarray(color)
+                    if adj_color.dtype.kind != 'f':
+                        adj_color = adj_color.astype(numpy.float32)
 
-                    # print 'red correcting.....',
-                    r = self.r_correct(r)
-                    # print 'done'
-                    # print 'green correcting...',
-                    g = self.g_correct(g)
-                    # print 'done'
-                    # print 'blue correcting....',
-                    b = self.b_correct(b)
-                    # print 'done\n'
-
-                    adj_color = numpy.dstack([r, g, b])[0]
+                    self.correct_rgb(adj_color)
 
         # if single channel
         elif channel is not None:
-            if channel == 0:
-                # print 'red correcting.....',
-                adj = self.r_correct(color)
-                # print 'done'
-            if channel == 1:
-                # print 'green correcting...',
-                adj = self.g_correct(color)
-                # print 'done'
-            if channel == 2:
-                # print 'blue correcting....',
-                adj = self.b_correct(color)
-                # print 'done'
-
-            adj_color = adj
-
-            # add ceiling/floor
-            if adj_color >= 1:
-                adj_color = 1.0
-            elif adj_color <= -1:
-                adj_color = -1.0
+            adj = self.correct(color, channel)
+
+            # add ceiling/floor, works for single values or arrays
+            adj_color = numpy.clip(adj, -1, 1)
+
+            if adj_color.ndim == 0:
+                adj_color = float(adj_color)
 
         return adj_color
 
 
+def get_pool():
+    """
+    Thread pool shared by gamma corrections of large arrays. Numpy releases
+    the GIL for lookups, so chunks are corrected in parallel.
+
+    :return: ThreadPoolExecutor instance
+    """
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+
+    return _pool
+
+
+_pool = None
+
+
 def make_correction(measured):
     """
     Calculates a conversion spline of RGB values to corrected values to
@@ -6,11 +6,19 @@ Program for presenting visual stimuli to retinal neurons for eletrophysiology ex
 # Distributed under the terms of the GNU General Public License (GPL).
 
 import copy
+import ctypes
+import hashlib
+import itertools
+import json
 import os
 import pickle
+import queue
 import subprocess
 import sys
+import threading
 import traceback
+import zipfile
+from collections import OrderedDict, deque
 from math import ceil
 from random import Random
 from time import strftime, localtime
@@ -24,12 +32,16 @@ import sortedcontainers
 from PIL import Image
 from tqdm import tqdm, trange
 
+import psychopy
 from psychopy import visual, core, event
 from psychopy.tools.coordinatetools import pol2cart
 from psychopy.tools.typetools import uint8_float, float_uint8
-from psychopy.visual import globalVars, filters
+from psychopy.visual import globalVars, filters, shaders
 from psychopy.visual.windowframepack import ProjectorFramePacker
 
+import stim_noise
+import trajectory
+
 GL = pyglet.gl
 
 global has_igor
@@ -134,9 +146,33 @@ class GlobalDefaults(object, metaclass=GlobalDefaultsMeta):
     :param int screen_num: On which monitor to display the window.
     :param string gamma_correction: Spline to use for gamma correction. See
      :doc:'GammaCorrection' documentation.
+    :param string gamma_mode: Where gamma correction is applied. 'cpu'
+     corrects textures and colors as they are made, 'gpu' linearizes the
+     whole window in a final shader pass, so colors can be changed without
+     re-uploading textures. With 'gpu', offscreen renders (e.g. jump
+     stim slices, and their logs) are uncorrected until drawn to the window,
+     and captures are corrected as they are encoded, see
+     :py:class:`CaptureWriter`. Only supported on psychopy versions in
+     MyWindow.fbo_render_versions.
+    :param string board_backend: How checkerboards are drawn. 'elements'
+     draws each check as an element of an ElementArrayStim, 'texture' draws
+     the board as a single texture with one check per texel, updated with
+     one upload per frame. 'shader' draws boards as 'texture', except noise,
+     which is generated on the GPU from fill_seed and the frame number (see
+     :py:mod:`stim_noise`).
+    :param string movie_backend: How movies are played. 'psychopy' plays
+     movies with psychopy's MovieStim, which decodes on the render thread and
+     follows wall clock time. 'ffmpeg' decodes on a separate thread, ahead of
+     the display, and shows each movie frame for a whole number of display
+     frames, see :py:class:`MovieDecoder`. 'cached' plays movies as
+     'ffmpeg', from frames decoded once at movie_size and memory mapped from
+     the cache_dir, see :py:class:`CachedMovie`.
     :param float trigger_wait: The wait time between the labjack sending a
      pulse and the start of the stims.
     :param bool log: Whether or not to write to a log file.
+    :param bool record_noise: Whether or not to record the frames of noise
+     checkerboards, and flashes of sparse noise, to the log folder, see
+     :py:class:`NoiseRecorder` and :py:class:`SparseRecorder`.
     :param list offset: List of microns in xy coordinates of how much to
      offset the center of the window.
     """
@@ -159,7 +195,11 @@ class GlobalDefaults(object, metaclass=GlobalDefaultsMeta):
                     trigger_wait=6,
                     capture=False,
                     small_win=False,
-                    framepack=False)
+                    framepack=False,
+                    gamma_mode='cpu',
+                    board_backend='elements',
+                    movie_backend='psychopy',
+                    record_noise=False)
 
     def __init__(self,
                  frame_rate=None,
@@ -179,7 +219,11 @@ class GlobalDefaults(object, metaclass=GlobalDefaultsMeta):
                  offset=None,
                  capture=None,
                  small_win=None,
-                 framepack=None):
+                 framepack=None,
+                 gamma_mode=None,
+                 board_backend=None,
+                 movie_backend=None,
+                 record_noise=None):
         """
         Populate defaults if passed; units converted as necessary.
         """
@@ -239,6 +283,18 @@ class GlobalDefaults(object, metaclass=GlobalDefaultsMeta):
         if framepack is not None:
             self.defaults['framepack'] = framepack
 
+        if gamma_mode is not None:
+            self.defaults['gamma_mode'] = gamma_mode
+
+        if board_backend is not None:
+            self.defaults['board_backend'] = board_backend
+
+        if movie_backend is not None:
+            self.defaults['movie_backend'] = movie_backend
+
+        if record_noise is not None:
+            self.defaults['record_noise'] = record_noise
+
     def __repr__(self):
         """For pretty printing dictionary of global defaults.
         """
@@ -253,6 +309,103 @@ class GlobalDefaults(object, metaclass=GlobalDefaultsMeta):
         return to_print
 
 
+#: Vertex shader for the final pass from a window's framebuffer.
+GAMMA_VERT_SHADER = """
+    void main() {
+        gl_FrontColor = gl_Color;
+        gl_TexCoord[0] = gl_MultiTexCoord0;
+        gl_Position = ftransform();
+    }
+    """
+
+#: Fragment shader that linearizes each channel with a 1D lookup texture.
+GAMMA_FRAG_SHADER = """
+    uniform sampler2D texture;
+    uniform sampler1D lut;
+    uniform float lutScale;
+    uniform float lutOffset;
+
+    void main() {
+        vec4 color = texture2D(texture, gl_TexCoord[0].st);
+        vec3 coord = color.rgb * lutScale + lutOffset;
+        gl_FragColor = vec4(texture1D(lut, coord.r).r,
+                            texture1D(lut, coord.g).g,
+                            texture1D(lut, coord.b).b,
+                            color.a);
+    }
+    """
+
+#: Vertex shader of noise boards. Integer operations need GLSL 1.30.
+NOISE_VERT_SHADER = """
+    #version 130
+
+    void main() {
+        gl_TexCoord[0] = gl_MultiTexCoord0;
+        gl_Position = ftransform();
+    }
+    """
+
+#: Fragment shader that fills each check with noise hashed from seed, frame,
+#: check and channel. The hash must match :py:func:`stim_noise.hash32`.
+NOISE_FRAG_SHADER = """
+    #version 130
+
+    uniform int seed;
+    uniform int stim;
+    uniform int frame;
+    uniform int numCheck;
+    uniform vec3 low;
+    uniform vec3 high;
+    uniform bool binary;
+    uniform bool gammaCorrect;
+    uniform sampler1D lut;
+    uniform float lutScale;
+    uniform float lutOffset;
+
+    uint hash32(uint x) {
+        x ^= x >> 16u;
+        x *= 0x7feb352du;
+        x ^= x >> 15u;
+        x *= 0x846ca68bu;
+        x ^= x >> 16u;
+        return x;
+    }
+
+    void main() {
+        // checks are numbered row by row from the bottom left
+        ivec2 cell = clamp(ivec2(gl_TexCoord[0].st * float(numCheck)),
+                           0, numCheck - 1);
+        uint check = uint(cell.y * numCheck + cell.x);
+        uint key = hash32(uint(seed) ^ hash32(uint(stim)));
+
+        vec3 color;
+        for (int i = 0; i < 3; i++) {
+            uint bits = hash32(key ^ hash32(uint(frame) ^
+                               hash32(check * 4u + uint(i))));
+
+            if (binary) {
+                color[i] = (bits >> 31u) == 1u ? high[i] : low[i];
+            } else {
+                float u = float(bits >> 8u) * (1.0 / 16777216.0);
+                color[i] = low[i] + u * (high[i] - low[i]);
+            }
+        }
+
+        // colors are in [-1, 1], framebuffer is in [0, 1]
+        color = (color + 1.0) / 2.0;
+
+        if (gammaCorrect) {
+            vec3 coord = clamp(color, 0.0, 1.0) * lutScale + lutOffset;
+            color = vec3(texture1D(lut, coord.r).r,
+                         texture1D(lut, coord.g).g,
+                         texture1D(lut, coord.b).b);
+        }
+
+        gl_FragColor = vec4(color, 1.0);
+    }
+    """
+
+
 class MyWindow(object):
     """Class with static methods for window management and triggering.
     """
@@ -262,6 +415,15 @@ class MyWindow(object):
     small_win = None
     #: Gamma correction instance. See :py:class:`GammaCorrection`.
     gamma_mon = None
+    #: Gamma correction instance applied on the GPU, if gamma_mode is 'gpu'.
+    #: gamma_mon is then None, so nothing is corrected on the CPU.
+    gamma_lut = None
+    #: Number of entries in the lookup texture for GPU gamma correction.
+    gamma_lut_size = 4096
+    #: psychopy versions, as (major, minor), whose Window.flip() draws the
+    #: framebuffer between _prepareFBOrender() and _finishFBOrender(), which
+    #: GPU gamma correction replaces.
+    fbo_render_versions = [(1, 90)]
     #: Used to break out of animation loop in :py:func:`main`.
     should_break = False
     running = False
@@ -303,6 +465,13 @@ class MyWindow(object):
         else:
             MyWindow.gamma_mon = None
 
+        # if correcting on the GPU, nothing should be corrected on the CPU
+        MyWindow.gamma_lut = None
+        if GlobalDefaults['gamma_mode'] == 'gpu' and \
+                MyWindow.gamma_mon is not None:
+            MyWindow.gamma_lut = MyWindow.gamma_mon
+            MyWindow.gamma_mon = None
+
         # gamma correction as necessary
         if MyWindow.gamma_mon is not None:
             color = MyWindow.gamma_mon(GlobalDefaults['background'])
@@ -325,10 +494,103 @@ class MyWindow(object):
                                      # waitBlanking=False
                                      )
 
+        if MyWindow.gamma_lut is not None:
+            MyWindow.install_gamma_shader(MyWindow.win, MyWindow.gamma_lut)
+
         MyWindow.win.mouseVisible = True,
         if GlobalDefaults['small_win']:
             MyWindow.make_small_win()
 
+    @staticmethod
+    def install_gamma_shader(win, gamma):
+        """Gamma corrects everything drawn to a window on the GPU. Replaces
+        the shader program used to copy the window's framebuffer to the back
+        buffer on flip with one that looks up each channel in a 1D texture
+        made from the gamma correction tables.
+
+        :param win: psychopy window, must use a framebuffer (useFBO=True).
+        :param gamma: gamma correction instance, see
+         :py:class:`GammaCorrection.GammaValues`.
+        :raises: RuntimeError: if psychopy's version isn't one of
+         fbo_render_versions, as the window wouldn't be corrected.
+        """
+        version = tuple(int(v) for v in
+                        psychopy.__version__.split('.')[:2])
+
+        if version not in MyWindow.fbo_render_versions or \
+                not hasattr(win, '_prepareFBOrender') or \
+                not hasattr(win, '_finishFBOrender'):
+            raise RuntimeError(
+                'gamma_mode \'gpu\' is not supported on psychopy {}, use '
+                'gamma_mode \'cpu\'.'.format(psychopy.__version__))
+
+        size = MyWindow.gamma_lut_size
+
+        win.winHandle.switch_to()
+
+        lut_id = MyWindow.gen_gamma_lut(gamma)
+        prog = shaders.compileProgram(GAMMA_VERT_SHADER, GAMMA_FRAG_SHADER)
+
+        # sample at texel centers
+        GL.glUseProgram(prog)
+        GL.glUniform1i(GL.glGetUniformLocation(prog, b'texture'), 0)
+        GL.glUniform1i(GL.glGetUniformLocation(prog, b'lut'), 1)
+        GL.glUniform1f(GL.glGetUniformLocation(prog, b'lutScale'),
+                       (size - 1.0) / size)
+        GL.glUniform1f(GL.glGetUniformLocation(prog, b'lutOffset'),
+                       0.5 / size)
+        GL.glUseProgram(0)
+
+        def prepare_fbo_render():
+            GL.glUseProgram(prog)
+            GL.glActiveTexture(GL.GL_TEXTURE1)
+            GL.glBindTexture(GL.GL_TEXTURE_1D, lut_id)
+            GL.glActiveTexture(GL.GL_TEXTURE0)
+
+        def finish_fbo_render():
+            GL.glActiveTexture(GL.GL_TEXTURE1)
+            GL.glBindTexture(GL.GL_TEXTURE_1D, 0)
+            GL.glActiveTexture(GL.GL_TEXTURE0)
+            GL.glUseProgram(0)
+
+        # psychopy calls these around drawing the framebuffer on flip
+        win._prepareFBOrender = prepare_fbo_render
+        win._finishFBOrender = finish_fbo_render
+
+    @staticmethod
+    def gen_gamma_lut(gamma):
+        """Makes a 1D texture of the gamma correction tables, mapping
+        framebuffer colors in [0, 1] to corrected colors, for shaders to look
+        up each channel in. The window's context must be current.
+
+        :param gamma: gamma correction instance, see
+         :py:class:`GammaCorrection.GammaValues`.
+        :return: texture id
+        """
+        size = MyWindow.gamma_lut_size
+
+        # framebuffer colors are in [0, 1], tables are in [-1, 1]
+        grid = numpy.linspace(-1, 1, size)
+        lut = numpy.empty((size, 3), dtype=numpy.float32)
+        for i in range(3):
+            lut[:, i] = gamma.correct(grid, i)
+        lut = numpy.clip((lut + 1) / 2, 0, 1)
+
+        lut_id = GL.GLuint()
+        GL.glGenTextures(1, ctypes.byref(lut_id))
+        GL.glBindTexture(GL.GL_TEXTURE_1D, lut_id)
+        GL.glTexParameteri(GL.GL_TEXTURE_1D, GL.GL_TEXTURE_MIN_FILTER,
+                           GL.GL_LINEAR)
+        GL.glTexParameteri(GL.GL_TEXTURE_1D, GL.GL_TEXTURE_MAG_FILTER,
+                           GL.GL_LINEAR)
+        GL.glTexParameteri(GL.GL_TEXTURE_1D, GL.GL_TEXTURE_WRAP_S,
+                           GL.GL_CLAMP_TO_EDGE)
+        GL.glTexImage1D(GL.GL_TEXTURE_1D, 0, GL.GL_RGB32F_ARB, size, 0,
+                        GL.GL_RGB, GL.GL_FLOAT, lut.ctypes)
+        GL.glBindTexture(GL.GL_TEXTURE_1D, 0)
+
+        return lut_id
+
     @staticmethod
     def close_win():
         """Static method to close window. Also closes labjack if present.
@@ -348,6 +610,17 @@ class MyWindow(object):
             MyWindow.small_win.close()
             MyWindow.small_win = None
 
+    @staticmethod
+    def offscreen(size):
+        """Makes an offscreen render target in the window's context, for
+        rendering and reading back content without drawing to, or closing,
+        the window. See :py:class:`OffscreenTarget`.
+
+        :param size: width and height of target in pix
+        :return: OffscreenTarget instance
+        """
+        return OffscreenTarget(MyWindow.win, size)
+
     @staticmethod
     def change_color(color):
         """Static method to live update the background of the window.
@@ -418,6 +691,10 @@ class MyWindow(object):
                                            # do_vsync=False
                                            )
 
+        if MyWindow.gamma_lut is not None:
+            MyWindow.install_gamma_shader(MyWindow.small_win,
+                                          MyWindow.gamma_lut)
+
     @staticmethod
     def flip():
         """Makes proper calls to flip windows
@@ -455,259 +732,1901 @@ class MyWindow(object):
             print('\nTo trigger, need labjackpython library. See documentation')
 
 
-class StimDefaults(object):
-    """Super class to hold parameter defaults. GUI passes dictionary of all
-    parameters, whether used to make stim or not.
+class TextureCache(object):
+    """Class with static methods for a process level cache of generated
+    textures, so that identical stims across reps, or repeated within a stim
+    list, reuse textures rather than regenerating them. Textures are keyed on
+    a hash of the parameters they are made from and the active gamma
+    profile, and least recently used textures are evicted once the cache
+    is larger than max_bytes.
 
-    :param string shape: Shape of the stim, 'circle', 'rectangle, or 'annulus'.
+    The cache holds texture arrays rather than uploaded GL textures, as
+    psychopy stims own and delete their texture names, so a hit skips
+    making and gamma correcting a texture, but not uploading it. Cached
+    textures are read only.
+    """
+    #: Cached textures, in order of least to most recently used.
+    textures = OrderedDict()
+    #: Memory cap, in bytes.
+    max_bytes = 512 * 2 ** 20
+    #: Current size, in bytes.
+    nbytes = 0
+    #: Counters for checking cache use, reset by main() each run.
+    hits = 0
+    misses = 0
 
-    :param string fill_mode: How the stim is filled. Can be 'uniform',
-     'sine', 'square', 'concentric', 'checkerboard', 'random', 'image',
-     or 'movie'.
+    @staticmethod
+    def make_key(*params):
+        """Hashes parameters in a canonical form, so that equal values of
+        different types (e.g. lists and arrays) give the same key.
 
-    :param float orientation: Orientation of the stim, in degrees.
+        :param params: parameter values
+        :return: key as hex string
+        """
+        def canonical(value):
+            if isinstance(value, numpy.ndarray):
+                value = value.tolist()
+            if isinstance(value, (list, tuple)):
+                return tuple(canonical(v) for v in value)
+            if isinstance(value, (int, float, numpy.number)) and \
+                    not isinstance(value, bool):
+                return float(value)
+            return value
+
+        return hashlib.sha1(repr(canonical(params)).encode()).hexdigest()
 
-    :param list size: Size of the stim, as an x, y list.
+    @staticmethod
+    def get(key, make):
+        """Gets a texture from the cache, or makes and caches it.
 
-    :param float outer_diameter: Size of circle, or outer diameter of
-     annulus, in micrometers.
+        :param string key: key from make_key().
+        :param make: function that returns a texture as a numpy array.
+        :return: texture as read only numpy array
+        """
+        texture = TextureCache.textures.get(key)
 
-    :param float inner_diameter: Inner diameter of annulus, in micrometers.
+        if texture is not None:
+            TextureCache.hits += 1
+            TextureCache.textures.move_to_end(key)
+            return texture
 
-    :param list check_size: Size of each check in a checkerboard or randomly
-     filled board, as an x, y list in micrometers.
+        TextureCache.misses += 1
+        texture = numpy.asarray(make())
+        texture.flags.writeable = False
 
-    :param int num_check: The number of checks in each direction.
+        # too big to ever cache
+        if texture.nbytes > TextureCache.max_bytes:
+            return texture
 
-    :param float delay: The time to between the first frame and the stim
-     appearing on screen. Rounds up to the nearest frame.
+        TextureCache.textures[key] = texture
+        TextureCache.nbytes += texture.nbytes
 
-    :param float end_delay: The time to between the last frame stim
-     appearing on screen and the end of frames flipping. Rounds up to the
-     nearest frame.
+        # evict least recently used
+        while TextureCache.nbytes > TextureCache.max_bytes:
+            _, evicted = TextureCache.textures.popitem(last=False)
+            TextureCache.nbytes -= evicted.nbytes
 
-    :param float duration: The duration for which the stim will animated.
-     Rounds up to the nearest frame.
+        return texture
 
-    :param list location: Coordinates of the stim, as an x, y list.
+    @staticmethod
+    def load(key, make):
+        """Gets a texture from the on disk cache in the cache_dir of the
+        config file, or makes and saves it, so that textures that are slow
+        to make (e.g. decoded images) are reused across runs. Without a
+        cache_dir, textures are always made.
+
+        :param string key: key from make_key().
+        :param make: function that returns a texture as a numpy array.
+        :return: texture as numpy array
+        """
+        cache_dir = config.get('StimProgram', 'cache_dir', fallback=None)
+        if cache_dir is None:
+            return make()
 
-    :param string timing: How the stim appears on screen over time. For
-     'step', the stim appears immediately. Other options include 'sine',
-     'sawtooth', 'square', and 'linear'.
+        path = os.path.join(cache_dir, key + '.npy')
 
-    :param float period_mod: For cyclic timing modes, the number of cycles.
+        if os.path.exists(path):
+            try:
+                return numpy.load(path)
+            # partially written, so remake
+            except (IOError, ValueError):
+                pass
 
-    :param float alpha: The transparency of the of the stim, between 0 and 1.
-     Does not apply to checkerboard or random fill stims, or images and movies.
+        texture = make()
 
-    :param string color_mode: The way in which the color of the stim is
-     determined. Can be either 'intensity', or 'rgb'.
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
 
-    :param string contrast_channel: The color channel in which color is
-     displayed in intensity mode. For the RGB color mode, contrast channel is
-     only used if a fill other than uniform is specified.
+        # write then rename, so readers never see partial files
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            numpy.save(f, texture)
+        os.replace(temp_path, path)
 
-    :param float intensity: The color of the stim relative to background,
-     between -1 and 1. For  fills, the color will fluctuate between high and
-     low values of the  specified intensity relative to background, and thus
-     background values on either extreme must use low intensities or risk
-     hitting the color ceiling/floor of the monitor.
+        return texture
 
-    :param list color: RGB color values of the stim, as a list of 3 values
-     between -1 and 1.
+    @staticmethod
+    def hash_file(filename):
+        """Hashes contents of a file, for keys of textures made from files.
 
-    :param float fill_seed: The seed for the random number generator for
-     random fills.
+        :param filename: path of file
+        :return: hash as hex string
+        """
+        try:
+            f = open(filename, 'rb')
+        except TypeError:
+            raise IOError('Make sure image exists and location is correct')
 
-    :param float move_seed: The seed for the random number generator for
-     random movement.
+        digest = hashlib.sha1()
 
-    :param float speed: The speed of moving stims, in micrometers per second.
+        with f:
+            for block in iter(lambda: f.read(2 ** 20), b''):
+                digest.update(block)
 
-    :param int num_dirs: The number of directions radially moving stims will
-     travel in.
+        return digest.hexdigest()
 
-    :param float start_dir: The start direction for radially moving stims.
+    @staticmethod
+    def clear():
+        """Empties cache and resets counters.
+        """
+        TextureCache.textures.clear()
+        TextureCache.nbytes = 0
+        TextureCache.hits = 0
+        TextureCache.misses = 0
 
-    :param float start_radius: The start radius for radially moving stims.
+    @staticmethod
+    def stats():
+        """Cache use counters.
 
-    :param float move_delay: The amount of wait time between each move
-     direction.
+        :return: dictionary of hits, misses, number of textures, and size
+        """
+        return dict(hits=TextureCache.hits,
+                    misses=TextureCache.misses,
+                    textures=len(TextureCache.textures),
+                    nbytes=TextureCache.nbytes)
+
+
+class IMLImage(object):
+    """Memory mapped .iml image, i.e. raw big endian uint16 pixels, as in the
+    van Hateren natural image database, so that regions can be cropped
+    without reading the whole file into memory. Only cropped regions are
+    converted, to float32.
+
+    Dimensions are read from a JSON sidecar with the same name (e.g.
+    image.json, with "width" and "height"), else from the file size; 1536 x
+    1024 if it fits, else square. Values are scaled by the maximum pixel
+    value of the file, or by the 12 bit range if that is higher. The maximum
+    is found once per file, by streaming over the memory map.
+
+    :ivar pixels: memory mapped pixels (rows x columns), read only
+    :ivar shape: rows and columns
+    :ivar maxi: pixel value scaled to 1
+    """
+    #: Width and height of images without sidecars.
+    default_size = (1536, 1024)
+    #: Lowest pixel value scaled to 1, the 12 bit range.
+    default_max = 4095
+    #: Maximum pixel values of files, keyed by path and modification time.
+    maxima = {}
+
+    def __init__(self, filename, rotated=False):
+        """
+        :param filename: path of .iml file
+        :param bool rotated: whether pixels are rotated 180 degrees, as
+         textures are drawn
+        """
+        self.filename = filename
+        self.tables = {}
 
-    :param float travel_distance: The distance that randomly moving stims
-     will travel before choosing a new direction.
+        rows, columns = self.gen_shape(self.read_sidecar())
 
-    :param string intensity_dir: Whether to go one or both directions relative to background.
+        self.pixels = numpy.memmap(filename, dtype='>u2', mode='r',
+                                   shape=(rows, columns))
+        self.maxi = max(self.gen_max(), IMLImage.default_max)
 
-    :param string contrast_opp: How the opposite of a color is determined.
-     Black means go to black, opposite indicates increase other color channels
-     as primary channel decreases.
+        if rotated:
+            self.pixels = self.pixels[::-1, ::-1]
 
-    :param float sf: The spatial frequency of a stim texture.
+        self.shape = self.pixels.shape
 
-    :param list phase: The offset of texture in the stim. Units are in
-     cycles, so integer phases will result in no discernible change.
+    def read_sidecar(self):
+        """Reads the JSON sidecar of the image, if any.
 
-    :param string movie_filename: File path of the movie to be displayed.
+        :return: dict of sidecar fields, empty if there is no sidecar
+        """
+        sidecar = os.path.splitext(self.filename)[0] + '.json'
 
-    :param list movie_size: Size of the movie, as an x, y list, in micrometers.
-     Keep aspect ratio or movie will be distorted.
+        if not os.path.exists(sidecar):
+            return {}
 
-    :param string image_filename: File path of the image to be displayed.
+        with open(sidecar) as f:
+            return json.load(f)
 
-    :param list image_size: Size of the image, as an x, y list, in micrometers.
-     Keep aspect ratio or movie will be distorted.
+    def gen_max(self):
+        """Finds the maximum pixel value of the file, once per file.
 
-    :param string table_filename: File path of the table to be used for
-     coordinates.
+        :return: maximum pixel value as int
+        """
+        key = (os.path.abspath(self.filename),
+               os.path.getmtime(self.filename))
 
-    :param bool trigger: Whether or not to send a trigger for the stim.
+        if key not in IMLImage.maxima:
+            IMLImage.maxima[key] = int(self.pixels.max())
 
-    :param int num_jumps:
+        return IMLImage.maxima[key]
 
-    :param float jump_delay:
+    def gen_shape(self, header):
+        """Reads dimensions from sidecar, or infers them from file size.
 
-    :param float force_stop: time at which stim should end, overrides all
-     other timing. Useful for moving and table stims.
-    """
-    def __init__(self,
-                 shape='circle',
-                 fill_mode='uniform',
-                 orientation=0,
-                 size=None,
-                 outer_diameter=75,
-                 inner_diameter=40,
-                 check_size=None,
-                 num_check=64,
-                 check_type='board',
-                 delay=0,
-                 duration=0.5,
-                 location=None,
-                 timing='step',
-                 intensity=1,
-                 alpha=1,
-                 color=None,
-                 color_mode='intensity',
-                 image_channel='all',
-                 fill_seed=1,
-                 move_seed=1,
-                 speed=10,
-                 num_dirs=4,
-                 start_dir=0,
-                 start_radius=300,
-                 travel_distance=50,
-                 ori_with_dir=False,
-                 intensity_dir='both',
-                 contrast_opp='opposite',
-                 frequency=1,
-                 sf=1,
-                 phase=None,
-                 phase_speed=None,
-                 contrast_channel='green',
-                 movie_filename=None,
-                 movie_size=None,
-                 period_mod=1,
-                 image_size=None,
-                 image_filename=None,
-                 table_filename=None,
-                 jitter_filename=None,
-                 table_type='polar',
-                 trigger=False,
-                 move_delay=0,
-                 num_jumps=5,
-                 # jump_delay=None,
-                 shuffle=False,
-                 blend_jumps=False,
-                 force_stop=0,
-                 end_delay=0,
-                 **kwargs):
+        :param dict header: sidecar fields
+        :return: tuple of rows and columns
         """
-        Default variable constructors; distance and time units converted
-        appropriately.
+        if 'width' in header and 'height' in header:
+            return int(header['height']), int(header['width'])
+
+        num_pixels = os.path.getsize(self.filename) // 2
+        width, height = IMLImage.default_size
+        side = int(round(num_pixels ** 0.5))
+
+        if num_pixels == width * height:
+            return height, width
+
+        elif side ** 2 == num_pixels:
+            return side, side
+
+        raise IOError('Can\'t tell dimensions of {}, add a sidecar {} with '
+                      'width and height.'.format(
+                          self.filename,
+                          os.path.splitext(self.filename)[0] + '.json'))
+
+    def texture(self, rows=slice(None), columns=slice(None), channel=3,
+                alpha=1, gamma=None):
+        """Converts a region to a texture. Values are scaled by maxi.
+
+        If gamma is given, e.g. MyWindow.gamma_mon, every pixel value is
+        corrected once, into a table that regions are looked up from, and
+        gray regions are made RGBA, so that each gun is corrected.
+
+        :param rows: slice of rows of region
+        :param columns: slice of columns of region
+        :param int channel: channel to place values in, 3 for gray
+        :param alpha: alpha of texture
+        :param gamma: callable gamma correcting an array of RGB values, or
+         None
+        :return: float32 texture (rows x columns x 4), or gray (rows x
+         columns) if not gamma corrected
         """
-        for key, value in kwargs.items():
-            print('NOT USED: {}={}'.format(key, value))
+        pixels = self.pixels[rows, columns]
 
-        self.shape = shape
-        self.fill_mode = fill_mode
-        self.sf = sf
-        self.intensity_dir = intensity_dir
-        self.contrast_opp = contrast_opp
-        self.color_mode = color_mode
-        self.intensity = intensity
-        self.alpha = alpha
-        self.orientation = orientation
-        self.num_check = num_check
-        self.check_type = check_type
-        self.fill_seed = fill_seed
-        self.timing = timing
-        self.frequency = frequency
-        self.period_mod = period_mod * 2.0 * duration
-        self.move_seed = move_seed
-        self.num_dirs = num_dirs
-        self.ori_with_dir = ori_with_dir
-        self.movie_filename = movie_filename
-        self.image_filename = image_filename
-        self.jitter_filename = jitter_filename
-        self.table_filename = table_filename
-        self.table_type = table_type
-        self.trigger = trigger
-        self.num_jumps = num_jumps
-        self.shuffle = shuffle
-        self.blend_jumps = blend_jumps
+        if gamma is not None:
+            texture = numpy.empty(pixels.shape + (4,), dtype=numpy.float32)
+            texture[:, :, 0:3] = self.gen_table(gamma, channel)[pixels]
+            texture[:, :, 3] = alpha
 
-        self.contrast_channel = ['red', 'green', 'blue', 'all'].\
-            index(contrast_channel)
-        self.image_channel = ['red', 'green', 'blue', 'all'].\
-            index(image_channel)
+            return texture
 
-        # override start dir with global
-        if GlobalDefaults['pref_dir'] != -1:
-            self.start_dir = GlobalDefaults['pref_dir']
-        else:
-            self.start_dir = start_dir
+        values = pixels.astype(numpy.float32)
+        values *= 2. / self.maxi
+        values -= 1
 
-        # mutable variables
-        if color is not None:
-            self.color = color
-        else:
-            self.color = [-1, 1, -1]
+        # .iml are gray scale by default
+        if channel == 3:
+            return values
 
-        if movie_size is not None:
-            self.movie_size = movie_size
-        else:
-            self.movie_size = [100, 100]
+        texture = numpy.full(values.shape + (4,), -1, dtype=numpy.float32)
+        texture[:, :, channel] = values
+        texture[:, :, 3] = alpha
 
-        if phase is not None:
-            self.phase = phase
-        else:
-            self.phase = [0, 0]
+        return texture
 
-        # size conversions
-        self.outer_diameter = outer_diameter * GlobalDefaults['pix_per_micron']
-        self.inner_diameter = inner_diameter * GlobalDefaults['pix_per_micron']
-        self.start_radius = start_radius * GlobalDefaults['pix_per_micron']
-        self.travel_distance = travel_distance * GlobalDefaults[
-            'pix_per_micron']
+    def gen_table(self, gamma, channel):
+        """Gamma corrected RGB values of every pixel value, made once per
+        gamma and channel.
 
-        # time conversions
-        self.delay = delay * GlobalDefaults['frame_rate']
-        self.end_delay = end_delay * GlobalDefaults['frame_rate']
-        self.duration = duration * GlobalDefaults['frame_rate']
-        self.move_delay = int(move_delay * GlobalDefaults['frame_rate'])
-        # self.jump_delay = jump_delay * GlobalDefaults['frame_rate']
-        self.force_stop = force_stop * GlobalDefaults['frame_rate']
+        :param gamma: callable gamma correcting an array of RGB values
+        :param int channel: channel values are placed in, 3 for gray
+        :return: float32 array (maxi + 1 x 3)
+        """
+        key = (id(gamma), channel)
 
-        # speed conversion
-        self.speed = speed * (1.0 * GlobalDefaults['pix_per_micron'] /
-                              GlobalDefaults['frame_rate'])
+        if key not in self.tables:
+            values = numpy.linspace(-1, 1, self.maxi + 1)
 
-        # mutable variables with unit conversion
-        if location is not None:
-            self.location = [location[0] * GlobalDefaults['pix_per_micron'],
-                             location[1] * GlobalDefaults['pix_per_micron']]
-        else:
-            self.location = [0, 0]
+            colors = numpy.full((self.maxi + 1, 3), -1.)
+            if channel == 3:
+                colors[:] = values[:, numpy.newaxis]
+            else:
+                colors[:, channel] = values
+
+            self.tables[key] = numpy.asarray(gamma(colors),
+                                             dtype=numpy.float32)
+
+        return self.tables[key]
+
+
+class FrameBank(object):
+    """Bounded buffer of frames made ahead of the display by a producer
+    thread, so that the render loop only needs to pop and upload. Frames are
+    taken from an iterable in order, so contents don't depend on timing.
+    """
+    #: Number of times the display got ahead of a producer, across banks.
+    #: Reset at the start of each run.
+    underruns = 0
+
+    def __init__(self, frames, size=64):
+        """Starts producer thread.
+
+        :param frames: iterable of frames, made on the producer thread
+        :param int size: number of frames to buffer
+        """
+        self.frames = frames
+        self.queue = queue.Queue(maxsize=size)
+        self.done = False
+        self.error = None
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.produce)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def produce(self):
+        """Fills buffer until frames are exhausted or bank is stopped. None
+        marks the end of frames. If making a frame raises, the error is kept
+        for get() to raise, and frames end there.
+        """
+        frames = None
+
+        try:
+            frames = iter(self.frames)
+
+            for frame in frames:
+                if not self.put(frame):
+                    return
+        except Exception as e:
+            self.error = e
+        finally:
+            # generators release resources, e.g. decoder processes, on close
+            if hasattr(frames, 'close'):
+                frames.close()
+
+        self.put(None)
+
+    def put(self, frame):
+        """Queues a frame, waiting for space unless bank is stopped.
+
+        :param frame: frame, or None for the end of frames
+        :return: whether frame was queued
+        """
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(frame, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def get(self, block=True):
+        """Pops next frame.
+
+        :param block: whether to wait for producer on underrun
+        :return: next frame, or None if frames are exhausted, or on an
+         underrun if not blocking
+        :raises Exception: the error raised making frames, once the frames
+         made before it are popped
+        """
+        if self.done:
+            return None
+
+        try:
+            frame = self.queue.get_nowait()
+        except queue.Empty:
+            FrameBank.underruns += 1
+
+            if not block:
+                return None
+
+            frame = self.wait()
+
+        if frame is None:
+            self.done = True
+
+            if self.error is not None:
+                error, self.error = self.error, None
+                raise error
+
+        return frame
+
+    def wait(self):
+        """Waits for the producer to queue a frame.
+
+        :return: next frame, or None if producer thread ended without
+         queueing one
+        """
+        while True:
+            try:
+                return self.queue.get(timeout=0.1)
+            except queue.Empty:
+                if not self.thread.is_alive() and self.queue.empty():
+                    return None
+
+    def stop(self):
+        """Stops producer thread, and drops buffered frames.
+        """
+        self.stopped.set()
+        self.thread.join()
+
+        self.queue = queue.Queue(maxsize=self.queue.maxsize)
+        self.done = True
+
+
+class MovieDecoder(object):
+    """Decodes a movie with an ffmpeg process. Iterating over a decoder starts
+    a process and yields its frames in order, as uint8 rgb arrays where row 0
+    is the bottom, gamma corrected if there is a lookup table, so that frames
+    are ready to upload to a :py:class:`TextureQuad`. Iterated by a
+    :py:class:`FrameBank`, decoding happens on the bank's producer thread,
+    ahead of the display.
+    """
+    def __init__(self, filename, loop=True, lut=None, size=None):
+        """Probes size and frame rate of movie.
+
+        :param filename: movie file
+        :param bool loop: whether to restart movie when it ends
+        :param lut: uint8 array (256 x 3) mapping the levels of each channel,
+         e.g. from gen_lut(), or None
+        :param size: width and height in pix to scale frames to, or None to
+         decode at the movie's size
+        """
+        self.filename = filename
+        self.loop = loop
+        self.lut = lut
+
+        self.width, self.height, self.fps = MovieDecoder.probe(filename)
+
+        if size is not None:
+            self.width, self.height = MovieDecoder.gen_size(size)
+
+    @staticmethod
+    def gen_size(size):
+        """Rounds a size to whole pixels.
+
+        :param size: width and height in pix
+        :return: tuple of int width and height, at least 1
+        """
+        return tuple(max(1, int(round(i))) for i in size)
+
+    @staticmethod
+    def probe(filename):
+        """Reads size and frame rate of the first video stream with ffprobe.
+
+        :param filename: movie file
+        :return: tuple of width, height, and frames per second
+        :raises IOError: if movie can't be probed
+        """
+        args = ['ffprobe',
+                '-v', 'error',
+                '-select_streams', 'v:0',
+                '-show_entries', 'stream=width,height,avg_frame_rate',
+                '-of', 'json',
+                filename]
+
+        try:
+            output = subprocess.check_output(args, stderr=subprocess.STDOUT)
+            stream = json.loads(output.decode())['streams'][0]
+            num, den = stream['avg_frame_rate'].split('/')
+            return int(stream['width']), int(stream['height']), \
+                float(num) / float(den)
+        except (OSError, subprocess.CalledProcessError, ValueError, KeyError,
+                IndexError, ZeroDivisionError):
+            raise IOError('Could not probe movie {}.'.format(filename))
+
+    @staticmethod
+    def gen_lut(gamma_mon):
+        """Makes a lookup table of the gamma corrected value of each level of
+        each channel, so that uint8 frames are corrected with a single
+        indexing operation.
+
+        :param gamma_mon: gamma correction instance, or None
+        :return: uint8 array (256 x 3), or None
+        """
+        if gamma_mon is None:
+            return None
+
+        levels = uint8_float(numpy.arange(256))
+        levels = numpy.repeat(levels[numpy.newaxis, :, numpy.newaxis], 3,
+                              axis=2).astype(numpy.float32)
+
+        return float_uint8(gamma_mon(levels, copy=False))[0]
+
+    def display_frames(self):
+        """Number of display frames each movie frame is shown for, i.e.
+        GlobalDefaults['frame_rate'] over the movie's frame rate, rounded.
+
+        :return: int, at least 1
+        """
+        return max(1, int(round(GlobalDefaults['frame_rate'] / self.fps)))
+
+    def __iter__(self):
+        """Starts an ffmpeg process, and yields frames as they are decoded.
+        Process is killed when generator is closed.
+        """
+        args = ['ffmpeg', '-v', 'error']
+
+        if self.loop:
+            args += ['-stream_loop', '-1']
+
+        args += ['-i', self.filename,
+                 '-vf', 'scale={}:{},vflip'.format(self.width, self.height),
+                 '-f', 'rawvideo',
+                 '-pix_fmt', 'rgb24',
+                 '-']
+
+        frame_bytes = self.width * self.height * 3
+        channels = numpy.arange(3)
+
+        process = subprocess.Popen(args,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.DEVNULL)
+
+        try:
+            while True:
+                data = process.stdout.read(frame_bytes)
+                if len(data) < frame_bytes:
+                    return
+
+                frame = numpy.frombuffer(data, dtype=numpy.uint8).reshape(
+                    self.height, self.width, 3)
+
+                if self.lut is not None:
+                    frame = self.lut[frame, channels]
+
+                yield frame
+        finally:
+            process.kill()
+            process.stdout.close()
+            process.wait()
+
+
+class CachedMovie(MovieDecoder):
+    """Movie decoded once, at the size it is shown at, into a raw file of
+    gamma corrected uint8 rgb frames in the cache_dir of the config file,
+    and memory mapped on later runs, so that playing it doesn't decode.
+    Files are keyed on the path, byte size and modification time of the
+    movie file, so that finding them doesn't read the movie, and on the
+    drawn size and the gamma lookup table, with a .json sidecar of the number of frames, size and
+    frame rate, written once the frames are complete.
+
+    Iterating yields copies of frames in order, so that reads from disk
+    happen on the producer thread of a :py:class:`FrameBank`.
+    """
+    def __init__(self, filename, size, loop=True, lut=None):
+        """Memory maps frames, decoding movie first if it isn't cached.
+
+        :param filename: movie file
+        :param size: width and height in pix to scale frames to
+        :param bool loop: whether to restart movie when it ends
+        :param lut: uint8 array (256 x 3) mapping the levels of each channel,
+         e.g. from gen_lut(), or None
+        :raises IOError: if there is no cache_dir, or movie has no frames
+        """
+        cache_dir = config.get('StimProgram', 'cache_dir', fallback=None)
+        if cache_dir is None:
+            raise IOError('Cached movies need a cache_dir in config file.')
+
+        try:
+            stat = os.stat(filename)
+        except TypeError:
+            raise IOError('Make sure movie exists and location is correct')
+
+        width, height = MovieDecoder.gen_size(size)
+        key = TextureCache.make_key(os.path.abspath(filename), stat.st_size,
+                                    stat.st_mtime, width, height, lut)
+        path = os.path.join(cache_dir, 'movie_' + key)
+
+        if not os.path.exists(path + '.json'):
+            CachedMovie.decode(MovieDecoder(filename, loop=False, lut=lut,
+                                            size=(width, height)), path)
+
+        with open(path + '.json') as f:
+            info = json.load(f)
+
+        self.filename = filename
+        self.loop = loop
+        self.lut = lut
+        self.width = info['width']
+        self.height = info['height']
+        self.fps = info['fps']
+
+        self.frames = numpy.memmap(path + '.rgb', dtype=numpy.uint8,
+                                   mode='r', shape=(info['frames'],
+                                                    self.height,
+                                                    self.width, 3))
+
+    @staticmethod
+    def decode(decoder, path):
+        """Writes all frames of a decoder to path.rgb, then the sidecar to
+        path.json. Both are written then renamed, so readers never see
+        partial files.
+
+        :param decoder: MovieDecoder instance, not looping
+        :param path: path of files, without extension
+        :raises IOError: if movie has no frames
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        print('\ndecoding {}...'.format(decoder.filename))
+
+        num_frames = 0
+        temp_path = '{}.rgb.{}.tmp'.format(path, os.getpid())
+
+        with open(temp_path, 'wb') as f:
+            for frame in tqdm(decoder):
+                f.write(frame.tobytes())
+                num_frames += 1
+
+        if num_frames == 0:
+            os.remove(temp_path)
+            raise IOError('Could not decode movie {}.'.format(
+                decoder.filename))
+
+        os.replace(temp_path, path + '.rgb')
+
+        temp_path = '{}.json.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'w') as f:
+            json.dump(dict(frames=num_frames, width=decoder.width,
+                           height=decoder.height, fps=decoder.fps), f)
+        os.replace(temp_path, path + '.json')
+
+    def __iter__(self):
+        """Yields copies of frames, in order.
+        """
+        frames = itertools.count() if self.loop else range(len(self.frames))
+
+        for i in frames:
+            yield numpy.array(self.frames[i % len(self.frames)])
+
+
+class NoiseRecorder(object):
+    """Records the frames of a noise stim to a .npz archive, on a writer
+    thread. The render thread only queues displayed frame numbers; noise only
+    depends on seed, stim and frame (see :py:mod:`stim_noise`), so the writer
+    remakes each frame's levels exactly, and stores them bit packed if
+    binary, or quantized to uint8 if uniform. Frames are appended in
+    compressed chunks, so that frame ranges can be read without loading the
+    whole archive, see read().
+
+    :param filename: path of archive
+    :param gen_levels: callable taking a frame number, returning levels of
+     each channel and check (channels x checks), bools if binary, else in
+     [0, 1)
+    :param int num_checks: number of checks
+    :param bool binary: whether noise is binary or uniform
+    :param int chunk_size: number of frames per chunk
+    """
+    def __init__(self, filename, gen_levels, num_checks, binary=False,
+                 chunk_size=1024):
+        self.filename = filename
+        self.gen_levels = gen_levels
+        self.num_checks = num_checks
+        self.binary = binary
+        self.chunk_size = chunk_size
+        self.num_chunks = 0
+
+        self.queue = queue.Queue()
+
+        self.thread = threading.Thread(target=self.write_frames)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, frame):
+        """Queues a displayed frame to be recorded.
+
+        :param int frame: frame number
+        """
+        self.queue.put(frame)
+
+    def write_frames(self):
+        """Writer thread target. Encodes queued frames, and writes them a
+        chunk at a time.
+        """
+        frames = []
+        data = []
+
+        while True:
+            frame = self.queue.get()
+
+            if frame is not None:
+                frames.append(frame)
+                data.append(self.encode(self.gen_levels(frame)))
+
+            if frames and (frame is None or len(frames) == self.chunk_size):
+                self.write_chunk(frames, data)
+                frames = []
+                data = []
+
+            if frame is None:
+                break
+
+    def encode(self, levels):
+        """Packs binary levels to bits, or quantizes uniform levels to uint8.
+
+        :param levels: array of levels (channels x checks)
+        :return: uint8 array
+        """
+        if self.binary:
+            return numpy.packbits(levels, axis=-1)
+
+        return numpy.minimum(numpy.asarray(levels) * 256,
+                             255).astype(numpy.uint8)
+
+    def header(self):
+        """Members written once, with the first chunk.
+
+        :return: list of (name, array) tuples
+        """
+        return [('binary', numpy.array(self.binary)),
+                ('num_checks', numpy.array(self.num_checks))]
+
+    def chunk_arrays(self, frames, data):
+        """Members of a chunk, as frames and data.
+
+        :param frames: list of frame numbers
+        :param data: list of encoded frames
+        :return: list of (name, array) tuples
+        """
+        return [('frames', numpy.array(frames, dtype=numpy.int32)),
+                ('data', numpy.stack(data))]
+
+    def write_chunk(self, frames, data):
+        """Appends a chunk of frames to the archive, as [name]_[chunk]
+        members of chunk_arrays().
+
+        :param frames: list of frame numbers
+        :param data: list of encoded frames
+        """
+        arrays = [('{}_{:06d}'.format(name, self.num_chunks), array)
+                  for name, array in self.chunk_arrays(frames, data)]
+
+        with zipfile.ZipFile(self.filename, 'a',
+                             compression=zipfile.ZIP_DEFLATED) as archive:
+            if self.num_chunks == 0:
+                arrays = self.header() + arrays
+
+            for name, array in arrays:
+                with archive.open(name + '.npy', 'w') as f:
+                    numpy.lib.format.write_array(f, array)
+
+        self.num_chunks += 1
+
+    def close(self):
+        """Writes remaining frames, and waits for writer thread to finish.
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+    @staticmethod
+    def read(filename, start=0, stop=None):
+        """Reads recorded frames in a range, only decompressing chunks that
+        overlap it. Frame numbers restart each rep, so frames of all reps
+        in the range are returned, in display order.
+
+        :param filename: path of archive
+        :param int start: first frame number
+        :param int stop: frame number to stop before, or None for all
+        :return: tuple of frame numbers, and array of levels (frames x
+         channels x checks), bools if binary, else uint8
+        """
+        frames = []
+        levels = []
+
+        with numpy.load(filename) as archive:
+            binary = bool(archive['binary'])
+            num_checks = int(archive['num_checks'])
+
+            chunks = sorted(name[len('frames_'):] for name in archive.files
+                            if name.startswith('frames_'))
+
+            for chunk in chunks:
+                chunk_frames = archive['frames_' + chunk]
+
+                keep = chunk_frames >= start
+                if stop is not None:
+                    keep &= chunk_frames < stop
+
+                if not keep.any():
+                    continue
+
+                data = archive['data_' + chunk][keep]
+                if binary:
+                    data = numpy.unpackbits(
+                        data, axis=-1)[..., :num_checks].astype(bool)
+
+                frames.append(chunk_frames[keep])
+                levels.append(data)
+
+        if not frames:
+            return numpy.zeros(0, dtype=numpy.int32), None
+
+        return numpy.concatenate(frames), numpy.concatenate(levels)
+
+
+class SparseRecorder(NoiseRecorder):
+    """Records the flashes of a sparse noise stim to a .npz archive, on a
+    writer thread, as (frame, check, color) events, color being 1 for high
+    and 0 for low. As with :py:class:`NoiseRecorder`, only displayed frame
+    numbers are queued, and the writer remakes the flashes of each frame.
+
+    :param filename: path of archive
+    :param gen_flashes: callable taking a frame number, returning the checks
+     flashed and their colors
+    :param int num_check: number of checks per side of board
+    :param int chunk_size: number of frames per chunk
+    """
+    def __init__(self, filename, gen_flashes, num_check, chunk_size=1024):
+        self.num_check = num_check
+
+        super(SparseRecorder, self).__init__(filename, gen_flashes,
+                                             num_checks=num_check**2,
+                                             chunk_size=chunk_size)
+
+    def encode(self, flashes):
+        """Flashes are stored as events.
+
+        :param flashes: tuple of checks and colors
+        :return: tuple of int32 checks and uint8 colors
+        """
+        checks, colors = flashes
+
+        return (numpy.asarray(checks, dtype=numpy.int32),
+                numpy.asarray(colors, dtype=numpy.uint8))
+
+    def header(self):
+        """Members written once, with the first chunk.
+
+        :return: list of (name, array) tuples
+        """
+        return [('num_check', numpy.array(self.num_check))]
+
+    def chunk_arrays(self, frames, data):
+        """Members of a chunk, as frame, check and color of each event.
+
+        :param frames: list of frame numbers
+        :param data: list of encoded flashes
+        :return: list of (name, array) tuples
+        """
+        checks, colors = zip(*data)
+
+        return [('frame', numpy.repeat(numpy.array(frames, dtype=numpy.int32),
+                                       [len(c) for c in checks])),
+                ('check', numpy.concatenate(checks)),
+                ('color', numpy.concatenate(colors))]
+
+    @staticmethod
+    def read(filename, start=0, stop=None):
+        """Reads recorded flashes in a range of frames, only decompressing
+        chunks that overlap it. Frame numbers restart each rep, so flashes of
+        all reps in the range are returned, in display order.
+
+        :param filename: path of archive
+        :param int start: first frame number
+        :param int stop: frame number to stop before, or None for all
+        :return: dict of arrays of frame, check and color of each event
+        """
+        events = dict(frame=[], check=[], color=[])
+
+        with numpy.load(filename) as archive:
+            chunks = sorted(name[len('frame_'):] for name in archive.files
+                            if name.startswith('frame_'))
+
+            for chunk in chunks:
+                frames = archive['frame_' + chunk]
+
+                keep = frames >= start
+                if stop is not None:
+                    keep &= frames < stop
+
+                if not keep.any():
+                    continue
+
+                for name in events:
+                    events[name].append(archive[name + '_' + chunk][keep])
+
+        dtypes = dict(frame=numpy.int32, check=numpy.int32,
+                      color=numpy.uint8)
+
+        return {name: numpy.concatenate(arrays) if arrays else
+                numpy.zeros(0, dtype=dtypes[name])
+                for name, arrays in events.items()}
+
+
+class RenderPlan(object):
+    """Per frame state of a stim, compiled by the stim's compile() before
+    the animation loop. Each array is indexed by frame number, and is None
+    if the stim doesn't change that state. Stims too long to hold arrays of
+    every frame (i.e. memory mapped tables) use :py:class:`LazyFrames`
+    instead.
+
+    :ivar draw: whether stim is drawn on each frame
+    :ivar pos: x, y position on each frame
+    :ivar ori: orientation on frames where it changes, otherwise NaN
+    :ivar color: gamma corrected RGBA timing color on each frame
+    :ivar phase: texture phase on each frame
+    :ivar update: callable taking the frame number, for state that can't be
+     precomputed (e.g. noise, image jumps)
+    """
+    def __init__(self, num_frames):
+        self.num_frames = num_frames
+        self.draw = None
+        self.pos = None
+        self.ori = None
+        self.color = None
+        self.phase = None
+        self.update = None
+
+
+class LazyFrames(object):
+    """Frame indexed state of a render plan, calculated on each frame it's
+    indexed on, so that memory use doesn't grow with the number of frames.
+    Converts to an array of every frame where one is needed, e.g.
+    numpy.flatnonzero().
+
+    :param func: function of an array of frame numbers, returning an array
+     of their state
+    :param int num_frames: number of frames of the run
+    """
+    def __init__(self, func, num_frames):
+        self.func = func
+        self.num_frames = num_frames
+
+    def __len__(self):
+        """Number of frames."""
+        return self.num_frames
+
+    def __getitem__(self, frame):
+        """State on a frame.
+
+        :param int frame: frame number
+        """
+        return self.func(numpy.array([frame]))[0]
+
+    def __array__(self, dtype=None):
+        """State of every frame.
+
+        :param dtype: type of array, or None for that of func
+        """
+        return numpy.asarray(self.func(numpy.arange(self.num_frames)),
+                             dtype=dtype)
+
+
+class CaptureWriter(object):
+    """Encodes captured frames to movies with a single ffmpeg process, which
+    is fed raw rgb frames over stdin by a writer thread, so that the render
+    thread only queues frames. The process makes a colour and a gray movie
+    in one pass, capture_video[time].mpg and capture_video[time]_gray.mpg.
+
+    Frames are read back from the window's framebuffer, before the final
+    shader pass of gamma_mode 'gpu', so with a gamma correction the writer
+    thread corrects them as the window does on flip, with a table of each
+    channel's 8 bit values.
+
+    :param directory: folder to save movies in
+    :param time_string: time of run, for file names
+    :param size: width and height of frames in pix
+    :param frame_rate: frame rate of movies
+    :param int queue_size: number of frames to buffer before add() waits for
+     the writer
+    :param gamma: gamma correction instance to apply to frames, e.g.
+     MyWindow.gamma_lut, or None
+    """
+    def __init__(self, directory, time_string, size, frame_rate,
+                 queue_size=16, gamma=None):
+        self.directory = directory
+        self.size = tuple(int(i) for i in size)
+        self.filenames = [os.path.join(directory, 'capture_video' +
+                                       time_string + suffix + '.mpg')
+                          for suffix in ['', '_gray']]
+        self.failed = False
+
+        self.table = None
+        if gamma is not None:
+            grid = uint8_float(numpy.arange(256))
+            self.table = numpy.column_stack(
+                [float_uint8(numpy.clip(gamma.correct(grid, i), -1, 1))
+                 for i in range(3)]).astype(numpy.uint8)
+
+        args = ['ffmpeg', '-y', '-v', 'error',
+                '-f', 'rawvideo',
+                '-pix_fmt', 'rgb24',
+                '-s', '{}x{}'.format(*self.size),
+                '-framerate', str(frame_rate),
+                '-i', '-',
+                '-map', '0:v', '-b:v', '20M', self.filenames[0],
+                '-map', '0:v', '-vf', 'format=gray', '-qscale', '0',
+                self.filenames[1]]
+
+        try:
+            self.process = subprocess.Popen(args,
+                                            stdin=subprocess.PIPE,
+                                            stderr=subprocess.PIPE)
+        except OSError:
+            raise IOError('Capture needs ffmpeg, see installation guide.')
+
+        self.queue = queue.Queue(maxsize=queue_size)
+
+        self.thread = threading.Thread(target=self.write_frames)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, frame):
+        """Queues a captured frame to be encoded.
+
+        :param frame: uint8 array (rows x columns x 3), where row 0 is the
+         top, of size
+        """
+        self.queue.put(frame)
+
+    def write_frames(self):
+        """Writer thread target. Writes queued frames to ffmpeg. If ffmpeg
+        exits early, remaining frames are dropped, so that add() never
+        waits on a full queue.
+        """
+        while True:
+            frame = self.queue.get()
+
+            if frame is None:
+                break
+
+            if self.failed:
+                continue
+
+            if self.table is not None:
+                frame = self.table[frame, numpy.arange(3)]
+
+            try:
+                self.process.stdin.write(
+                    numpy.ascontiguousarray(frame, dtype=numpy.uint8).data)
+            except OSError:
+                self.failed = True
+
+    def close(self):
+        """Writes remaining frames, and waits for ffmpeg to finish the
+        movies.
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+
+        errors = self.process.stderr.read()
+        self.process.wait()
+
+        if self.process.returncode != 0 or self.failed:
+            print('\nffmpeg failed:\n{}'.format(
+                errors.decode(errors='replace')))
+        else:
+            print('\nSaved in: {}'.format(self.directory))
+
+
+class TextureQuad(object):
+    """An 8 bit texture drawn on a single quad, by default with nearest
+    neighbour sampling, so each texel covers size / texels pixels. Updates
+    are uploaded with a single sub image upload, on the next draw, so that
+    GL calls happen while the window's context is current. Textures don't
+    need power of two dimensions.
+
+    Has the position and orientation interface of psychopy stims used by the
+    stim classes.
+    """
+    #: GL pixel formats by number of channels.
+    formats = {1: GL.GL_LUMINANCE, 3: GL.GL_RGB, 4: GL.GL_RGBA}
+
+    def __init__(self, win, data, size, pos=(0, 0), ori=0,
+                 interpolate=False):
+        """
+        :param win: psychopy window to draw to
+        :param data: uint8 array (rows x columns x channels), where row 0 is
+         the bottom, with 1, 3 or 4 channels
+        :param size: width and height of quad in pix
+        :param pos: center of quad in pix
+        :param ori: orientation of quad in degrees, clockwise, as psychopy
+         stims
+        :param bool interpolate: whether to sample the texture linearly, as
+         psychopy stims, instead of with nearest neighbour sampling
+        """
+        self.win = win
+        self.size = numpy.array(size, dtype=float)
+        self.pos = numpy.array(pos, dtype=float)
+        self.ori = ori
+        self.interpolate = interpolate
+
+        self.tex_id = None
+        self.shape = None
+        self.data = None
+        self.texels = []
+
+        self.update(data)
+
+    def update(self, data, copy=True):
+        """Sets texture data, uploaded on next draw.
+
+        :param data: uint8 array, see __init__
+        :param bool copy: whether to copy data. If False, the quad holds on
+         to data until it is uploaded, so the caller must not change it, e.g.
+         frames handed over by a frame bank.
+        """
+        if copy:
+            data = numpy.array(data, dtype=numpy.uint8)
+        else:
+            data = numpy.asarray(data, dtype=numpy.uint8)
+        if data.ndim == 2:
+            data = data[:, :, numpy.newaxis]
+
+        self.data = numpy.ascontiguousarray(data)
+        self.texels = []
+
+    def update_texels(self, rows, columns, values):
+        """Sets single texels, uploaded on next draw with a sub image upload
+        each, so that changing a few texels doesn't upload the whole
+        texture.
+
+        :param rows: row of each texel
+        :param columns: column of each texel
+        :param values: uint8 array of texel values (texels x channels)
+        """
+        values = numpy.asarray(values, dtype=numpy.uint8).reshape(
+            len(rows), -1)
+
+        # not uploaded yet, so change pending data
+        if self.data is not None:
+            if not self.data.flags.writeable:
+                self.data = self.data.copy()
+            self.data[rows, columns] = values
+        else:
+            self.texels.extend(zip(rows, columns, values))
+
+    def upload(self):
+        """Uploads pending data, allocating texture on first upload or if
+        its shape changed.
+        """
+        rows, columns, channels = self.data.shape
+        pixel_format = TextureQuad.formats[channels]
+
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self.tex_id)
+        GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 1)
+
+        if self.shape != self.data.shape:
+            GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, pixel_format, columns, rows,
+                            0, pixel_format, GL.GL_UNSIGNED_BYTE,
+                            self.data.ctypes)
+            self.shape = self.data.shape
+        else:
+            GL.glTexSubImage2D(GL.GL_TEXTURE_2D, 0, 0, 0, columns, rows,
+                               pixel_format, GL.GL_UNSIGNED_BYTE,
+                               self.data.ctypes)
+
+        self.data = None
+
+    def upload_texels(self):
+        """Uploads pending single texels.
+        """
+        pixel_format = TextureQuad.formats[self.shape[2]]
+
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self.tex_id)
+        GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 1)
+
+        for row, column, value in self.texels:
+            value = numpy.ascontiguousarray(value)
+            GL.glTexSubImage2D(GL.GL_TEXTURE_2D, 0, int(column), int(row), 1,
+                               1, pixel_format, GL.GL_UNSIGNED_BYTE,
+                               value.ctypes)
+
+        self.texels = []
+
+    def draw(self, win=None):
+        """Draws quad, uploading pending data first.
+
+        :param win: window to draw to, defaults to window passed on init
+        """
+        win = self.win if win is None else win
+
+        if self.tex_id is None:
+            texture_filter = GL.GL_LINEAR if self.interpolate else \
+                GL.GL_NEAREST
+
+            self.tex_id = GL.GLuint()
+            GL.glGenTextures(1, ctypes.byref(self.tex_id))
+            GL.glBindTexture(GL.GL_TEXTURE_2D, self.tex_id)
+            for param in [GL.GL_TEXTURE_MIN_FILTER, GL.GL_TEXTURE_MAG_FILTER]:
+                GL.glTexParameteri(GL.GL_TEXTURE_2D, param, texture_filter)
+            for param in [GL.GL_TEXTURE_WRAP_S, GL.GL_TEXTURE_WRAP_T]:
+                GL.glTexParameteri(GL.GL_TEXTURE_2D, param,
+                                   GL.GL_CLAMP_TO_EDGE)
+
+        if self.data is not None:
+            self.upload()
+
+        if self.texels:
+            self.upload_texels()
+
+        # quad is drawn around its center, rotated clockwise by ori
+        left, bottom = -self.size / 2.
+        right, top = self.size / 2.
+
+        win.setScale('pix')
+
+        GL.glMatrixMode(GL.GL_MODELVIEW)
+        GL.glPushMatrix()
+        GL.glTranslatef(self.pos[0], self.pos[1], 0)
+        GL.glRotatef(-self.ori, 0, 0, 1)
+
+        GL.glUseProgram(0)
+        GL.glEnable(GL.GL_TEXTURE_2D)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self.tex_id)
+        GL.glTexEnvi(GL.GL_TEXTURE_ENV, GL.GL_TEXTURE_ENV_MODE, GL.GL_REPLACE)
+        GL.glColor4f(1, 1, 1, 1)
+
+        GL.glBegin(GL.GL_QUADS)
+        GL.glTexCoord2f(0, 0)
+        GL.glVertex2f(left, bottom)
+        GL.glTexCoord2f(1, 0)
+        GL.glVertex2f(right, bottom)
+        GL.glTexCoord2f(1, 1)
+        GL.glVertex2f(right, top)
+        GL.glTexCoord2f(0, 1)
+        GL.glVertex2f(left, top)
+        GL.glEnd()
+
+        GL.glTexEnvi(GL.GL_TEXTURE_ENV, GL.GL_TEXTURE_ENV_MODE,
+                     GL.GL_MODULATE)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+        GL.glDisable(GL.GL_TEXTURE_2D)
+
+        GL.glPopMatrix()
+
+    def setPos(self, pos):
+        """Position setter, as psychopy stims.
+
+        :param pos: center of quad in pix
+        """
+        self.pos = numpy.array(pos, dtype=float)
+
+
+class NoiseQuad(object):
+    """A quad of checks filled with noise by a fragment shader, hashed from
+    (seed, stim, frame, check, channel), so that nothing is uploaded per frame;
+    only the frame number changes. :py:func:`stim_noise.noise_frame` makes the
+    same frames on the CPU. Colors are gamma corrected in the shader with
+    the correction tables as a 1D texture, if correcting on the CPU. Needs
+    OpenGL 3.0 for integer operations in shaders.
+
+    Has the position and orientation interface of psychopy stims used by the
+    stim classes.
+    """
+    def __init__(self, win, num_check, size, seed, low, high, binary=False,
+                 pos=(0, 0), stim=0):
+        """
+        :param win: psychopy window to draw to
+        :param int num_check: number of checks along each side
+        :param size: width and height of quad in pix
+        :param int seed: seed of noise
+        :param low: rgb of low end of noise
+        :param high: rgb of high end of noise
+        :param bool binary: whether noise is binary or uniform
+        :param pos: center of quad in pix
+        :param int stim: stim number, so that stims with the same seed show
+         different noise
+        """
+        self.win = win
+        self.num_check = num_check
+        self.size = numpy.array(size, dtype=float)
+        self.pos = numpy.array(pos, dtype=float)
+        self.ori = 0
+
+        self.seed = seed
+        self.stim = stim
+        self.low = numpy.array(low, dtype=float)
+        self.high = numpy.array(high, dtype=float)
+        self.binary = binary
+        #: Frame number to draw noise of.
+        self.frame = 0
+
+        self.prog = None
+        self.lut_id = None
+
+    def draw(self, win=None):
+        """Draws quad, compiling shader on first draw.
+
+        :param win: window to draw to, defaults to window passed on init
+        """
+        win = self.win if win is None else win
+
+        if self.prog is None:
+            self.prog = shaders.compileProgram(NOISE_VERT_SHADER,
+                                               NOISE_FRAG_SHADER)
+
+            if MyWindow.gamma_mon is not None:
+                self.lut_id = MyWindow.gen_gamma_lut(MyWindow.gamma_mon)
+
+        # quad is drawn around its center, rotated clockwise by ori
+        left, bottom = -self.size / 2.
+        right, top = self.size / 2.
+
+        win.setScale('pix')
+
+        GL.glMatrixMode(GL.GL_MODELVIEW)
+        GL.glPushMatrix()
+        GL.glTranslatef(self.pos[0], self.pos[1], 0)
+        GL.glRotatef(-self.ori, 0, 0, 1)
+
+        def uniform(name):
+            return GL.glGetUniformLocation(self.prog, name)
+
+        lut_size = MyWindow.gamma_lut_size
+
+        # hash works on bit patterns, so wrap to signed ints
+        GL.glUseProgram(self.prog)
+        GL.glUniform1i(uniform(b'seed'), ctypes.c_int32(int(self.seed)).value)
+        GL.glUniform1i(uniform(b'stim'), ctypes.c_int32(int(self.stim)).value)
+        GL.glUniform1i(uniform(b'frame'), ctypes.c_int32(self.frame).value)
+        GL.glUniform1i(uniform(b'numCheck'), self.num_check)
+        GL.glUniform3f(uniform(b'low'), *self.low)
+        GL.glUniform3f(uniform(b'high'), *self.high)
+        GL.glUniform1i(uniform(b'binary'), self.binary)
+        GL.glUniform1i(uniform(b'gammaCorrect'), self.lut_id is not None)
+        GL.glUniform1i(uniform(b'lut'), 1)
+        GL.glUniform1f(uniform(b'lutScale'), (lut_size - 1.0) / lut_size)
+        GL.glUniform1f(uniform(b'lutOffset'), 0.5 / lut_size)
+
+        if self.lut_id is not None:
+            GL.glActiveTexture(GL.GL_TEXTURE1)
+            GL.glBindTexture(GL.GL_TEXTURE_1D, self.lut_id)
+            GL.glActiveTexture(GL.GL_TEXTURE0)
+
+        GL.glBegin(GL.GL_QUADS)
+        GL.glTexCoord2f(0, 0)
+        GL.glVertex2f(left, bottom)
+        GL.glTexCoord2f(1, 0)
+        GL.glVertex2f(right, bottom)
+        GL.glTexCoord2f(1, 1)
+        GL.glVertex2f(right, top)
+        GL.glTexCoord2f(0, 1)
+        GL.glVertex2f(left, top)
+        GL.glEnd()
+
+        if self.lut_id is not None:
+            GL.glActiveTexture(GL.GL_TEXTURE1)
+            GL.glBindTexture(GL.GL_TEXTURE_1D, 0)
+            GL.glActiveTexture(GL.GL_TEXTURE0)
+
+        GL.glUseProgram(0)
+        GL.glPopMatrix()
+
+    def setPos(self, pos):
+        """Position setter, as psychopy stims.
+
+        :param pos: center of quad in pix
+        """
+        self.pos = numpy.array(pos, dtype=float)
+
+
+class OffscreenTarget(object):
+    """A framebuffer object with an 8 bit RGBA texture attached, to render to
+    and read back from in a window's context, without touching what the
+    window shows. Used as a context manager, drawing within it goes to the
+    target, in pix units centered on the target, ignoring the window's view
+    offset and scale, with the window's framebuffer, viewport and matrices
+    restored on exit.
+
+    Rendering goes through the same pipeline as drawing to the window (e.g.
+    psychopy stims), so content can be prepared while the window stays open
+    and idle.
+    """
+    def __init__(self, win, size):
+        """
+        :param win: psychopy window whose context to render in
+        :param size: width and height of target in pix
+        """
+        self.win = win
+        self.size = (int(size[0]), int(size[1]))
+
+        self.fbo_id = None
+        self.tex_id = None
+
+        self.prev_fbo = None
+        self.prev_viewport = None
+
+    def create(self):
+        """Allocates framebuffer and its texture.
+        """
+        width, height = self.size
+
+        self.tex_id = GL.GLuint()
+        GL.glGenTextures(1, ctypes.byref(self.tex_id))
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self.tex_id)
+        for param in [GL.GL_TEXTURE_MIN_FILTER, GL.GL_TEXTURE_MAG_FILTER]:
+            GL.glTexParameteri(GL.GL_TEXTURE_2D, param, GL.GL_NEAREST)
+        GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGBA8, width, height, 0,
+                        GL.GL_RGBA, GL.GL_UNSIGNED_BYTE, None)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+
+        self.fbo_id = GL.GLuint()
+        GL.glGenFramebuffersEXT(1, ctypes.byref(self.fbo_id))
+        GL.glBindFramebufferEXT(GL.GL_FRAMEBUFFER_EXT, self.fbo_id)
+        GL.glFramebufferTexture2DEXT(GL.GL_FRAMEBUFFER_EXT,
+                                     GL.GL_COLOR_ATTACHMENT0_EXT,
+                                     GL.GL_TEXTURE_2D, self.tex_id, 0)
+
+        status = GL.glCheckFramebufferStatusEXT(GL.GL_FRAMEBUFFER_EXT)
+        if status != GL.GL_FRAMEBUFFER_COMPLETE_EXT:
+            raise RuntimeError('Offscreen framebuffer incomplete, status '
+                               '{}'.format(status))
+
+    def __enter__(self):
+        """Binds target for drawing, and clears it to transparent black.
+        """
+        self.win.winHandle.switch_to()
+
+        self.prev_fbo = ctypes.c_int()
+        GL.glGetIntegerv(GL.GL_FRAMEBUFFER_BINDING_EXT,
+                         ctypes.byref(self.prev_fbo))
+        self.prev_viewport = (ctypes.c_int * 4)()
+        GL.glGetIntegerv(GL.GL_VIEWPORT, self.prev_viewport)
+
+        if self.fbo_id is None:
+            try:
+                self.create()
+            except RuntimeError:
+                GL.glBindFramebufferEXT(GL.GL_FRAMEBUFFER_EXT,
+                                        self.prev_fbo.value)
+                self.close()
+                raise
+
+        GL.glBindFramebufferEXT(GL.GL_FRAMEBUFFER_EXT, self.fbo_id)
+
+        width, height = self.size
+        GL.glViewport(0, 0, width, height)
+
+        # stims scale by window size to draw in pix, so rescale to target
+        GL.glMatrixMode(GL.GL_PROJECTION)
+        GL.glPushMatrix()
+        GL.glLoadIdentity()
+        GL.glScalef(float(self.win.size[0]) / width,
+                    float(self.win.size[1]) / height, 1)
+        GL.glMatrixMode(GL.GL_MODELVIEW)
+        GL.glPushMatrix()
+        # window's view offset and scale are in the modelview, but targets
+        # are centered on themselves
+        GL.glLoadIdentity()
+
+        GL.glClearColor(0, 0, 0, 0)
+        GL.glClear(GL.GL_COLOR_BUFFER_BIT)
+
+        return self
+
+    def __exit__(self, *exc_info):
+        """Restores window's framebuffer, viewport and matrices.
+        """
+        GL.glMatrixMode(GL.GL_PROJECTION)
+        GL.glPopMatrix()
+        GL.glMatrixMode(GL.GL_MODELVIEW)
+        GL.glPopMatrix()
+
+        GL.glBindFramebufferEXT(GL.GL_FRAMEBUFFER_EXT, self.prev_fbo.value)
+        GL.glViewport(*self.prev_viewport)
+
+    def read(self):
+        """Reads back target. Call within the context.
+
+        :return: uint8 array (rows x columns x 3), where row 0 is the
+         bottom
+        """
+        width, height = self.size
+        pixels = numpy.zeros((height, width, 3), dtype=numpy.uint8)
+
+        GL.glPixelStorei(GL.GL_PACK_ALIGNMENT, 1)
+        GL.glReadPixels(0, 0, width, height, GL.GL_RGB, GL.GL_UNSIGNED_BYTE,
+                        pixels.ctypes)
+
+        return pixels
+
+    def close(self):
+        """Deletes framebuffer and texture.
+        """
+        if self.fbo_id is not None:
+            self.win.winHandle.switch_to()
+            GL.glDeleteFramebuffersEXT(1, ctypes.byref(self.fbo_id))
+            GL.glDeleteTextures(1, ctypes.byref(self.tex_id))
+
+        self.fbo_id = None
+        self.tex_id = None
+
+
+class ReadbackRing(object):
+    """Reads back a window's back buffer asynchronously, through a ring of
+    pixel pack buffers. Each read() starts copying the frame into the next
+    buffer, which returns without waiting for the GPU, and maps the buffer
+    read depth - 1 frames earlier, which has had time to finish, so reading
+    back doesn't stall the pipeline every frame. Frames are returned depth - 1
+    reads late, and flush() returns the rest.
+    """
+    def __init__(self, win, size, depth=3):
+        """
+        :param win: psychopy window to read from
+        :param size: width and height of window in pix
+        :param int depth: number of buffers, at least 2
+        """
+        self.win = win
+        self.size = (int(size[0]), int(size[1]))
+        self.depth = max(2, depth)
+        self.nbytes = self.size[0] * self.size[1] * 4
+
+        self.buffer_ids = None
+        self.count = 0
+        self.pending = deque()
+
+    def create(self):
+        """Allocates buffers.
+        """
+        self.buffer_ids = (GL.GLuint * self.depth)()
+        GL.glGenBuffers(self.depth, self.buffer_ids)
+
+        for buffer_id in self.buffer_ids:
+            GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, buffer_id)
+            GL.glBufferData(GL.GL_PIXEL_PACK_BUFFER, self.nbytes, None,
+                            GL.GL_STREAM_READ)
+
+        GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, 0)
+
+    def read(self):
+        """Starts reading back the back buffer, and maps the oldest pending
+        read once all buffers are in use.
+
+        :return: uint8 array (rows x columns x 3) of the frame read depth - 1
+         reads earlier, where row 0 is the top, or None if there isn't one
+         yet
+        """
+        if self.buffer_ids is None:
+            self.create()
+
+        width, height = self.size
+        buffer_id = self.buffer_ids[self.count % self.depth]
+        self.count += 1
+
+        # windows drawing to a framebuffer object have no back buffer
+        if getattr(self.win, 'useFBO', False):
+            GL.glReadBuffer(GL.GL_COLOR_ATTACHMENT0_EXT)
+        else:
+            GL.glReadBuffer(GL.GL_BACK)
+
+        # reads into the bound buffer, at offset 0, without waiting
+        GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, buffer_id)
+        GL.glPixelStorei(GL.GL_PACK_ALIGNMENT, 1)
+        GL.glReadPixels(0, 0, width, height, GL.GL_RGBA, GL.GL_UNSIGNED_BYTE,
+                        0)
+        GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, 0)
+
+        self.pending.append(buffer_id)
+
+        if len(self.pending) < self.depth:
+            return None
+
+        return self.map(self.pending.popleft())
+
+    def map(self, buffer_id):
+        """Copies a finished read out of its buffer.
+
+        :param buffer_id: buffer to map
+        :return: uint8 array (rows x columns x 3), where row 0 is the top,
+         as a view of the copy
+        """
+        width, height = self.size
+
+        GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, buffer_id)
+        address = GL.glMapBuffer(GL.GL_PIXEL_PACK_BUFFER, GL.GL_READ_ONLY)
+
+        if not address:
+            GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, 0)
+            raise RuntimeError('Could not map pixel pack buffer.')
+
+        try:
+            data = ctypes.cast(address, ctypes.POINTER(
+                ctypes.c_ubyte * self.nbytes)).contents
+            frame = numpy.frombuffer(data, dtype=numpy.uint8).copy()
+        finally:
+            GL.glUnmapBuffer(GL.GL_PIXEL_PACK_BUFFER)
+            GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, 0)
+
+        return frame.reshape(height, width, 4)[::-1, :, :3]
+
+    def flush(self):
+        """Maps all pending reads.
+
+        :return: list of frames, in order, see map()
+        """
+        frames = [self.map(buffer_id) for buffer_id in self.pending]
+        self.pending.clear()
+
+        return frames
+
+    def close(self):
+        """Deletes buffers. Pending reads are dropped.
+        """
+        if self.buffer_ids is not None:
+            GL.glDeleteBuffers(self.depth, self.buffer_ids)
+
+        self.buffer_ids = None
+        self.pending.clear()
+
+
+class StimDefaults(object):
+    """Super class to hold parameter defaults. GUI passes dictionary of all
+    parameters, whether used to make stim or not.
+
+    :param string shape: Shape of the stim, 'circle', 'rectangle, or 'annulus'.
+
+    :param string fill_mode: How the stim is filled. Can be 'uniform',
+     'sine', 'square', 'concentric', 'checkerboard', 'random', 'image',
+     or 'movie'.
+
+    :param float orientation: Orientation of the stim, in degrees.
+
+    :param list size: Size of the stim, as an x, y list.
+
+    :param float outer_diameter: Size of circle, or outer diameter of
+     annulus, in micrometers.
+
+    :param float inner_diameter: Inner diameter of annulus, in micrometers.
+
+    :param list check_size: Size of each check in a checkerboard or randomly
+     filled board, as an x, y list in micrometers.
+
+    :param int num_check: The number of checks in each direction.
+
+    :param int num_sparse: The number of checks flashed each frame by sparse
+     noise boards.
+
+    :param float delay: The time to between the first frame and the stim
+     appearing on screen. Rounds up to the nearest frame.
+
+    :param float end_delay: The time to between the last frame stim
+     appearing on screen and the end of frames flipping. Rounds up to the
+     nearest frame.
+
+    :param float duration: The duration for which the stim will animated.
+     Rounds up to the nearest frame.
+
+    :param list location: Coordinates of the stim, as an x, y list.
+
+    :param string timing: How the stim appears on screen over time. For
+     'step', the stim appears immediately. Other options include 'sine',
+     'sawtooth', 'square', and 'linear'.
+
+    :param float period_mod: For cyclic timing modes, the number of cycles.
+
+    :param float alpha: The transparency of the of the stim, between 0 and 1.
+     Does not apply to checkerboard or random fill stims, or images and movies.
+
+    :param string color_mode: The way in which the color of the stim is
+     determined. Can be either 'intensity', or 'rgb'.
+
+    :param string contrast_channel: The color channel in which color is
+     displayed in intensity mode. For the RGB color mode, contrast channel is
+     only used if a fill other than uniform is specified.
+
+    :param float intensity: The color of the stim relative to background,
+     between -1 and 1. For  fills, the color will fluctuate between high and
+     low values of the  specified intensity relative to background, and thus
+     background values on either extreme must use low intensities or risk
+     hitting the color ceiling/floor of the monitor.
+
+    :param list color: RGB color values of the stim, as a list of 3 values
+     between -1 and 1.
+
+    :param float fill_seed: The seed for the random number generator for
+     random fills.
+
+    :param float move_seed: The seed for the random number generator for
+     random movement.
+
+    :param float speed: The speed of moving stims, in micrometers per second.
+
+    :param int num_dirs: The number of directions radially moving stims will
+     travel in.
+
+    :param float start_dir: The start direction for radially moving stims.
+
+    :param float start_radius: The start radius for radially moving stims.
+
+    :param float move_delay: The amount of wait time between each move
+     direction.
+
+    :param float travel_distance: The distance that randomly moving stims
+     will travel before choosing a new direction.
+
+    :param string intensity_dir: Whether to go one or both directions relative to background.
+
+    :param string contrast_opp: How the opposite of a color is determined.
+     Black means go to black, opposite indicates increase other color channels
+     as primary channel decreases.
+
+    :param float sf: The spatial frequency of a stim texture.
+
+    :param list phase: The offset of texture in the stim. Units are in
+     cycles, so integer phases will result in no discernible change.
+
+    :param string movie_filename: File path of the movie to be displayed.
+
+    :param list movie_size: Size of the movie, as an x, y list, in micrometers.
+     Keep aspect ratio or movie will be distorted.
+
+    :param string image_filename: File path of the image to be displayed.
+
+    :param list image_size: Size of the image, as an x, y list, in micrometers.
+     Keep aspect ratio or movie will be distorted.
+
+    :param string table_filename: File path of the table to be used for
+     coordinates.
+
+    :param bool trigger: Whether or not to send a trigger for the stim.
+
+    :param int num_jumps:
+
+    :param int frame_repeat: The number of frames each image of an image
+     sequence is shown for.
+
+    :param float jump_delay:
+
+    :param float force_stop: time at which stim should end, overrides all
+     other timing. Useful for moving and table stims.
+    """
+    def __init__(self,
+                 shape='circle',
+                 fill_mode='uniform',
+                 orientation=0,
+                 size=None,
+                 outer_diameter=75,
+                 inner_diameter=40,
+                 check_size=None,
+                 num_check=64,
+                 num_sparse=1,
+                 check_type='board',
+                 delay=0,
+                 duration=0.5,
+                 location=None,
+                 timing='step',
+                 intensity=1,
+                 alpha=1,
+                 color=None,
+                 color_mode='intensity',
+                 image_channel='all',
+                 fill_seed=1,
+                 move_seed=1,
+                 speed=10,
+                 num_dirs=4,
+                 start_dir=0,
+                 start_radius=300,
+                 travel_distance=50,
+                 ori_with_dir=False,
+                 intensity_dir='both',
+                 contrast_opp='opposite',
+                 frequency=1,
+                 sf=1,
+                 phase=None,
+                 phase_speed=None,
+                 contrast_channel='green',
+                 movie_filename=None,
+                 movie_size=None,
+                 period_mod=1,
+                 image_size=None,
+                 image_filename=None,
+                 table_filename=None,
+                 jitter_filename=None,
+                 table_type='polar',
+                 trigger=False,
+                 move_delay=0,
+                 num_jumps=5,
+                 frame_repeat=1,
+                 # jump_delay=None,
+                 shuffle=False,
+                 blend_jumps=False,
+                 force_stop=0,
+                 end_delay=0,
+                 **kwargs):
+        """
+        Default variable constructors; distance and time units converted
+        appropriately.
+        """
+        for key, value in kwargs.items():
+            print('NOT USED: {}={}'.format(key, value))
+
+        self.shape = shape
+        self.fill_mode = fill_mode
+        self.sf = sf
+        self.intensity_dir = intensity_dir
+        self.contrast_opp = contrast_opp
+        self.color_mode = color_mode
+        self.intensity = intensity
+        self.alpha = alpha
+        self.orientation = orientation
+        self.num_check = num_check
+        self.num_sparse = num_sparse
+        self.check_type = check_type
+        self.fill_seed = fill_seed
+        self.timing = timing
+        self.frequency = frequency
+        self.period_mod = period_mod * 2.0 * duration
+        self.move_seed = move_seed
+        self.num_dirs = num_dirs
+        self.ori_with_dir = ori_with_dir
+        self.movie_filename = movie_filename
+        self.image_filename = image_filename
+        self.jitter_filename = jitter_filename
+        self.table_filename = table_filename
+        self.table_type = table_type
+        self.trigger = trigger
+        self.num_jumps = num_jumps
+        self.frame_repeat = max(1, int(frame_repeat))
+        self.shuffle = shuffle
+        self.blend_jumps = blend_jumps
+
+        self.contrast_channel = ['red', 'green', 'blue', 'all'].\
+            index(contrast_channel)
+        self.image_channel = ['red', 'green', 'blue', 'all'].\
+            index(image_channel)
+
+        # override start dir with global
+        if GlobalDefaults['pref_dir'] != -1:
+            self.start_dir = GlobalDefaults['pref_dir']
+        else:
+            self.start_dir = start_dir
+
+        # mutable variables
+        if color is not None:
+            self.color = color
+        else:
+            self.color = [-1, 1, -1]
+
+        if movie_size is not None:
+            self.movie_size = movie_size
+        else:
+            self.movie_size = [100, 100]
+
+        if phase is not None:
+            self.phase = phase
+        else:
+            self.phase = [0, 0]
+
+        # size conversions
+        self.outer_diameter = outer_diameter * GlobalDefaults['pix_per_micron']
+        self.inner_diameter = inner_diameter * GlobalDefaults['pix_per_micron']
+        self.start_radius = start_radius * GlobalDefaults['pix_per_micron']
+        self.travel_distance = travel_distance * GlobalDefaults[
+            'pix_per_micron']
+
+        # time conversions
+        self.delay = delay * GlobalDefaults['frame_rate']
+        self.end_delay = end_delay * GlobalDefaults['frame_rate']
+        self.duration = duration * GlobalDefaults['frame_rate']
+        self.move_delay = int(move_delay * GlobalDefaults['frame_rate'])
+        # self.jump_delay = jump_delay * GlobalDefaults['frame_rate']
+        self.force_stop = force_stop * GlobalDefaults['frame_rate']
+
+        # speed conversion
+        self.speed = speed * (1.0 * GlobalDefaults['pix_per_micron'] /
+                              GlobalDefaults['frame_rate'])
+
+        # mutable variables with unit conversion
+        if location is not None:
+            self.location = [location[0] * GlobalDefaults['pix_per_micron'],
+                             location[1] * GlobalDefaults['pix_per_micron']]
+        else:
+            self.location = [0, 0]
 
         if size is not None:
             self.size = [size[0] * GlobalDefaults['pix_per_micron'],
@@ -728,7 +2647,7 @@ class StimDefaults(object):
                                        [image_size[0] * GlobalDefaults['pix_per_micron'],
                                         image_size[1] * GlobalDefaults['pix_per_micron']]))
         else:
-            self.movie_size = [100, 100]
+            self.image_size = [100, 100]
 
         if check_size is not None:
             self.check_size = [check_size[0] * GlobalDefaults[
@@ -763,9 +2682,14 @@ class StaticStim(StimDefaults):
         self.draw_duration = None
         self.stim = None
         self.small_stim = None
+        self.plan = None
         self.contrast_adj_rgb = None
 
         self.colors = None
+        self.color_schedule = None
+
+        #: Order of stim, keys its random streams. Set by stim_factory().
+        self.number = 0
 
         # seed fill and move randoms
         self.fill_random = Random()
@@ -787,10 +2711,17 @@ class StaticStim(StimDefaults):
         if self.timing != 'step':
             self.fill_mode = 'uniform'
 
+        texture = self.gen_texture()
+
+        # if gamma correcting on the GPU, timing colors are set as the stim
+        # color, which multiplies a white texture
+        if self.timing != 'step' and MyWindow.gamma_lut is not None:
+            texture[:, :, 0:3] = 1
+
         self.stim = visual.GratingStim(win=MyWindow.win,
                                        size=self.gen_size(),
                                        mask=self.gen_mask(),
-                                       tex=self.gen_texture(),
+                                       tex=texture,
                                        pos=self.location,
                                        phase=self.phase,
                                        ori=self.orientation,
@@ -822,8 +2753,7 @@ class StaticStim(StimDefaults):
         self.start_stim = int(ceil(self.delay))
 
         if self.trigger:
-            if self.start_stim not in MyWindow.frame_trigger_list:
-                MyWindow.frame_trigger_list.add(self.start_stim)
+            self.add_trigger(self.start_stim)
 
         self.end_stim = int(ceil(self.duration + self.start_stim))
         self.end_delay = int(ceil(self.end_delay))
@@ -834,27 +2764,150 @@ class StaticStim(StimDefaults):
             self.end_stim = int(ceil(self.force_stop))
             self.end_delay = 0
 
+        self.color_schedule = self.gen_color_schedule()
+
         return self.end_stim + self.end_delay
 
+    def add_trigger(self, frame):
+        """Registers a frame on which to send a trigger.
+
+        :param int frame: frame number to trigger on
+        """
+        if frame not in MyWindow.frame_trigger_list:
+            MyWindow.frame_trigger_list.add(frame)
+
+    def reset(self):
+        """Rewinds state not held in the render plan, so that the same
+        instance can be replayed for another protocol rep without rebuilding
+        textures, stim objects or the plan.
+        """
+        # reseed randoms
+        self.fill_random.seed(self.fill_seed)
+        self.move_random.seed(self.move_seed)
+
+    def close(self):
+        """Releases anything held for animating, such as producer threads.
+        Called once after the last rep.
+        """
+        pass
+
+    def stop(self):
+        """Stops anything that plays in the background, such as movies, at
+        the end of each rep. Rewound by reset() before the next rep.
+        """
+        pass
+
+    def record(self, directory, time_string):
+        """Starts recording displayed frames to directory. Only stims with
+        random content record.
+
+        :param directory: log folder of run
+        :param time_string: time of run, for file names
+        """
+        pass
+
+    def compile(self, num_frames):
+        """Compiles draw range, timing colors and phase drift into a render
+        plan indexed by frame, so that animate() only applies precomputed
+        state. Call once, after draw_times().
+
+        :param int num_frames: number of frames of the run
+        """
+        self.plan = RenderPlan(num_frames)
+        self.plan.draw = self.compile_frames(self.is_drawn)
+
+        # adjust colors based on timing
+        if self.fill_mode not in ['movie', 'image']:
+            if self.fill_mode == 'checkerboard':
+                if self.check_type in ['noisy noise', 'binary noise',
+                                       'sparse noise'] or \
+                        self.timing != 'step':
+                    self.plan.update = self.gen_timing
+
+            elif self.timing != 'step':
+                self.plan.color = self.compile_frames(self.gen_plan_color,
+                                                      drawn=True)
+
+        # phase drifts by phase_speed on every drawn frame
+        if self.fill_mode not in ['movie', 'checkerboard'] and \
+                any(self.phase_speed):
+            self.plan.phase = self.compile_frames(self.gen_plan_phase,
+                                                  drawn=True)
+
+    def compile_frames(self, func, drawn=False):
+        """Compiles state of the plan into an array indexed by frame.
+
+        :param func: function of an array of frame numbers, returning an
+         array of their state
+        :param bool drawn: whether to only calculate state of frames stim is
+         drawn on, leaving others zero
+        :return: array (num_frames x ...)
+        """
+        if not drawn:
+            return func(numpy.arange(self.plan.num_frames))
+
+        frames = numpy.flatnonzero(self.plan.draw)
+        state = func(frames)
+
+        compiled = numpy.zeros((self.plan.num_frames,) + state.shape[1:],
+                               dtype=state.dtype)
+        compiled[frames] = state
+
+        return compiled
+
+    def is_drawn(self, frames):
+        """Whether stim is drawn on frames.
+
+        :param frames: array of frame numbers
+        :return: bool array
+        """
+        return (frames >= self.start_stim) & (frames < self.end_stim)
+
+    def gen_plan_color(self, frames):
+        """Timing colors of drawn frames.
+
+        :param frames: array of frame numbers
+        :return: float32 array of RGBA values (frames x 4)
+        """
+        return self.lookup_colors(frames - self.start_stim)
+
+    def gen_plan_phase(self, frames):
+        """Texture phase of drawn frames, which drifts by phase_speed from
+        the first.
+
+        :param frames: array of frame numbers
+        :return: array of phases (frames x 2)
+        """
+        drifted = frames - int(ceil(self.start_stim)) + 1
+
+        return numpy.add(self.phase, numpy.multiply.outer(
+            drifted, numpy.asarray(self.phase_speed, dtype=float)))
+
     def animate(self, frame):
-        """Method for drawing stim objects to back buffer. Checks if object
-        should be drawn. Back buffer is brought to front with calls to flip()
-        on the window.
+        """Method for drawing stim objects to back buffer. Applies the
+        state compiled for this frame by compile(), if stim should be drawn.
+        Back buffer is brought to front with calls to flip() on the window.
 
         :param int frame: current frame number
         """
+        plan = self.plan
+
         # check if within animation range
-        if self.start_stim <= frame < self.end_stim:
-            # adjust colors and phase based on timing
-            if self.fill_mode not in ['movie', 'image']:
-                if self.fill_mode == 'checkerboard' and self.check_type == 'noisy noise':
-                    self.gen_timing(frame)
+        if plan.draw[frame]:
+            if plan.update is not None:
+                plan.update(frame)
+
+            if plan.pos is not None:
+                self.set_pos(*plan.pos[frame])
 
-                elif self.timing != 'step':
-                    self.gen_timing(frame)
+            if plan.ori is not None and not numpy.isnan(plan.ori[frame]):
+                self.stim.ori = plan.ori[frame]
 
-            if self.fill_mode != 'movie':
-                self.gen_phase()
+            if plan.color is not None:
+                self.set_timing_color(plan.color[frame])
+
+            if plan.phase is not None:
+                self.stim.phase = plan.phase[frame]
 
             if self.small_stim is not None:
                 MyWindow.win.winHandle.switch_to()
@@ -979,6 +3032,53 @@ class StaticStim(StimDefaults):
         return stim_mask
 
     def gen_texture(self):
+        """Gets texture for stim object from :py:class:`TextureCache`,
+        generating it with make_texture() if needed.
+
+        :return: texture as numpy array
+        """
+        texture = TextureCache.get(self.texture_key(), self.make_texture)
+
+        # timing stims edit their texture every frame
+        if self.timing != 'step':
+            texture = numpy.array(texture)
+
+        return texture
+
+    def texture_key(self):
+        """Hashes the parameters that make_texture() depends on, along with
+        the active gamma profile.
+
+        :return: key for :py:class:`TextureCache`
+        """
+        if self.colors is None:
+            self.gen_rgb()
+
+        if self.fill_mode == 'image' and self.image_filename is not None \
+                and os.path.exists(self.image_filename):
+            image = (os.path.abspath(self.image_filename),
+                     os.path.getmtime(self.image_filename),
+                     self.image_channel)
+        else:
+            image = None
+
+        if MyWindow.gamma_mon is not None:
+            gamma = str(GlobalDefaults['gamma_correction'])
+        else:
+            gamma = None
+
+        return TextureCache.make_key(self.fill_mode,
+                                     self.shape,
+                                     self.gen_size(),
+                                     self.outer_diameter,
+                                     self.inner_diameter,
+                                     self.contrast_channel,
+                                     self.alpha,
+                                     self.colors,
+                                     image,
+                                     gamma)
+
+    def make_texture(self):
         """Generates texture for stim object. Textures are 3D numpy arrays
         (size*size*4). The 3rd dimension is RGB and Alpha (transparency)
         values.
@@ -1049,84 +3149,112 @@ class StaticStim(StimDefaults):
 
             filename, file_ext = os.path.splitext(pic_name)
 
+            # rotated and gamma corrected
             if file_ext != '.iml':
-                image = Image.open(self.image_filename)
+                texture = self.load_image()
 
-                # make smaller for faster correction if possible
-                if max(image.size) > max(self.gen_size()):
-                    image.thumbnail(self.gen_size(), Image.ANTIALIAS)
+            # if .iml
+            else:
+                image = IMLImage(self.image_filename, rotated=True)
+                texture = image.texture(channel=self.image_channel,
+                                        alpha=self.alpha,
+                                        gamma=MyWindow.gamma_mon)
 
-                # rescale rgb
-                texture = numpy.asarray(image) / 255.0 * 2 - 1
+        # gamma correct
+        if self.fill_mode != 'image' and MyWindow.gamma_mon is not None:
+            texture = MyWindow.gamma_mon(texture, copy=False)
 
-                # if only want one color channel, remove others
-                if self.image_channel != 3:
-                    for i in range(3):
-                        if self.image_channel != i:
-                            texture[:, :, i] = -1
+        # make center see-through if annulus
+        if self.shape == 'annulus':
+            radius = filters.makeRadialMatrix(self.outer_diameter,
+                                              radius=1.0 / self.outer_diameter)
+            texture[numpy.where(radius < self.inner_diameter)] = [0, 0, 0, -1]
 
-                # add alpha
-                texture = numpy.insert(texture, 3, self.alpha, axis=2)
+        # print texture
+        return texture
 
-            # if .iml
-            else:
-                image = numpy.fromfile(self.image_filename, dtype='uint16')
-                image.byteswap(True)  # changes endianness
-                image = image.reshape(1024, 1536)
+    def load_image(self):
+        """Gets image texture from the on disk cache of
+        :py:class:`TextureCache`, decoding it with decode_image() if needed.
+        Keyed on a hash of the file's contents, along with image size,
+        channel, alpha and the active gamma profile.
+
+        :return: texture as numpy array
+        """
+        if MyWindow.gamma_mon is not None:
+            gamma = str(GlobalDefaults['gamma_correction'])
+        else:
+            gamma = None
 
-                maxi = image.max()
-                if maxi <= 4095:
-                    maxi = 4095
+        key = TextureCache.make_key(TextureCache.hash_file(self.image_filename),
+                                    self.gen_size(),
+                                    self.image_channel,
+                                    self.alpha,
+                                    gamma)
 
-                image = image.astype(numpy.float64)
+        return TextureCache.load(key, self.decode_image)
 
-                image /= maxi
+    def decode_image(self):
+        """Decodes image file in a single pass into a float32 RGBA texture,
+        shrunk to fit image size, with channels other than image_channel
+        dark. Rotated 180 degrees as a view, and gamma corrected.
 
-                if self.image_channel != 3:
-                    texture = numpy.zeros((1024, 1536, 3))
-                    texture[:, :, self.image_channel] = image
+        :return: texture as numpy array
+        """
+        image = Image.open(self.image_filename)
+        size = tuple(int(i) for i in self.gen_size())
 
-                    texture *= 2
-                    texture -= 1
+        # JPEGs can decode at a reduced scale directly
+        image.draft('RGB', size)
 
-                    # add alpha values
-                    texture = numpy.insert(texture, 3, self.alpha, axis=2)
+        # make smaller for faster correction if possible
+        if max(image.size) > max(size):
+            image.thumbnail(size, Image.LANCZOS)
 
-                # .iml are gray scale by default
-                else:
-                    image *= 2
-                    image -= 1
-                    texture = image
+        pixels = numpy.asarray(image.convert('RGB'))
+
+        texture = numpy.empty(pixels.shape[:2] + (4,), dtype=numpy.float32)
+        texture[:, :, 3] = self.alpha
+
+        # rescale rgb, only of wanted channel if one
+        if self.image_channel != 3:
+            texture[:, :, :3] = -1
+            pixels = pixels[:, :, self.image_channel]
+            rgb = texture[:, :, self.image_channel]
+        else:
+            rgb = texture[:, :, :3]
 
-            texture = numpy.rot90(texture, 2)
+        numpy.multiply(pixels, numpy.float32(2 / 255.), out=rgb)
+        rgb -= 1
+
+        texture = texture[::-1, ::-1]
 
         # gamma correct
         if MyWindow.gamma_mon is not None:
-            texture = MyWindow.gamma_mon(texture)
-
-        # make center see-through if annulus
-        if self.shape == 'annulus':
-            radius = filters.makeRadialMatrix(self.outer_diameter,
-                                              radius=1.0 / self.outer_diameter)
-            texture[numpy.where(radius < self.inner_diameter)] = [0, 0, 0, -1]
+            texture = MyWindow.gamma_mon(texture, copy=False)
 
-        # print texture
         return texture
 
-    # @profile
-    def gen_timing(self, frame):
-        """Adjusts color values of stims based on desired timing in desired
-        channel(i.e. as a function of current frame over draw time).
-        Recalculated on every call to animate()
-
-        TODO: precompute values
+    def gen_color_schedule(self, stim_frames=None):
+        """Precomputes the color of the stim on each frame for non step
+        timing modes, so that animating only needs to index a row. Colors
+        are gamma corrected and clipped.
 
-        :param int frame: current frame number
-        :return: list of rgb values as floats
+        :param stim_frames: frame numbers relative to the start of the stim.
+         Defaults to every frame of the draw duration.
+        :return: float32 array of RGBA values (frames x 4), or None if stim
+         is not animated by timing
         """
-        stim_frame_num = frame - self.start_stim
-        time_fraction = stim_frame_num * 1.0 / self.draw_duration
-        texture = self.stim.tex
+        if self.timing == 'step' or self.fill_mode in ['movie', 'image',
+                                                       'checkerboard']:
+            return None
+
+        if stim_frames is None:
+            stim_frames = numpy.arange(self.draw_duration)
+
+        # column so that channels broadcast across rows
+        time_fraction = numpy.asarray(stim_frames, dtype=numpy.float64)[
+            :, numpy.newaxis] / self.draw_duration
 
         if self.colors is not None:
             _, _, delta, background = self.colors
@@ -1137,64 +3265,99 @@ class StaticStim(StimDefaults):
         delta = (delta + 1) / 2
         background = (background + 1) / 2
 
-        if self.timing == 'sine':
-            # adjust color
-            if self.intensity_dir == 'both':
-                color = scipy.sin(self.period_mod * scipy.pi *
-                                  time_fraction) * delta + background
+        angle = self.period_mod * numpy.pi * time_fraction
 
-            elif self.intensity_dir == 'single':
-                color = scipy.sin(self.period_mod * scipy.pi *
-                                  time_fraction - scipy.pi / 2) * delta + background
+        if self.timing == 'sine':
+            if self.intensity_dir == 'single':
+                angle = angle - numpy.pi / 2
+            wave = numpy.sin(angle)
 
         elif self.timing == 'square':
-            if self.intensity_dir == 'both':
-                color = (scipy.signal.square(self.period_mod * scipy.pi *
-                                             time_fraction, duty=0.5) * 2) / \
-                    2 * delta + background
-
-            if self.intensity_dir == 'single':
-                color = scipy.signal.square(self.period_mod * scipy.pi *
-                                            time_fraction, duty=0.5) * delta \
-                    + background
+            wave = scipy.signal.square(angle, duty=0.5)
 
         elif self.timing == 'sawtooth':
-            if self.intensity_dir == 'both':
-                color = (scipy.signal.sawtooth(self.period_mod * scipy.pi *
-                                               time_fraction, width=0.5) * 2) \
-                    / 2 * delta + background
-
-            if self.intensity_dir == 'single':
-                color = scipy.signal.sawtooth(self.period_mod * scipy.pi *
-                                              time_fraction, width=0.5) * \
-                    delta + background
+            wave = scipy.signal.sawtooth(angle, width=0.5)
 
         elif self.timing == 'linear':
             # don't need to check intensity dir, because determined by delta
-            color = background + delta * (time_fraction * 2 - 1)
+            wave = time_fraction * 2 - 1
+
+        color = wave * delta + background
 
         # unscale
         color = color * 2 - 1
 
         # gamma correct
-        if MyWindow.gamma_mon is not None and self.fill_mode not in ['image']:
+        if MyWindow.gamma_mon is not None:
             color = MyWindow.gamma_mon(color, channel=self.contrast_channel)
 
-        # fill texture array
+        # other channels go either to black or opposite of contrast channel
         if self.contrast_channel != 3:
             if self.contrast_opp == 'black':
-                if color[0] > 0:
-                    c = color * -1
-                else:
-                    c = color
+                c = numpy.where(color[:, :1] > 0, color * -1, color)
             elif self.contrast_opp == 'opposite':
                 c = color * -1
-            c = numpy.clip(c, -1, 1)
-            c[self.contrast_channel] = color[self.contrast_channel]
+            c[:, self.contrast_channel] = color[:, self.contrast_channel]
+            color = c
 
-            texture[:, :, 0:3] = c
-        else:
-            texture[:, :, 0:3] = color
+        schedule = numpy.empty((len(color), 4), dtype=numpy.float32)
+        schedule[:, 0:3] = numpy.clip(color, -1, 1)
+        schedule[:, 3] = self.alpha
+
+        return schedule
+
+    def gen_timing(self, frame):
+        """Adjusts color values of stims based on desired timing in desired
+        channel(i.e. as a function of current frame over draw time).
+
+        :param int frame: current frame number
+        """
+        self.set_timing_color(self.lookup_colors([frame - self.start_stim])[0])
+
+    def lookup_colors(self, stim_frames):
+        """Looks up timing colors from the schedule made by
+        gen_color_schedule(), and only calculates colors of frames outside of
+        it (i.e. force_stop).
+
+        :param stim_frames: frame numbers relative to the start of the stim.
+        :return: float32 array of RGBA values (frames x 4)
+        """
+        stim_frames = numpy.asarray(stim_frames)
+
+        if self.color_schedule is None:
+            return self.gen_color_schedule(stim_frames)
+
+        index = stim_frames.astype(int)
+        scheduled = (index == stim_frames) & (index >= 0) & \
+            (index < len(self.color_schedule))
+
+        colors = numpy.empty((len(stim_frames), 4), dtype=numpy.float32)
+        colors[scheduled] = self.color_schedule[index[scheduled]]
+        if not scheduled.all():
+            colors[~scheduled] = self.gen_color_schedule(
+                stim_frames[~scheduled])
+
+        return colors
+
+    def set_timing_color(self, color):
+        """Sets color of the stim's texture, leaving alpha for masks.
+
+        :param color: gamma corrected RGBA value
+        """
+        # if gamma correcting on the GPU, texture is white, so only need to
+        # update color instead of uploading texture
+        if MyWindow.gamma_lut is not None:
+            self.stim.setColor(color[0:3])
+
+            if self.small_stim is not None:
+                self.small_stim.setColor(color[0:3])
+
+            return
+
+        texture = self.stim.tex
+
+        # fill texture array, leaving alpha for masks such as annuli
+        texture[:, :, 0:3] = color[0:3]
 
         self.stim.tex = texture
 
@@ -1228,11 +3391,11 @@ class MovingStim(StaticStim):
         # non parameter instance attributes
         self.current_x = None
         self.current_y = None
-        self.frame_counter = None
         self.x_array = None
         self.y_array = None
         self.num_frames = None
-        self.error_count = 0
+        self.sweeps = None
+        self.sweep_dirs = None
 
         # to track random motion positions
         self.log = [[], [0], []]  # angle, frame num, position
@@ -1245,6 +3408,9 @@ class MovingStim(StaticStim):
         """
         self.start_stim = int(self.delay + 0.99)
 
+        # all sweeps at once
+        self.gen_sweeps()
+
         # need to generate movement to get number of frames
         self.gen_pos()
 
@@ -1258,152 +3424,103 @@ class MovingStim(StaticStim):
         if self.trigger:
             for x in range(self.num_dirs):
                 trigger_frame = self.num_frames * x + self.start_stim
-                if trigger_frame not in MyWindow.frame_trigger_list:
-                    MyWindow.frame_trigger_list.add(trigger_frame)
+                self.add_trigger(trigger_frame)
 
         if self.force_stop != 0:
             self.end_stim = self.force_stop
             self.end_delay = 0
 
+        self.color_schedule = self.gen_color_schedule()
+
         return self.end_stim + self.end_delay
 
-    def animate(self, frame):
-        """Method for animating moving stims. Moves stims appropriately,
-        then makes call to animate of super.
+    def compile(self, num_frames):
+        """Slices positions of the sweeps into the render plan, repeating
+        them if drawn for longer (i.e. force_stop), and orients the stim at
+        the start of each sweep. Extends super method.
 
-        :param int frame: current frame number
+        :param int num_frames: number of frames of the run
         """
-        # check if within animation range
-        if self.start_stim <= frame < self.end_stim:
-            # if next coordinate is calculated, moves stim, otherwise calls
-            # gen_movement() and retries
-            try:
-                x, y = self.get_next_pos()
-                self.set_pos(x, y)
-
-                super(MovingStim, self).animate(frame)
+        super(MovingStim, self).compile(num_frames)
 
-                # to raise errors to stop recursion
-                self.error_count = 0
+        drawn = numpy.flatnonzero(self.plan.draw)
+        positions = self.sweeps.reshape(-1, 2)
 
-            except (AttributeError, IndexError, TypeError):
-                self.error_count += 1
-                if self.error_count == 2:
-                    raise
+        self.plan.pos = numpy.zeros((num_frames, 2))
+        self.plan.pos[drawn] = positions[numpy.arange(len(drawn)) %
+                                         len(positions)]
 
-                # make new coordinate array
-                # TODO: don't generate on the fly
-                self.gen_pos()
+        # first frame of each sweep, and which sweep it is
+        starts = numpy.arange(0, len(drawn), self.num_frames)
+        sweeps = numpy.arange(len(starts)) % self.num_dirs
 
-                # log frame number for RandomlyMovingStim
-                self.log[1].append(frame)
+        if self.ori_with_dir:
+            self.plan.ori = numpy.full(num_frames, numpy.nan)
+            self.plan.ori[drawn[starts]] = self.sweep_dirs[sweeps] + \
+                self.orientation
+
+        # log travel direction, starting frame and the position the stim was
+        # at when each sweep started
+        self.log[0] = ((self.sweep_dirs[sweeps] + 180) % 360).tolist()
+        self.log[1] = [0] + drawn[starts[1:]].tolist()
+        self.log[2] = [numpy.array(self.get_pos())] + \
+            list(self.plan.pos[drawn[starts[1:] - 1]])
+
+    def gen_sweeps(self):
+        """Generates positions of every sweep direction as one array, with
+        move_delay frames off screen after each sweep.
+        """
+        off_pos = self.gen_off_pos() if self.move_delay > 0 else (0, 0)
 
-                # retry
-                self.animate(frame)
+        self.sweeps, self.sweep_dirs = trajectory.radial_sweeps(
+            self.start_dir, self.num_dirs, self.start_radius, self.speed,
+            self.move_delay, off_pos)
 
     def gen_pos(self):
+        """Takes the first sweep from gen_sweeps() as the array of position
+        coordinates, for the number of frames per sweep.
         """
-        Makes calls to gen_start_pos() and gen_pos_array() with proper
-        variables to get new array of position coordinates.
-        """
-        # update current position trackers
-        self.current_x, self.current_y = self.gen_start_pos(self.start_dir)
+        sweep = self.sweeps[0]
 
-        # reset frame counter
-        self.frame_counter = 0
-
-        # set movement direction (opposite of origin direction)
-        angle = self.start_dir + 180
-        if angle >= 360:
-            angle -= 360
+        # update current position trackers
+        self.current_x, self.current_y = sweep[0]
 
         # orient shape if not an image and fill is uniform
         if self.ori_with_dir:
-            self.stim.ori = self.start_dir + self.orientation
+            self.stim.ori = self.sweep_dirs[0] + self.orientation
 
-        # set start_dir for next call of gen_pos()
-        self.start_dir += 360 / self.num_dirs
+        self.num_frames = len(sweep)
+        self.x_array = sweep[:, 0]
+        self.y_array = sweep[:, 1]
 
-        # start_dir cannot be more than 360
-        if self.start_dir >= 360:
-            self.start_dir -= 360
+    def gen_off_pos(self):
+        """Position to place stim during move delays, just off screen.
 
-        # add to log
-        self.log[0].append(angle)
-        self.log[2].append(self.get_pos())
-
-        # calculate variables
-        travel_distance = ((self.current_x**2 + self.current_y**2) ** 0.5) * 2
-        self.num_frames = int(travel_distance / self.speed + 0.99)  # round up
-
-        # generate position array
-        self.x_array, self.y_array = self.gen_pos_array(self.current_x,
-                                                        self.current_y,
-                                                        self.num_frames,
-                                                        angle)
-
-        # add in move delay by placing stim off screen
-        if self.move_delay > 0:
-            if len(self.stim.size) > 1:
-                max_size = max(self.stim.size)
-            else:
-                max_size = self.stim.size
-
-            off_x = (GlobalDefaults['display_size'][0] + max_size) / 2
-            off_y = (GlobalDefaults['display_size'][1] + max_size) / 2
-
-            for i in range(self.move_delay):
-                self.x_array = scipy.append(self.x_array, off_x)
-                self.y_array = scipy.append(self.y_array, off_y)
-
-            self.num_frames += self.move_delay
-
-    def gen_start_pos(self, direction):
-        """Calculates starting position in x, y coordinates on the starting
-        radius based on travel direction.
-
-        :param direction: starting position on border of frame based on travel
-        :return: starting position on border of frame based on travel angle
-         origin
+        :return: x, y coordinate as tuple
         """
-        start_x = self.start_radius * scipy.sin(direction * scipy.pi / 180)
-        start_y = self.start_radius * scipy.cos(direction * scipy.pi / 180)
+        if len(self.stim.size) > 1:
+            max_size = max(self.stim.size)
+        else:
+            max_size = self.stim.size
 
-        return start_x, start_y
+        off_x = (GlobalDefaults['display_size'][0] + max_size) / 2
+        off_y = (GlobalDefaults['display_size'][1] + max_size) / 2
+
+        return off_x, off_y
 
     def gen_pos_array(self, start_x, start_y, num_frames, angle):
         """Creates 2 arrays for x, y coordinates of stims for each frame.
 
-        Adapted from code By David L. Morton, used under MIT License. Source:
-        https://code.google.com/p/computational-neuroscience/source/browse/trunk/projects/electrophysiology/stimuli/randomly_moving_checkerboard_search.py/#40
-
         :param start_x: starting x coordinate
         :param start_y: starting y coordinate
         :param num_frames: number of frames stim will travel for
         :param angle: travel direction
         :return: the x, y coordinates of the stim for every frame as 2 arrays
         """
-        dx = self.speed * scipy.sin(angle * scipy.pi / 180.0)
-        dy = self.speed * scipy.cos(angle * scipy.pi / 180.0)
-
-        x = scipy.array([start_x + i * dx for i in range(num_frames)])
-        y = scipy.array([start_y + i * dy for i in range(num_frames)])
-
-        return x, y
-
-    def get_next_pos(self):
-        """Returns the next coordinate from x, y_array for animate to set the
-        position of the stim for the next frame.
-
-        :return: x, y coordinate as tuple
-        """
-        x = self.x_array[self.frame_counter]
-        y = self.y_array[self.frame_counter]
-
-        # increment frame counter for next frame
-        self.frame_counter += 1
+        positions = trajectory.line((start_x, start_y), self.speed, angle,
+                                    num_frames)
 
-        return x, y
+        return positions[:, 0], positions[:, 1]
 
     def set_pos(self, x, y):
         """Position setter. Necessary for alternate position setting in subclasses.
@@ -1436,45 +3553,68 @@ class RandomlyMovingStim(MovingStim):
         delay and duration times.
 
         :return: last frame number as int
-        """
-        self.gen_pos()
-
+        """
         self.end_stim = super(MovingStim, self).draw_times() - self.end_delay
 
+        # need draw range to generate whole walk
+        self.gen_pos()
+
         if self.trigger:
             for x in range(int(self.duration / self.num_frames + 0.99)):
                 trigger_frame = self.num_frames * x + self.start_stim
-                if trigger_frame not in MyWindow.frame_trigger_list:
-                    MyWindow.frame_trigger_list.add(trigger_frame)
+                self.add_trigger(trigger_frame)
 
         return self.end_stim + self.end_delay
 
+    def compile(self, num_frames):
+        """Walk is already generated for every drawn frame, so positions are
+        sliced in. Overrides super method.
+
+        :param int num_frames: number of frames of the run
+        """
+        super(MovingStim, self).compile(num_frames)
+
+        drawn = numpy.flatnonzero(self.plan.draw)
+
+        self.plan.pos = numpy.zeros((num_frames, 2))
+        self.plan.pos[drawn, 0] = self.x_array[:len(drawn)]
+        self.plan.pos[drawn, 1] = self.y_array[:len(drawn)]
+
     def gen_pos(self):
-        """Makes calls to gen_start_pos` and
-        gen_pos_array with proper variables to get new array of
-        position coordinates. Overrides super.
+        """Generates the entire random walk over the draw duration as arrays
+        of position coordinates, one segment of travel_distance per random
+        angle. Angles, starting frames and starting positions of segments are
+        logged. Overrides super.
         """
         # update current position
         self.current_x, self.current_y = self.get_pos()
 
-        # reset frame count
-        self.frame_counter = 0
+        # frames per segment, round up
+        self.num_frames = int(self.travel_distance / self.speed + 0.99)
 
-        # random angle between 0 and 360
-        angle = self.move_random.randint(0, 360)
+        num_segments = int(ceil((self.end_stim - self.start_stim) /
+                                float(self.num_frames)))
+        num_segments = max(num_segments, 1)
 
-        # add to log
-        self.log[0].append(angle)
-        self.log[2].append(self.get_pos())
+        # random angles between 0 and 360
+        angles = [self.move_random.randint(0, 360)
+                  for i in range(num_segments)]
 
-        # calculate variables, round up
-        self.num_frames = int(self.travel_distance / self.speed + 0.99)
+        # each segment starts where the last one ended
+        positions = trajectory.path((self.current_x, self.current_y),
+                                    [self.speed] * num_segments, angles,
+                                    [self.num_frames] * num_segments)
+
+        self.x_array = positions[:, 0]
+        self.y_array = positions[:, 1]
+
+        # log
+        starts = numpy.arange(1, num_segments) * self.num_frames
 
-        # generate position array
-        self.x_array, self.y_array = self.gen_pos_array(self.current_x,
-                                                        self.current_y,
-                                                        self.num_frames,
-                                                        angle)
+        self.log[0] = angles
+        self.log[1] = [0] + (starts + self.start_stim).tolist()
+        self.log[2] = [numpy.array(self.get_pos())] + \
+            list(positions[starts - 1])
 
 
 class TableStim(MovingStim):
@@ -1492,6 +3632,12 @@ class TableStim(MovingStim):
     is coordinates and 'wave1' is whether or not to trigger (if polar),
     or as 'wave0', 'wave1', 'wave2' (if xy).
 
+    Very long polar and coordinate tables can be saved as a numpy .npy
+    file, with one row per frame and the same columns as text tables (see
+    convert_table()). These are memory mapped, and read a window of frames
+    at a time by a frame bank ahead of the display, instead of being loaded
+    whole.
+
     There are 3 table types: polar, coordinate, or direction. Their formats
     are as follows.
 
@@ -1506,12 +3652,17 @@ class TableStim(MovingStim):
     Optionally, direction can be replaced with '$' (dollar sign), and the
     direction will default to the global default (can also do use '-$').
     """
+    #: Parsed tables, keyed by path, modification time and table type.
+    tables = {}
+
     def __init__(self, **kwargs):
         """Passes parameters up to super."""
         super(TableStim, self).__init__(**kwargs)
 
         # instance attributes
         self.trigger_frames = None
+        self.mapped_pos = None
+        self.table_bank = None
 
     def draw_times(self):
         """Determines during which frames stim should be drawn, based on desired
@@ -1536,194 +3687,378 @@ class TableStim(MovingStim):
                 for j in range(self.num_dirs):
                     for i in self.trigger_frames:
                         trigger_frame = i + j * self.num_frames
-                        if trigger_frame not in MyWindow.frame_trigger_list:
-                            MyWindow.frame_trigger_list.add(trigger_frame)
+                        self.add_trigger(trigger_frame)
 
         if self.force_stop != 0:
             self.end_stim = self.force_stop
 
+        # memory mapped tables calculate colors per frame, see compile()
+        if self.mapped_pos is None:
+            self.color_schedule = self.gen_color_schedule()
+
         return self.end_stim
 
-    def gen_pos(self):
-        """Overrides super method. Calls gen_pos_array() and resets frame
-        counter.
+    def compile(self, num_frames):
+        """Memory mapped tables are read while animating, so the plan is
+        made of LazyFrames, calculated on each frame, and positions index
+        into the table, instead of being compiled. Extends super method.
+
+        :param int num_frames: number of frames of the run
         """
-        self.frame_counter = 0
-        self.x_array, self.y_array = self.gen_pos_array()
+        if self.mapped_pos is None:
+            return super(TableStim, self).compile(num_frames)
+
+        super(MovingStim, self).compile(num_frames)
+
+        self.plan.pos = self.mapped_pos
 
-        # orient shape if not an image and fill is uniform
         if self.ori_with_dir:
-            self.stim.ori = self.start_dir + self.orientation
+            self.plan.ori = LazyFrames(self.gen_mapped_ori, num_frames)
 
-        # add in move delay by placing stim off screen
-        if len(self.stim.size) > 1:
-            max_size = max(self.stim.size)
-        else:
-            max_size = self.stim.size
+        self.table_bank = FrameBank(self.mapped_pos.windows(), size=2)
+        self.mapped_pos.prefetch(self.table_bank)
 
-        off_x = (GlobalDefaults['display_size'][0] + max_size) / 2
-        off_y = (GlobalDefaults['display_size'][1] + max_size) / 2
+    def reset(self):
+        """Restarts reading memory mapped tables ahead from the first
+        window. Extends super method.
+        """
+        super(TableStim, self).reset()
 
-        for i in range(self.move_delay):
-            self.x_array = scipy.append(self.x_array, off_x)
-            self.y_array = scipy.append(self.y_array, off_y)
+        if self.table_bank is not None:
+            self.table_bank.stop()
+            self.table_bank = FrameBank(self.mapped_pos.windows(), size=2)
+            self.mapped_pos.prefetch(self.table_bank)
 
-        self.num_frames += self.move_delay
+    def close(self):
+        """Stops reading memory mapped tables ahead. Extends super method.
+        """
+        super(TableStim, self).close()
+
+        if self.table_bank is not None:
+            self.table_bank.stop()
+            self.table_bank = None
+            self.mapped_pos.prefetch(None)
+
+    def compile_frames(self, func, drawn=False):
+        """Plans of memory mapped tables calculate state on each frame.
+        Extends super method.
 
-        # set start_dir for next call of gen_pos()
-        self.start_dir += 360 / self.num_dirs
+        :param func: function of an array of frame numbers, returning an
+         array of their state
+        :param bool drawn: whether state is only needed on drawn frames
+        :return: LazyFrames if table is memory mapped, else array
+        """
+        if self.mapped_pos is None:
+            return super(TableStim, self).compile_frames(func, drawn)
+
+        return LazyFrames(func, self.plan.num_frames)
+
+    def gen_mapped_ori(self, frames):
+        """Orientation of memory mapped tables on the first frame of each
+        sweep.
+
+        :param frames: array of frame numbers
+        :return: array of orientations, NaN on other frames
+        """
+        sweeps, i = numpy.divmod(frames - self.mapped_pos.first_frame,
+                                 self.num_frames)
+        ori = (self.start_dir + sweeps * 360. / self.num_dirs) % 360 + \
+            self.orientation
+
+        return numpy.where((i == 0) & (sweeps >= 0), ori, numpy.nan)
+
+    def gen_pos(self):
+        """Overrides super method. Generates positions of every direction as
+        one array of sweeps with gen_pos_array(), with move_delay frames off
+        screen after each sweep.
+        """
+        if os.path.splitext(self.table_filename or '')[1] == '.npy':
+            return self.gen_mapped_pos()
+
+        self.sweep_dirs = self.start_dir + \
+            numpy.arange(self.num_dirs) * 360. / self.num_dirs
+        self.sweep_dirs[1:] %= 360
+
+        # add in move delay by placing stim off screen
+        off_pos = self.gen_off_pos() if self.move_delay > 0 else (0, 0)
+        off = numpy.tile(off_pos, (self.move_delay, 1))
+
+        # only polar tables are rotated with direction
+        sweeps = []
+        for direction in self.sweep_dirs:
+            if not sweeps or self.table_type == 'polar':
+                x, y = self.gen_pos_array(direction)
+                sweep = numpy.concatenate([numpy.column_stack([x, y]), off])
+            sweeps.append(sweep)
+
+        self.sweeps = numpy.array(sweeps)
+        self.x_array, self.y_array = self.sweeps[0].T
+
+        # orient shape if not an image and fill is uniform
+        if self.ori_with_dir:
+            self.stim.ori = self.sweep_dirs[0] + self.orientation
 
-        # start_dir cannot be more than 360
-        if self.start_dir >= 360:
-            self.start_dir -= 360
+        self.num_frames += self.move_delay
 
-    def gen_pos_array(self, *args):
+    def gen_pos_array(self, start_dir=None):
         """Creates 2 arrays for x, y coordinates of stims for each frame.
 
+        :param start_dir: direction to rotate polar tables to, defaults to
+         start_dir of stim
         :return: the x, y coordinates of the stim for every frame as 2 arrays
         :raises: ImportError: if attempts to load from an Igor file without
          having the igor module.
         :raises: IOError: raised if file contents not properly formatted.
         """
-        table = self.table_filename
         radii = None
-        x = None
 
+        columns = self.load_table(self.table_filename, self.table_type)
+
+        if self.table_type == 'polar':
+            radii, trigger_list = columns
+        elif self.table_type == 'coordinate':
+            x, y, trigger_list = columns
+        else:
+            x, y, trigger_list = self.gen_directions(*columns)
+
+        if trigger_list is not None:
+            trigger_list = numpy.array(trigger_list, dtype=int)
+            trigger_list[0] = 1   # trigger on first frame
+            trigger_list[-1] = 1  # trigger on last frame
+            self.trigger_frames = numpy.flatnonzero(trigger_list == 1).tolist()
+
+        # binary waves only trigger on first frame
+        else:
+            self.trigger_frames = [0]
+
+        # convert pix to micrometers
+        if radii is not None:
+            radii = numpy.asarray(radii, dtype=float) * \
+                GlobalDefaults['pix_per_micron']
+        else:
+            x = numpy.asarray(x, dtype=float) * GlobalDefaults['pix_per_micron']
+            y = numpy.asarray(y, dtype=float) * GlobalDefaults['pix_per_micron']
+
+        self.num_frames = len(radii) if radii is not None else len(x)
+
+        # make arrays if polar
+        if self.table_type == 'polar':
+            if start_dir is None:
+                start_dir = self.start_dir
+            theta = start_dir * -1 - 90  # origins are different in cart
+            x, y = pol2cart(theta, radii)
+
+        return x, y
+
+    def gen_mapped_pos(self):
+        """Sets up positions of every direction for a memory mapped table,
+        without reading the table into memory. Trigger frames are found a
+        window of frames at a time.
+        """
+        columns = self.load_table(self.table_filename, self.table_type)
+        table_frames = len(columns[0])
+        window = 2**16
+
+        # trigger on first and last frame
+        trigger_frames = {0, table_frames - 1}
+
+        for start in range(0, table_frames, window):
+            triggers = numpy.asarray(columns[-1][start:start + window])
+            trigger_frames.update(
+                (numpy.flatnonzero(triggers == 1) + start).tolist())
+
+        self.trigger_frames = sorted(trigger_frames)
+
+        # origins are different in cart
+        thetas = None
+        if self.table_type == 'polar':
+            thetas = [(self.start_dir + i * 360. / self.num_dirs) * -1 - 90
+                      for i in range(self.num_dirs)]
+
+        if self.move_delay > 0:
+            off_pos = self.gen_off_pos()
+        else:
+            off_pos = (0, 0)
+
+        self.mapped_pos = trajectory.MappedTrajectory(
+            columns[:-1], first_frame=int(ceil(self.start_stim)),
+            num_dirs=self.num_dirs, thetas=thetas,
+            scale=GlobalDefaults['pix_per_micron'],
+            move_delay=self.move_delay, off_pos=off_pos)
+
+        self.num_frames = self.mapped_pos.sweep_frames
+
+    def gen_directions(self, speeds, dirs, durations):
+        """Converts columns of a directions table into positions, where each
+        direction continues from the end of the last.
+
+        :param speeds: movement speeds (pix/sec)
+        :param dirs: directions in degrees, as strings, or '$' or '-$' for the
+         global preferred direction
+        :param durations: durations (ms)
+        :return: x positions, y positions, and triggers (start of each
+         direction) as 3 arrays
+        """
+        # '$' travels towards, and '-$' away from preferred direction
+        if GlobalDefaults['pref_dir'] != -1:
+            pref_dirs = {'$': GlobalDefaults['pref_dir'] + 180,
+                         '-$': GlobalDefaults['pref_dir']}
+        else:
+            pref_dirs = {'$': 0, '-$': 0}
+
+        angles = numpy.zeros(len(dirs))
+        is_pref = numpy.isin(dirs, list(pref_dirs))
+
+        try:
+            angles[~is_pref] = dirs[~is_pref].astype(float)
+        except ValueError:
+            raise IOError('File contents not a supported format. See docs for '
+                          'reference. Selected file: {}.'.
+                          format(self.table_filename))
+
+        for symbol, pref_dir in pref_dirs.items():
+            angles[dirs == symbol] = pref_dir
+
+        # convert ms to frames, and pix/sec to pix/frame
+        frames = (GlobalDefaults['frame_rate'] * durations / 1000. +
+                  0.99).astype(int)
+        speeds = speeds / float(GlobalDefaults['frame_rate'])
+
+        positions = trajectory.path(self.location, speeds, angles, frames)
+
+        trigger_list = numpy.zeros(len(positions), dtype=int)
+        firsts = numpy.cumsum(frames) - frames
+        trigger_list[firsts[frames > 0]] = 1
+
+        return positions[:, 0], positions[:, 1], trigger_list
+
+    @staticmethod
+    def load_table(table, table_type):
+        """Parses a table file into arrays of its columns, in file units.
+        Each file is only parsed once, and kept until it is modified.
+
+        :param table: path to table file
+        :param table_type: 'polar', 'coordinate', or 'directions'
+        :return: tuple of read only column arrays; radii and triggers if
+         polar, x, y and triggers if coordinate, or speeds, directions (as
+         strings) and durations if directions. Triggers are None for binary
+         wave files.
+        :raises: ImportError: if attempts to load from an Igor file without
+         having the igor module.
+        :raises: IOError: raised if file contents not properly formatted.
+        """
         if table is None:
             raise IOError('No table file selected')
 
         if not os.path.exists(table):
             raise IOError('No such table file: {}'.format(table))
 
+        key = (os.path.abspath(table), os.path.getmtime(table), table_type)
+
+        if key in TableStim.tables:
+            return TableStim.tables[key]
+
+        error = IOError('File contents not a supported format. See docs for '
+                        'reference. Selected file: {}.'.format(table))
+
+        num_columns = 2 if table_type == 'polar' else 3
+        ext = os.path.splitext(table)[1]
+
         # if text file
-        if os.path.splitext(table)[1] == '.txt':
-            with open(table, 'r') as f:
-                lines = [line.strip() for line in f]
-
-            if self.table_type == 'polar':
-                radii = [i.split()[0] for i in lines]
-                trigger_list = [i.split()[1] for i in lines]
-
-            elif self.table_type == 'coordinate':
-                x = [i.split()[0] for i in lines]
-                y = [i.split()[1] for i in lines]
-                try:
-                    trigger_list = [i.split()[2] for i in lines]
-                except IndexError:
-                    raise IOError('File contents not a supported format. See '
-                                  'docs for reference. Selected file: {}.'.
-                                  format(self.table_filename))
-
-            elif self.table_type == 'directions':
-
-                x = numpy.array([])
-                y = numpy.array([])
-                trigger_list = []
-
-                for line in lines:
-                    if len(x) == 0:
-                        start_x = self.location[0]
-                        start_y = self.location[1]
-                    else:
-                        start_x = x[-1]
-                        start_y = y[-1]
-
-                    speed = float(line.split()[0])
-                    dur = float(line.split()[2]) / 1000  # convert ms to sec
-                    try:
-                        dir = float(line.split()[1])
-                    except ValueError:
-                        if line.split()[1] == '$':
-                            if GlobalDefaults['pref_dir'] != -1:
-                                dir = GlobalDefaults['pref_dir'] + 180
-                            elif GlobalDefaults['pref_dir'] == -1:
-                                dir = 0
-                        elif line.split()[1] == '-$':
-                            if GlobalDefaults['pref_dir'] != -1:
-                                dir = GlobalDefaults['pref_dir']
-                            elif GlobalDefaults['pref_dir'] == -1:
-                                dir = 0
-
-                    num_frames = int(GlobalDefaults['frame_rate'] * dur + 0.99)
-                    trigger_list.append(1)
-                    trigger_list.extend([0] * (num_frames - 1))
-                    self.speed = speed * (1.0 / GlobalDefaults['frame_rate'])
-
-                    x_to_app, y_to_app = super(TableStim,
-                                               self).gen_pos_array(start_x,
-                                                                   start_y,
-                                                                   num_frames,
-                                                                   dir)
-
-                    x = numpy.append(x, x_to_app)
-                    y = numpy.append(y, y_to_app)
+        if ext == '.txt':
+            # directions may have '$' instead of a number
+            dtype = str if table_type == 'directions' else float
 
-            trigger_list[0] = 1   # trigger on first frame
-            trigger_list[-1] = 1  # trigger on last frame
+            try:
+                data = numpy.loadtxt(table, dtype=dtype, ndmin=2)
+            except ValueError:
+                raise error
+
+            if data.shape[1] < num_columns:
+                raise error
+
+            columns = list(data[:, :num_columns].T)
+
+            if table_type == 'directions':
+                columns[0] = columns[0].astype(float)
+                columns[2] = columns[2].astype(float)
 
         # if igor binary wave format or packed experiment format
-        elif os.path.splitext(table)[1] in ['.ibw', '.pxp']:
-            if has_igor:
-                if os.path.splitext(table)[1] == '.ibw':
-                    if self.table_type == 'polar':
-                        radii = binarywave.load(table)['wave']['wData']
-                    else:
-                        raise IOError('.ibw format does not support '
-                                      'coordinate table type')
-
-                elif os.path.splitext(table)[1] == '.pxp':
-                    if self.table_type == 'polar':
-                        radii = packed.load(table)[1]['root']['wave0'].wave[
-                            'wave']['wData']
-                        trigger_list = packed.load(table)[1]['root'][
-                            'wave1'].wave['wave']['wData']
-
-                    if self.table_type == 'coordinate':
-                        x = packed.load(table)[1]['root']['wave0'].wave[
-                            'wave']['wData']
-                        y = packed.load(table)[1]['root']['wave1'].wave[
-                            'wave']['wData']
-                        trigger_list = packed.load(table)[1]['root'][
-                            'wave2'].wave['wave']['wData']
-
-                    trigger_list[0] = 1   # trigger on first frame
-                    trigger_list[-1] = 1  # trigger on last frame
-
-            elif not has_igor:
+        elif ext in ['.ibw', '.pxp']:
+            if not has_igor:
                 raise ImportError('Need igor python module to load \'.ibw\' '
                                   'or \'.pxp\' formats. Install module with '
                                   '\'pip install igor\'.')
 
-        # convert strings to floats, and convert to pix to micrometers
-        if radii is not None:
-            radii = map(float, radii)
-            radii = [r * GlobalDefaults['pix_per_micron'] for r in radii]
-        elif x is not None:
-            x = map(float, x)
-            y = map(float, y)
-            x = [i * GlobalDefaults['pix_per_micron'] for i in x]
-            y = [i * GlobalDefaults['pix_per_micron'] for i in y]
+            if table_type == 'directions':
+                raise error
+
+            if ext == '.ibw':
+                if table_type != 'polar':
+                    raise IOError('.ibw format does not support '
+                                  'coordinate table type')
+
+                columns = [binarywave.load(table)['wave']['wData'], None]
+
+            else:
+                root = packed.load(table)[1]['root']
+                columns = [root['wave{}'.format(i)].wave['wave']['wData']
+                           for i in range(num_columns)]
+
+        # memory mapped, rows are only read when indexed
+        elif ext == '.npy':
+            try:
+                data = numpy.load(table, mmap_mode='r')
+            except ValueError:
+                raise error
+
+            if table_type == 'directions' or data.ndim != 2 or \
+                    data.shape[1] < num_columns:
+                raise error
+
+            columns = [data[:, i] for i in range(num_columns)]
+
         else:
-            raise IOError('File contents not a supported format. See docs for '
-                          'reference. Selected file: {}.'.
-                          format(self.table_filename))
+            raise error
 
-        if trigger_list is not None:
-            trigger_list = map(int, trigger_list)
-            self.trigger_frames = []
+        for column in columns:
+            if column is not None:
+                column.setflags(write=False)
 
-            for i in range(len(trigger_list)):
-                if trigger_list[i] == 1:
-                    self.trigger_frames.append(i)
+        TableStim.tables[key] = tuple(columns)
 
-        self.num_frames = len(radii) if radii is not None else len(x)
+        return TableStim.tables[key]
 
-        # make arrays if polar
-        if self.table_type == 'polar':
-            theta = self.start_dir * -1 - 90  # origins are different in cart
-            x, y = map(list, zip(*[pol2cart(theta, r) for r in radii]))
+    @staticmethod
+    def convert_table(table, table_type, filename=None):
+        """Converts a text or Igor table to a .npy table, which is memory
+        mapped when animating. Columns are radius and trigger if polar, or x,
+        y and trigger if coordinate. Directions tables depend on frame rate
+        and preferred direction, so can't be converted.
+
+        :param table: path to table file
+        :param table_type: 'polar' or 'coordinate'
+        :param filename: path to save to, defaults to table path with .npy
+         extension
+        :return: path to converted table
+        :raises: IOError: raised if table can't be converted.
+        """
+        if table_type == 'directions':
+            raise IOError('Directions tables can\'t be converted.')
 
-        return x, y
+        columns = list(TableStim.load_table(table, table_type))
+
+        # binary waves only trigger on first frame
+        if columns[-1] is None:
+            columns[-1] = numpy.zeros(len(columns[0]))
+            columns[-1][0] = 1
+
+        if filename is None:
+            filename = os.path.splitext(table)[0] + '.npy'
+
+        numpy.save(filename, numpy.column_stack(columns).astype(numpy.float64))
+
+        return filename
 
 
 class ImageJumpStim(StaticStim):
@@ -1736,53 +4071,70 @@ class ImageJumpStim(StaticStim):
         super(ImageJumpStim, self).__init__(**kwargs)
 
         self.orig_tex = None
+        self.iml = None
         self.slice_index = 0
         self.slice_list = []
         self.slice_log = []
         self.jumpstim_list = []
+        self.first_stim = None
 
     def gen_texture(self):
         """
         Keeps copy of og texture
         :return:
         """
-        mock_jump = StaticStim(image_filename=self.image_filename,
-                               image_channel=['red', 'green', 'blue', 'all'][
-                                   self.image_channel],
-                               image_size=self.image_size,
-                               fill_mode='image',
-                               shape=self.shape)
+        # .iml already at drawn size are cropped from the file directly
+        if os.path.splitext(str(self.image_filename))[1] == '.iml':
+            iml = IMLImage(self.image_filename, rotated=True)
+
+            if iml.shape[::-1] == tuple(self.image_size):
+                self.iml = iml
 
-        tex = mock_jump.gen_texture()
+        if self.iml is None:
+            mock_jump = StaticStim(image_filename=self.image_filename,
+                                   image_channel=['red', 'green', 'blue',
+                                                  'all'][self.image_channel],
+                                   image_size=self.image_size,
+                                   fill_mode='image',
+                                   shape=self.shape)
 
-        MyWindow.close_win()
-        cap_win = visual.Window(units='pix', size=self.image_size)
+            tex = mock_jump.gen_texture()
 
-        mock_stim = visual.GratingStim(win=cap_win,
-                                       size=self.image_size,
-                                       mask=None,
-                                       tex=tex,
-                                       autoLog=False)
-        mock_stim.draw()
-        tex = cap_win._getRegionOfFrame(buffer='back')
-        cap_win.close()
-        MyWindow.make_win()
-        cap = numpy.asarray(tex.transpose(Image.FLIP_TOP_BOTTOM))
-        cap = uint8_float(cap)
+            # rasterize at image size, off screen
+            target = MyWindow.offscreen(self.image_size)
 
-        self.orig_tex = cap
+            with target:
+                mock_stim = visual.GratingStim(win=MyWindow.win,
+                                               size=self.image_size,
+                                               mask=None,
+                                               tex=tex,
+                                               autoLog=False)
+                mock_stim.draw()
+                cap = target.read()
+
+            target.close()
+
+            self.orig_tex = uint8_float(cap)
+            tex = self.orig_tex
 
         self.gen_slice_list()
 
+        if self.iml is not None:
+            tex = self.slice_list[0]
+
         # Pushing textures is slow, but preloading textures is memory
         # expensive. Generating shuffled textures is too slow, so preload
         # those, but do other slices on the fly.
 
-        numpy.random.seed(self.move_seed)
         # clock = core.Clock()
 
         if self.shuffle:
+            target = MyWindow.offscreen(self.gen_size())
+
             for i, slice in enumerate(tqdm(self.slice_list)):
+                # each jump has its own stream, so any can be remade alone
+                generator = stim_noise.stream(self.move_seed, self.number, i)
+
                 temp_stim = visual.GratingStim(win=MyWindow.win,
                                                size=self.gen_size(),
                                                mask=self.gen_mask(),
@@ -1793,26 +4145,39 @@ class ImageJumpStim(StaticStim):
                                                autoLog=False,
                                                texRes=2**10)
 
-                # want to shuffle scaled tex, so draw to back and pull, then
-                # shuffle that
-                temp_stim.draw()
-                image = MyWindow.win._getRegionOfFrame(buffer='back')
-                MyWindow.win.clearBuffer()
-                cap = numpy.asarray(image) / 255.0 * 2 - 1
+                # want to shuffle scaled tex, so draw off screen and pull,
+                # then shuffle that
+                with target:
+                    temp_stim.draw()
+                    cap = uint8_float(target.read())
 
                 if self.image_channel != 3:
-                    numpy.random.shuffle(cap.reshape(-1, cap.shape[-1])
-                                         .T[self.image_channel])
+                    generator.shuffle(cap.reshape(-1, cap.shape[-1])
+                                      .T[self.image_channel])
                 else:
                     # TODO: faster randomizing
-                    numpy.random.shuffle(cap.reshape(-1, cap.shape[-1]))
+                    generator.shuffle(cap.reshape(-1, cap.shape[-1]))
 
                 # slice = cap
                 temp_stim.setTex(cap)
                 self.jumpstim_list.append(temp_stim)
 
+            target.close()
+
         return tex
 
+    def get_orig_tex(self):
+        """Gets whole image texture slices are cut from.
+
+        :return: texture as numpy array
+        """
+        if self.iml is not None:
+            return self.iml.texture(channel=self.image_channel,
+                                    alpha=self.alpha,
+                                    gamma=MyWindow.gamma_mon)
+
+        return self.orig_tex
+
     def gen_size(self):
         """
         Overrides sizing
@@ -1840,87 +4205,353 @@ class ImageJumpStim(StaticStim):
         if self.trigger:
             for i in range(self.num_jumps + 1):
                 trigger_frame = i * self.move_delay + self.delay
-                if trigger_frame not in MyWindow.frame_trigger_list:
-                    MyWindow.frame_trigger_list.add(trigger_frame)
+                self.add_trigger(trigger_frame)
+
+        if self.force_stop != 0:
+            self.end_stim = self.force_stop
+
+        # shuffled stims swap out self.stim while animating
+        self.first_stim = self.stim
+
+        return self.end_stim
+
+    def reset(self):
+        """Rewinds to first slice. Slices are kept, so jumps are the same
+        every rep. Extends super method.
+        """
+        super(ImageJumpStim, self).reset()
+
+        self.slice_index = 0
+        self.stim = self.first_stim
+
+    def compile(self, num_frames):
+        """Jumps are made while animating. Extends super method.
+
+        :param int num_frames: number of frames of the run
+        """
+        super(ImageJumpStim, self).compile(num_frames)
+        self.plan.update = self.gen_jump
+
+    def gen_jump(self, frame):
+        """Jumps to the next slice every move_delay frames.
+
+        :param int frame: current frame number
+        """
+        if frame % self.move_delay == 0:
+            if self.shuffle:
+                self.stim = self.jumpstim_list[self.slice_index]
+            else:
+                self.stim.setTex(self.slice_list[self.slice_index])
+
+                if self.small_stim is not None:
+                    self.small_stim.setTex(self.slice_list[
+                                           self.slice_index])
+
+            self.slice_index += 1
+
+    def gen_slice(self, *args):
+        """Slices the original texture and returns slice, i.e. a smaller
+        section of the original image that will be zoomed in.
+
+        :return: texture slice
+        """
+        if self.image_size[0] >= GlobalDefaults['display_size'][0] and \
+                self.image_size[1] >= GlobalDefaults['display_size'][1]:
+
+            x = int(GlobalDefaults['display_size'][0])
+            y = int(GlobalDefaults['display_size'][1])
+
+            if self.iml is not None:
+                rows, columns = self.iml.shape
+            else:
+                rows, columns = self.orig_tex.shape[:2]
+
+            # maximum coordinate of slice
+            max_x = columns - x
+            max_y = rows - y
+
+            x_low = self.move_random.randint(0, max_x)
+            y_low = self.move_random.randint(0, max_y)
+
+            x_high = int(x_low + x)
+            y_high = int(y_low + y)
+
+            self.slice_log.append([y_low, y_high, x_low, x_high])
+
+            # subsection of original image of window size
+            if self.iml is not None:
+                tex = self.iml.texture(slice(y_low, y_high),
+                                       slice(x_low, x_high),
+                                       channel=self.image_channel,
+                                       alpha=self.alpha,
+                                       gamma=MyWindow.gamma_mon)
+            else:
+                tex = self.orig_tex[y_low:y_high,
+                                    x_low:x_high]
+
+            return tex
+
+        else:
+            raise AssertionError('Image drawn size must be larger than window '
+                                 'size (can\'t jump around otherwise...).'
+                                 '\nImage size:  {} x {} pixels'
+                                 '\nwindow size: {} x {} pixels'.format(
+                                     self.image_size[0],
+                                     self.image_size[1],
+                                     GlobalDefaults['display_size'][0],
+                                     GlobalDefaults['display_size'][1]))
+
+    def gen_slice_list(self):
+        """
+        Generates slices for jumping around.
+        """
+        for i in trange(self.num_jumps):
+            self.slice_list.append(self.gen_slice())
+
+
+class ImageSequenceStim(StaticStim):
+    """Class to play a stack of images, showing the next image every
+    frame_repeat frames, e.g. natural scene stacks or precomputed noise.
+    Loops if the stim is longer than the stack.
+
+    Stacks are .npy files of images (images x rows x columns, with an
+    optional axis of 1, 3 or 4 channels), either unsigned ints scaled by the
+    maximum of their type (e.g. uint8 or uint16), or floats from -1 to 1, or
+    directories of image files of the same size, which are stacked into a
+    .npy in the cache_dir once. Stacks are memory mapped, and upcoming images
+    are converted and gamma corrected on the producer thread of a
+    :py:class:`FrameBank`, so each image is one upload to a single
+    :py:class:`TextureQuad` of image_size, at location. The first image is
+    uploaded before each rep, and the rest while animating. Images are
+    rotated 180 degrees, as in image stims.
+    """
+    #: Extensions of image files read from directories.
+    extensions = ['.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp']
+
+    def __init__(self, **kwargs):
+        # pass parameters up to super
+        super(ImageSequenceStim, self).__init__(**kwargs)
+
+        self.images = None
+        self.lut = None
+        self.frame_bank = None
+
+    def make_stim(self):
+        """Memory maps stack, and creates texture quad showing the first
+        image, so it is ready before the run.
+        """
+        self.images = self.load_images()
+        self.lut = MovieDecoder.gen_lut(MyWindow.gamma_mon)
+
+        self.stim = TextureQuad(MyWindow.win, self.gen_frame(0),
+                                size=self.image_size,
+                                pos=self.location)
+
+    def load_images(self):
+        """Memory maps stack, stacking directories of images first.
+
+        :return: array of images (images x rows x columns [x channels])
+        :raises IOError: if stack doesn't exist, or has the wrong shape or
+         type
+        """
+        if self.image_filename is None or \
+                not os.path.exists(self.image_filename):
+            raise IOError('Make sure image stack exists and location is '
+                          'correct')
+
+        if os.path.isdir(self.image_filename):
+            images = ImageSequenceStim.stack_images(self.image_filename)
+        else:
+            images = numpy.load(self.image_filename, mmap_mode='r')
+
+        if images.ndim not in [3, 4] or len(images) == 0 or \
+                (images.ndim == 4 and images.shape[3] not in [1, 3, 4]):
+            raise IOError('Image stack {} must be images x rows x columns '
+                          '[x channels].'.format(self.image_filename))
+
+        if images.dtype.kind not in 'uf':
+            raise IOError('Image stack {} must be unsigned ints or floats, '
+                          'not {}.'.format(self.image_filename, images.dtype))
+
+        return images
+
+    @staticmethod
+    def stack_images(directory):
+        """Stacks the image files of a directory, in order of filename, into
+        a uint8 rgb .npy in the cache_dir of the config file, keyed on the
+        contents of the files. Without a cache_dir, images are stacked in
+        memory.
+
+        :param directory: directory of images
+        :return: array of images (images x rows x columns x 3)
+        :raises IOError: if there are no images, or sizes differ
+        """
+        paths = [os.path.join(directory, f) for f in sorted(
+            os.listdir(directory)) if os.path.splitext(f)[1].lower() in
+            ImageSequenceStim.extensions]
+
+        if not paths:
+            raise IOError('No images in {}.'.format(directory))
+
+        def read(path):
+            return numpy.asarray(Image.open(path).convert('RGB'))
+
+        cache_dir = config.get('StimProgram', 'cache_dir', fallback=None)
+        if cache_dir is None:
+            try:
+                return numpy.stack([read(path) for path in paths])
+            except ValueError:
+                raise IOError('Images in {} must all be the same '
+                              'size.'.format(directory))
+
+        key = TextureCache.make_key(*[TextureCache.hash_file(path)
+                                      for path in paths])
+        path = os.path.join(cache_dir, 'stack_' + key + '.npy')
+
+        if not os.path.exists(path):
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+
+            first = read(paths[0])
+
+            # write then rename, so readers never see partial files
+            temp_path = '{}.{}.tmp'.format(path, os.getpid())
+            stack = numpy.lib.format.open_memmap(
+                temp_path, mode='w+', dtype=numpy.uint8,
+                shape=(len(paths),) + first.shape)
+
+            for i, image_path in enumerate(tqdm(paths)):
+                image = read(image_path)
+
+                if image.shape != first.shape:
+                    del stack
+                    os.remove(temp_path)
+                    raise IOError('Images in {} must all be the same '
+                                  'size.'.format(directory))
+
+                stack[i] = image
+
+            stack.flush()
+            del stack
+            os.replace(temp_path, path)
+
+        return numpy.load(path, mmap_mode='r')
+
+    def gen_frame(self, index):
+        """Converts an image of the stack to a gamma corrected uint8 rgb
+        frame, with channels other than image_channel dark.
+
+        :param int index: index of image, wraps around stack
+        :return: uint8 array (rows x columns x 3)
+        """
+        image = numpy.asarray(self.images[index % len(self.images)])
+
+        if image.dtype.kind == 'f':
+            image = float_uint8(numpy.clip(image, -1, 1))
+        elif image.dtype != numpy.uint8:
+            scale = 255. / numpy.iinfo(image.dtype).max
+            image = numpy.rint(image * scale).astype(numpy.uint8)
+
+        if image.ndim == 2:
+            image = image[:, :, numpy.newaxis]
+
+        # rotated as image stims, and without alpha
+        image = image[::-1, ::-1, :3]
+
+        frame = numpy.zeros(image.shape[:2] + (3,), dtype=numpy.uint8)
+
+        if self.image_channel != 3:
+            frame[:, :, self.image_channel] = \
+                image[:, :, min(self.image_channel, image.shape[2] - 1)]
+        else:
+            frame[:] = image
 
-        if self.force_stop != 0:
-            self.end_stim = self.force_stop
+        if self.lut is not None:
+            frame = self.lut[frame, numpy.arange(3)]
 
-        return self.end_stim
+        return frame
 
-    def animate(self, frame):
-        """Method for animating moving stims. Pulls pixels drawn,
-        then makes call to animate of super.
+    def gen_frame_bank(self):
+        """Starts a frame bank of the images shown on each
+        frame_repeat drawn frames, after the first image, which is already
+        uploaded. Buffer is limited to 256 MiB.
 
-        :param int frame: current frame number
+        :return: FrameBank instance
         """
-        # check if within animation range
-        # clock = core.Clock()
-        # clock.reset()
-        if self.start_stim <= frame < self.end_stim:
+        num_images = -(-int(numpy.count_nonzero(self.plan.draw)) //
+                       self.frame_repeat)
 
-            if frame % self.move_delay == 0:
-                if self.shuffle:
-                    self.stim = self.jumpstim_list[self.slice_index]
-                else:
-                    self.stim.setTex(self.slice_list[self.slice_index])
+        frames = (self.gen_frame(i) for i in range(1, num_images))
 
-                    if self.small_stim is not None:
-                        self.small_stim.setTex(self.slice_list[
-                                               self.slice_index])
+        frame_bytes = self.images.shape[1] * self.images.shape[2] * 3
+        size = max(2, min(64, 2**28 // frame_bytes))
 
-                self.slice_index += 1
+        return FrameBank(frames, size=size)
 
-            super(ImageJumpStim, self).animate(frame)
+    def reset(self):
+        """Uploads the first image again, and restarts frame bank from the
+        next. Extends super method.
+        """
+        super(ImageSequenceStim, self).reset()
 
-        # print clock.getTime() * 1000
+        if self.frame_bank is not None:
+            self.frame_bank.stop()
+            self.stim.update(self.gen_frame(0))
+            self.frame_bank = self.gen_frame_bank()
 
-    def gen_slice(self, *args):
-        """Slices the original texture and returns slice, i.e. a smaller
-        section of the original image that will be zoomed in.
+    def compile(self, num_frames):
+        """Images are shown as they are, so aren't changed by timing or
+        phase, and are taken from a frame bank while animating. Extends
+        super method.
 
-        :return: texture slice
+        :param int num_frames: number of frames of the run
         """
-        if self.image_size[0] >= GlobalDefaults['display_size'][0] and \
-                self.image_size[1] >= GlobalDefaults['display_size'][1]:
+        super(ImageSequenceStim, self).compile(num_frames)
 
-            x = int(GlobalDefaults['display_size'][0])
-            y = int(GlobalDefaults['display_size'][1])
+        self.plan.color = None
+        self.plan.phase = None
+        self.plan.update = self.gen_image
 
-            # maximum coordinate of slice
-            max_x = self.orig_tex.shape[1] - x
-            max_y = self.orig_tex.shape[0] - y
+        self.frame_bank = self.gen_frame_bank()
 
-            x_low = self.move_random.randint(0, max_x)
-            y_low = self.move_random.randint(0, max_y)
+    def close(self):
+        """Stops frame bank. Extends super method.
+        """
+        super(ImageSequenceStim, self).close()
 
-            x_high = int(x_low + x)
-            y_high = int(y_low + y)
+        if self.frame_bank is not None:
+            self.frame_bank.stop()
+            self.frame_bank = None
 
-            self.slice_log.append([y_low, y_high, x_low, x_high])
+    def gen_image(self, frame):
+        """Shows the next image on the first of every frame_repeat drawn
+        frames, except the first, which is already shown. Waits for the
+        frame bank on an underrun.
 
-            # subsection of original 1536x1024 image of window size
-            tex = self.orig_tex[y_low:y_high,
-                                x_low:x_high]
+        :param int frame: current frame number
+        """
+        if frame != self.start_stim and \
+                (frame - self.start_stim) % self.frame_repeat == 0:
+            data = self.frame_bank.get()
 
-            return tex
+            if data is not None:
+                self.stim.update(data, copy=False)
 
-        else:
-            raise AssertionError('Image drawn size must be larger than window '
-                                 'size (can\'t jump around otherwise...).'
-                                 '\nImage size:  {} x {} pixels'
-                                 '\nwindow size: {} x {} pixels'.format(
-                                     self.image_size[0],
-                                     self.image_size[1],
-                                     GlobalDefaults['display_size'][0],
-                                     GlobalDefaults['display_size'][1]))
 
-    def gen_slice_list(self):
-        """
-        Generates slices for jumping around.
-        """
-        for i in trange(self.num_jumps):
-            self.slice_list.append(self.gen_slice())
+def random_state(random):
+    """Makes a numpy generator with the same Mersenne Twister state as a
+    python Random instance, so that its draws match.
+
+    :param random: python Random instance
+    :return: numpy RandomState
+    """
+    internal = random.getstate()[1]
+
+    state = numpy.random.RandomState()
+    state.set_state(('MT19937', numpy.array(internal[:-1], dtype=numpy.uint32),
+                     internal[-1]))
+
+    return state
 
 
 # function because inheritance is conditional
@@ -1942,19 +4573,22 @@ def board_texture_class(bases, **kwargs):
             # instance attributes
             self.index = None
             self.colors = None
+            self.frame_bank = None
+            self.sparse_checks = None
+            self.recorder = None
+            self.backend = None
+            self.offset = None
 
         def make_stim(self):
             """Creates instance of psychopy stim object.
             """
-            # array of coordinates for each element
-            xys = []
-            # populate xys
-            low, high = self.num_check // -2, self.num_check // 2
+            self.backend = GlobalDefaults['board_backend']
 
-            for y in range(low, high):
-                for x in range(low, high):
-                    xys.append((self.check_size[0] * x,
-                                self.check_size[1] * y))
+            # array of coordinates for each element, rows of x
+            first, last = self.num_check // -2, self.num_check // 2
+            x, y = numpy.meshgrid(numpy.arange(first, last) * self.check_size[0],
+                                  numpy.arange(first, last) * self.check_size[1])
+            xys = numpy.column_stack([x.ravel(), y.ravel()])
 
             # get colors
             self.high, self.low, _, _ = self.gen_rgb()
@@ -1978,42 +4612,44 @@ def board_texture_class(bases, **kwargs):
                     self.colors[:] = self.low[:3]
 
                 # index to know how to color elements in array
-                self.index = numpy.zeros((self.num_check, self.num_check))
-
                 # populate every other for a checkerboard
                 if self.check_type == 'board':
-                    self.index[0::2, 0::2] = 1
-                    self.index[1::2, 1::2] = 1
-                    self.index = numpy.concatenate(self.index[:])
+                    checks = numpy.arange(self.num_check)
+                    self.index = numpy.add.outer(checks, checks) % 2 == 0
+                    self.index = self.index.ravel()
 
                 # randomly populate for a random checkerboard
                 elif self.check_type == 'random':
-                    self.index = numpy.concatenate(self.index[:])
-                    for i in range(len(self.index)):
-                        self.index[i] = self.fill_random.randint(0, 1)
+                    self.index = self.gen_random_index(self.num_check**2)
 
                 # use index to assign colors for board and random
                 if len(self.low.shape) == 0:
-                    self.colors[numpy.where(self.index),
-                                self.contrast_channel] = self.high
+                    self.colors[self.index, self.contrast_channel] = self.high
                 else:
-                    self.colors[numpy.where(self.index)] = self.high[:3]
+                    self.colors[self.index] = self.high[:3]
 
-            elif self.check_type in ['noise', 'noisy noise']:
-                numpy.random.seed(self.fill_seed)
+            elif self.check_type in ['noise', 'noisy noise', 'binary noise']:
+                self.colors = self.gen_noise(0)
 
-                if len(self.low.shape) == 0:
-                    self.colors[:, self.contrast_channel] = numpy.random.uniform(
-                        low=self.low, high=self.high, size=self.num_check**2)
-                else:
-                    r = numpy.random.uniform(low=self.low[0], high=self.high[0], size=self.num_check**2)
-                    g = numpy.random.uniform(low=self.low[1], high=self.high[1], size=self.num_check**2)
-                    b = numpy.random.uniform(low=self.low[2], high=self.high[2], size=self.num_check**2)
-                    self.colors[:] = numpy.dstack([r, g, b])
+            # sparse checks are flashed on a board of the mean color
+            elif self.check_type == 'sparse noise':
+                self.colors = self.gen_sparse_colors(
+                    numpy.full(self.num_check**2, 0.5))
 
-                # gamma correct
-                if MyWindow.gamma_mon is not None:
-                    self.colors = MyWindow.gamma_mon(self.colors)
+            size = (self.check_size[0] * self.num_check,
+                    self.check_size[1] * self.num_check)
+
+            if self.backend in ['texture', 'shader']:
+                # elements are centered on their coordinates
+                self.offset = (first + last - 1) / 2. * \
+                    numpy.array(self.check_size, dtype=float)
+
+                self.stim = self.gen_quad(MyWindow.win, size)
+
+                if MyWindow.small_win is not None:
+                    self.small_stim = self.gen_quad(MyWindow.small_win, size)
+
+                return
 
             self.stim = visual.ElementArrayStim(MyWindow.win,
                                                 xys=xys,
@@ -2025,8 +4661,7 @@ def board_texture_class(bases, **kwargs):
                                                        self.check_size[1]),
                                                 autoLog=False)
 
-            self.stim.size = (self.check_size[0] * self.num_check,
-                              self.check_size[1] * self.num_check)
+            self.stim.size = size
 
             if MyWindow.small_win is not None:
 
@@ -2040,28 +4675,323 @@ def board_texture_class(bases, **kwargs):
                                                                  self.check_size[1]),
                                                           autoLog=False)
 
-                self.small_stim.size = (self.check_size[0] * self.num_check,
-                                        self.check_size[1] * self.num_check)
+                self.small_stim.size = size
+
+        def is_procedural(self):
+            """Whether noise is generated in a shader.
+
+            :return: bool
+            """
+            return self.backend == 'shader' and \
+                self.check_type in ['noise', 'noisy noise', 'binary noise']
+
+        def gen_quad(self, win, size):
+            """Makes a quad for the texture and shader backends.
+
+            :param win: window to draw to
+            :param size: width and height of board in pix
+            :return: NoiseQuad instance for noise generated in a shader, else
+             TextureQuad instance
+            """
+            if self.is_procedural():
+                low, high = self.gen_noise_range()
+
+                return NoiseQuad(win,
+                                 num_check=self.num_check,
+                                 size=size,
+                                 seed=self.fill_seed,
+                                 low=low,
+                                 high=high,
+                                 binary=self.check_type == 'binary noise',
+                                 pos=self.offset,
+                                 stim=self.number)
+
+            return TextureQuad(win, self.to_frame(self.colors), size=size,
+                               pos=self.offset)
+
+        def gen_random_index(self, size):
+            """Draws random bits from fill_random, identical to calling
+            fill_random.randint(0, 1) size times, but vectorized through a
+            numpy generator sharing its state.
+
+            :param int size: number of bits
+            :return: boolean array
+            """
+            state = random_state(self.fill_random)
+            start = state.get_state()
+
+            # randint(0, 1) takes the top 2 bits of each word, rejecting
+            # words with the top bit set
+            bits = []
+            needed = size
+            num_words = 0
+
+            while needed > 0:
+                words = state.randint(0, 2**32, size=2 * needed + 64,
+                                      dtype=numpy.uint32)
+                accepted = numpy.flatnonzero(words >> 31 == 0)[:needed]
+
+                bits.append((words[accepted] >> 30).astype(bool))
+                needed -= len(accepted)
+
+                if needed > 0:
+                    num_words += len(words)
+                else:
+                    num_words += accepted[-1] + 1
+
+            # advance fill_random by the words used
+            state.set_state(start)
+            state.randint(0, 2**32, size=num_words, dtype=numpy.uint32)
+            keys, pos = state.get_state()[1:3]
+            self.fill_random.setstate((3, tuple(keys.tolist()) + (pos,), None))
+
+            return numpy.concatenate(bits)
+
+        def reset(self):
+            """Restarts frame bank. Extends super method.
+            """
+            super(BoardTexture, self).reset()
+
+            if self.sparse_checks is not None:
+                self.set_checks(self.sparse_checks, self.gen_sparse_colors(
+                    numpy.full(len(self.sparse_checks), 0.5)))
+                self.sparse_checks = None
+
+            if self.frame_bank is not None:
+                self.frame_bank.stop()
+                self.frame_bank = self.gen_frame_bank()
+
+        def compile(self, num_frames):
+            """Noise frames are made ahead of the display by a frame bank.
+            Extends super method.
+
+            :param int num_frames: number of frames of the run
+            """
+            super(BoardTexture, self).compile(num_frames)
+
+            if self.plan.update is not None and not self.is_procedural() \
+                    and self.check_type != 'sparse noise':
+                self.frame_bank = self.gen_frame_bank()
+
+        def close(self):
+            """Stops frame bank and recorder. Extends super method.
+            """
+            super(BoardTexture, self).close()
+
+            if self.frame_bank is not None:
+                self.frame_bank.stop()
+                self.frame_bank = None
+
+            if self.recorder is not None:
+                self.recorder.close()
+                self.recorder = None
+
+        def record(self, directory, time_string):
+            """Records frames of noise that changes every frame to a
+            Noiselog_[time]_[stim].npz archive, or flashes of sparse noise
+            to a Sparselog_[time]_[stim].npz archive. Overrides super method.
+
+            :param directory: log folder of run
+            :param time_string: time of run, for file names
+            """
+            if self.check_type == 'sparse noise':
+                file_name = 'Sparselog_{}_{}.npz'.format(time_string,
+                                                         self.number)
+
+                self.recorder = SparseRecorder(
+                    os.path.join(directory, file_name), self.gen_flashes,
+                    num_check=self.num_check)
+
+                return
+
+            if self.check_type not in ['noise', 'noisy noise',
+                                       'binary noise'] or \
+                    self.plan.update is None:
+                return
+
+            file_name = 'Noiselog_{}_{}.npz'.format(time_string, self.number)
+
+            self.recorder = NoiseRecorder(
+                os.path.join(directory, file_name),
+                self.gen_noise_levels,
+                num_checks=self.num_check**2,
+                binary=self.check_type == 'binary noise')
 
         def gen_timing(self, frame):
             """ElementArrayStim does not support assigning alpha values.
+            Instead, sets next noise frame from the frame bank, or the frame
+            number of noise generated in a shader.
 
             :param int frame: current frame number
             """
-            if len(self.low.shape) == 0:
-                self.colors[:, self.contrast_channel] = numpy.random.uniform(
-                    low=self.low, high=self.high, size=self.num_check**2)
+            if self.is_procedural():
+                for stim in [self.stim, self.small_stim]:
+                    if stim is not None:
+                        stim.frame = frame
+
+            elif self.check_type == 'sparse noise':
+                self.gen_sparse(frame)
+
             else:
-                r = numpy.random.uniform(low=self.low[0], high=self.high[0], size=self.num_check**2)
-                g = numpy.random.uniform(low=self.low[1], high=self.high[1], size=self.num_check**2)
-                b = numpy.random.uniform(low=self.low[2], high=self.high[2], size=self.num_check**2)
-                self.colors[:] = numpy.dstack([r, g, b])
+                self.set_frame(self.frame_bank.get())
+
+            if self.recorder is not None:
+                self.recorder.add(frame)
+
+        def gen_sparse(self, frame):
+            """Flashes num_sparse checks at high or low, and returns last
+            frame's checks to the mean color. Only changed checks are
+            updated.
+
+            :param int frame: current frame number
+            """
+            checks, highs = self.gen_flashes(frame)
+
+            if self.sparse_checks is not None:
+                self.set_checks(self.sparse_checks, self.gen_sparse_colors(
+                    numpy.full(len(self.sparse_checks), 0.5)))
+
+            self.set_checks(checks, self.gen_sparse_colors(highs))
+            self.sparse_checks = checks
+
+        def gen_flashes(self, frame):
+            """Draws the checks flashed on a frame from the frame's own
+            stream, without permuting the whole board.
+
+            :param int frame: frame number
+            :return: tuple of checks, and their colors, 1 for high and 0 for
+             low
+            """
+            state = stim_noise.stream(self.fill_seed, self.number, frame)
+
+            checks = stim_noise.sample(state, self.num_check**2,
+                                  min(self.num_sparse, self.num_check**2))
+            highs = state.integers(0, 2, size=len(checks), dtype=numpy.uint8)
+
+            return checks, highs
+
+        def gen_sparse_colors(self, levels):
+            """Colors of checks between low and high, gamma corrected.
+
+            :param levels: level of each check, 0 for low, 1 for high
+            :return: array of rgb values for each check
+            """
+            low, high = self.gen_noise_range()
+            colors = low + numpy.outer(levels, high - low)
+
+            if MyWindow.gamma_mon is not None:
+                colors = MyWindow.gamma_mon(colors, copy=False)
+
+            return colors
+
+        def gen_frame_bank(self):
+            """Starts a frame bank of the noise frames of each drawn frame.
+            Buffer is limited to 256 MiB.
+
+            :return: FrameBank instance
+            """
+            def frames():
+                for frame in numpy.flatnonzero(self.plan.draw):
+                    yield self.to_frame(self.gen_noise(frame))
+
+            frame_bytes = self.to_frame(self.colors).nbytes
+            size = max(2, min(64, 2**28 // frame_bytes))
+
+            return FrameBank(frames(), size=size)
+
+        def gen_noise(self, frame):
+            """Draws a frame of uniform noise between low and high from the
+            frame's own stream (see :py:func:`stim_noise.stream`), and gamma
+            corrects. Binary noise, and noise generated in a shader, are
+            made by gen_noise_frame() instead.
+
+            :param int frame: frame number
+            :return: array of rgb values for each element
+            """
+            if self.check_type == 'binary noise' or self.is_procedural():
+                return self.gen_noise_frame(frame)
+
+            low, high = self.gen_noise_range()
+            channels = self.gen_noise_channels()
+
+            colors = numpy.full((self.num_check ** 2, 3), -1,
+                                dtype=numpy.float64)
+            colors[:, channels] = low[channels] + \
+                self.gen_noise_levels(frame).T * (high - low)[channels]
 
             # gamma correct
             if MyWindow.gamma_mon is not None:
-                self.colors = MyWindow.gamma_mon(self.colors)
+                colors = MyWindow.gamma_mon(colors, copy=False)
+
+            return colors
+
+        def gen_noise_levels(self, frame):
+            """Levels of noise of the contrast channels of a frame, i.e.
+            where between low and high each check is.
+
+            :param int frame: frame number
+            :return: array of levels (channels x checks), bools if binary,
+             else in [0, 1)
+            """
+            channels = self.gen_noise_channels()
+
+            if self.check_type == 'binary noise' or self.is_procedural():
+                return stim_noise.noise_levels(
+                    self.fill_seed, self.number, frame, self.num_check**2,
+                    binary=self.check_type == 'binary noise')[:, channels].T
+
+            state = stim_noise.stream(self.fill_seed, self.number, frame)
+
+            # same draws as uniform(low, high), one channel at a time
+            return numpy.array([state.random(self.num_check**2)
+                                for channel in channels])
+
+        def gen_noise_channels(self):
+            """Channels noise is drawn in.
+
+            :return: list of channel indices
+            """
+            if len(self.low.shape) == 0:
+                return [self.contrast_channel]
+
+            return [0, 1, 2]
+
+        def gen_noise_range(self):
+            """Low and high ends of noise in each channel. Channels other than
+            the contrast channel are held at -1, as in gen_noise().
+
+            :return: tuple of rgb arrays of low and high
+            """
+            if len(self.low.shape) == 0:
+                low = numpy.full(3, -1.)
+                high = numpy.full(3, -1.)
+                low[self.contrast_channel] = self.low
+                high[self.contrast_channel] = self.high
+            else:
+                low = self.low[:3]
+                high = self.high[:3]
+
+            return low, high
+
+        def gen_noise_frame(self, frame):
+            """Makes a frame of counter based noise from fill_seed and the stim
+            number, matching noise generated in a shader (see
+            :py:func:`stim_noise.noise_frame`), and gamma corrects.
+
+            :param int frame: frame number
+            :return: array of rgb values for each element
+            """
+            low, high = self.gen_noise_range()
+
+            colors = stim_noise.noise_frame(
+                self.fill_seed, self.number, frame, self.num_check**2, low,
+                high, binary=self.check_type == 'binary noise').astype(
+                    numpy.float64)
+
+            if MyWindow.gamma_mon is not None:
+                colors = MyWindow.gamma_mon(colors, copy=False)
 
-            self.stim.setColors(self.colors)
+            return colors
 
         def gen_phase(self):
             """ElementArrayStim does not support texture phase.
@@ -2073,9 +5003,66 @@ def board_texture_class(bases, **kwargs):
 
             :param colors: array of rgb values for each element
             """
-            self.stim.setColors(colors)
-            if self.small_stim is not None:
-                self.small_stim.setColors(colors)
+            self.set_frame(self.to_frame(colors))
+
+        def to_frame(self, colors):
+            """Converts element colors to a frame for the board backend;
+            colors as is for elements, or a uint8 texture with a texel per
+            check for textures.
+
+            :param colors: array of rgb values for each element
+            :return: frame to pass to set_frame()
+            """
+            if self.backend in ['texture', 'shader']:
+                return float_uint8(colors).reshape(self.num_check,
+                                                   self.num_check, 3)
+
+            return colors
+
+        def set_checks(self, checks, colors):
+            """Sets colors of some checks. Textures only upload the changed
+            texels. ElementArrayStim has no partial updates, so the changed
+            elements are written into the per vertex colors it draws from,
+            and all colors are only set when those are due to be rebuilt.
+
+            :param checks: index of each check
+            :param colors: array of rgb values for each check
+            """
+            self.colors[checks] = colors
+
+            for stim in [self.stim, self.small_stim]:
+                if stim is None:
+                    continue
+
+                if self.backend in ['texture', 'shader']:
+                    stim.update_texels(checks // self.num_check,
+                                       checks % self.num_check,
+                                       float_uint8(colors))
+
+                elif isinstance(getattr(stim, '_RGBAs', None),
+                                numpy.ndarray) and \
+                        not stim._needColorUpdate:
+                    # vertices of each element, rgb scaled to [0, 1]
+                    rgbas = stim._RGBAs.reshape(self.num_check**2, -1, 4)
+                    rgbas[checks, :, 0:3] = \
+                        (numpy.asarray(colors)[:, numpy.newaxis] + 1) / 2.
+
+                else:
+                    stim.setColors(self.colors)
+
+        def set_frame(self, frame):
+            """Sets a frame made by to_frame().
+
+            :param frame: colors or texture, depending on backend
+            """
+            for stim in [self.stim, self.small_stim]:
+                if stim is None:
+                    continue
+
+                if self.backend in ['texture', 'shader']:
+                    stim.update(frame, copy=False)
+                else:
+                    stim.setColors(frame)
 
         def set_pos(self, x, y):
             """Position setter. Moves entire array of elements
@@ -2083,13 +5070,21 @@ def board_texture_class(bases, **kwargs):
             :param x: x coordinate
             :param y: y coordinate
             """
-            self.stim.setFieldPos((x, y))
-            if self.small_stim is not None:
-                self.small_stim.setFieldPos((x, y))
+            for stim in [self.stim, self.small_stim]:
+                if stim is None:
+                    continue
+
+                if self.backend in ['texture', 'shader']:
+                    stim.setPos(self.offset + (x, y))
+                else:
+                    stim.setFieldPos((x, y))
 
         def get_pos(self):
             """Position getter.
             """
+            if self.backend in ['texture', 'shader']:
+                return self.stim.pos - self.offset
+
             return self.stim.fieldPos
 
     return BoardTexture()
@@ -2107,32 +5102,152 @@ def movie_stim_class(bases, **kwargs):
             # pass parameters up to super
             super(MovieStim, self).__init__(**kwargs)
 
+            self.backend = None
+            self.decoder = None
+            self.frame_bank = None
+
         def make_stim(self):
-            """Creates instance of psychopy stim object.
+            """Creates instance of psychopy stim object, or a texture quad
+            of movie frames decoded ahead of the display if backend is
+            'ffmpeg', or read from a pre-decoded cache if 'cached'.
+            """
+            self.backend = GlobalDefaults['movie_backend']
+            lut = MovieDecoder.gen_lut(MyWindow.gamma_mon)
+
+            if self.backend == 'cached':
+                self.decoder = CachedMovie(self.movie_filename,
+                                           self.movie_size, lut=lut)
+
+                # first frame is ready before the run
+                self.stim = TextureQuad(MyWindow.win, self.decoder.frames[0],
+                                        size=self.movie_size,
+                                        pos=self.location)
+
+            elif self.backend == 'ffmpeg':
+                self.decoder = MovieDecoder(self.movie_filename, lut=lut)
+
+                blank = numpy.zeros((self.decoder.height, self.decoder.width,
+                                     3), dtype=numpy.uint8)
+
+                self.stim = TextureQuad(MyWindow.win, blank,
+                                        size=self.movie_size,
+                                        pos=self.location)
+
+            else:
+                self.stim = visual.MovieStim(win=MyWindow.win,
+                                             filename=self.movie_filename,
+                                             pos=self.location,
+                                             size=self.movie_size,
+                                             loop=True)
+
+        def reset(self):
+            """Paused psychopy movies can't be returned to their unstarted
+            state, so movie stims are remade. Decoded movies restart their
+            frame bank instead. Extends super method.
+            """
+            super(MovieStim, self).reset()
+
+            if self.backend in ['ffmpeg', 'cached']:
+                if self.frame_bank is not None:
+                    self.frame_bank.stop()
+                self.frame_bank = FrameBank(self.decoder,
+                                            size=self.gen_bank_size())
+            else:
+                self.make_stim()
+
+        def compile(self, num_frames):
+            """Psychopy movies are paused on their last frame while
+            animating. Decoded movies advance by one movie frame every
+            display_frames() drawn frames, from a frame bank. Extends super
+            method.
+
+            :param int num_frames: number of frames of the run
+            """
+            super(MovieStim, self).compile(num_frames)
+
+            if self.backend in ['ffmpeg', 'cached']:
+                self.plan.update = self.gen_movie_frame
+                self.frame_bank = FrameBank(self.decoder,
+                                            size=self.gen_bank_size())
+            else:
+                self.plan.update = self.gen_pause
+
+        def close(self):
+            """Stops frame bank, and with it the decoder. Extends super
+            method.
+            """
+            super(MovieStim, self).close()
+
+            if self.frame_bank is not None:
+                self.frame_bank.stop()
+                self.frame_bank = None
+
+        def stop(self):
+            """Pauses psychopy movies, or stops the frame bank of decoded
+            movies, and with it the decoder. Overrides super method.
+            """
+            if self.backend in ['ffmpeg', 'cached']:
+                if self.frame_bank is not None:
+                    self.frame_bank.stop()
+                    self.frame_bank = None
+            else:
+                self.stim.pause()
+
+        def gen_bank_size(self):
+            """Number of decoded frames to buffer, limited to 256 MiB.
+
+            :return: int
             """
-            self.stim = visual.MovieStim(win=MyWindow.win,
-                                         filename=self.movie_filename,
-                                         pos=self.location,
-                                         size=self.movie_size,
-                                         loop=True)
+            frame_bytes = self.decoder.width * self.decoder.height * 3
+
+            return max(2, min(64, 2**28 // frame_bytes))
+
+        def gen_movie_frame(self, frame):
+            """Shows the next decoded frame on the first of each
+            display_frames() drawn frames, so movie frames are locked to
+            display frames. Waits for the decoder on an underrun, which is
+            counted by the frame bank.
 
-        def animate(self, frame):
+            :param int frame: current frame number
             """
-            Method for drawing stim objects to back buffer. Checks if object
-            should be drawn. Back buffer is brought to front with calls to
-            flip() on the window.
+            if (frame - self.start_stim) % \
+                    self.decoder.display_frames() == 0:
+                data = self.frame_bank.get()
+
+                # hold last frame if movie ended
+                if data is not None:
+                    self.stim.update(data, copy=False)
+
+        def gen_pause(self, frame):
+            """Pauses movie on the last frame it is drawn.
 
             :param int frame: current frame number
             """
-            # check if within animation range
             if self.end_stim == (frame + 1):
                 self.stim.pause()
 
-            super(MovieStim, self).animate(frame)
-
     return MovieStim()
 
 
+def log_dir(time_at_run):
+    """Makes log folder of a run, in day and time folders in the logs
+    directory, if it doesn't exist.
+
+    :param time_at_run: Time at which stims were run
+    :return: path of log folder
+    """
+    path = config.get('StimProgram', 'logs_dir')
+
+    # day folder, then time folder
+    path = os.path.join(path, strftime('%Y_%m_%d', time_at_run),
+                        strftime('%Hh%Mm%Ss', time_at_run))
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    return path
+
+
 def log_stats(count_reps, reps, count_frames, num_frames, elapsed_time,
               stim_list, to_animate, time_at_run):
     """Function to write information about stims to file.
@@ -2149,22 +5264,7 @@ def log_stats(count_reps, reps, count_frames, num_frames, elapsed_time,
     current_time = time_at_run
     current_time_string = strftime('%Y_%m_%d_%H%M%S', current_time)
 
-    path = config.get('StimProgram', 'logs_dir')
-    if not os.path.exists(path):
-        os.makedirs(path)
-
-    # day folder
-    # path += strftime('%Y_%m_%d', current_time) + '\\'
-    path = os.path.join(path, strftime('%Y_%m_%d', current_time))
-    if not os.path.exists(path):
-        os.makedirs(path)
-
-    # time folder
-    # path += strftime('%Hh%Mm%Ss', current_time) + '\\'
-    path = os.path.join(path, strftime('%Hh%Mm%Ss', current_time))
-
-    if not os.path.exists(path):
-        os.makedirs(path)
+    path = log_dir(current_time)
 
     # filename format: stimlog_[time]_[stimtype].txt
     file_name = 'stimlog_' + current_time_string + '_' + stim_list[
@@ -2183,7 +5283,9 @@ def log_stats(count_reps, reps, count_frames, num_frames, elapsed_time,
         average_fps = (count_reps * num_frames + count_frames) / elapsed_time
         f.write("Average fps: {0:.2f} hz.".format(average_fps))
 
-        f.write("\nElapsed time: {0:.3f} seconds.\n".format(elapsed_time))
+        f.write("\nElapsed time: {0:.3f} seconds.".format(elapsed_time))
+
+        f.write("\nFrame bank underrun(s): {}.\n".format(FrameBank.underruns))
 
         for i in stim_list:
             f.write(str(i))
@@ -2275,7 +5377,7 @@ def log_stats(count_reps, reps, count_frames, num_frames, elapsed_time,
 
             if stim_list[i].stim_type in ['ImageJumpStim']:
 
-                cap = float_uint8(to_animate[i].orig_tex)
+                cap = float_uint8(to_animate[i].get_orig_tex())
                 save_name = path + file_name[:-3] + 'npy'
                 numpy.save(save_name, numpy.flipud(cap))
                 # print cap.shape, cap.dtype
@@ -2316,58 +5418,6 @@ def log_stats(count_reps, reps, count_frames, num_frames, elapsed_time,
     return current_time_string
 
 
-def save_movie(current_time, save_loc):
-    """
-    Saves movies to file from saved pngs
-
-    :param current_time: current time
-    :param save_loc: save location
-    """
-    current_time_string = strftime('%Y_%m_%d_%H%M%S', current_time)
-    save_name = 'capture_video' + current_time_string + '.mpg'
-    save_name_gray = 'capture_video' + current_time_string + '_gray.mpg'
-
-    args = ['ffmpeg',
-            '-f', 'image2',
-            '-framerate', str(GlobalDefaults['frame_rate']),
-            '-i', os.path.join(save_loc, 'capture_%05d.png'),
-            '-b:v', '20M',
-            os.path.join(save_loc, save_name)]
-
-    # make movie using ffmpeg
-    print('ffmpeg...')
-    # print save_loc
-    # print os.path.join(save_loc, 'capture_%05d.png')
-
-    process = subprocess.Popen(args,
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE)
-    stdout, stderr = process.communicate()
-    print(stdout, stderr)
-
-    args2 = ['ffmpeg',
-             '-i', os.path.join(save_loc, save_name),
-             '-vf', 'format=gray',
-             '-qscale', '0',
-             os.path.join(save_loc, save_name_gray)]
-
-    print('\ngrayscale conversion...')
-
-    process = subprocess.Popen(args2,
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE)
-    stdout, stderr = process.communicate()
-    print(stdout, stderr)
-
-    # delete .pngs
-    # to_delete = [f for f in os.listdir(save_loc) if f.endswith('.png')]
-    # for f in to_delete:
-    #     os.remove(os.path.join(save_loc, f))
-
-    print('Saved in: {}'.format(save_loc))
-    print('\nDONE')
-
-
 def stim_factory(stim):
     """
     Instantiates a stim class from a StimInfo class
@@ -2379,30 +5429,66 @@ def stim_factory(stim):
                 'moving': MovingStim,
                 'table' : TableStim,
                 'random': RandomlyMovingStim,
-                'jump'  : ImageJumpStim}
+                'jump'  : ImageJumpStim,
+                'sequence': ImageSequenceStim}
 
     # checkerboards and movies have conditional inheritance based on move type, so instantiate
     # those with functions, the rest as normal
 
-    if stim.parameters['fill_mode'] == 'checkerboard':
-        return board_texture_class(stim_map[stim.stim_type], **stim.parameters)
+    # sequences show their own images, whatever the fill mode
+    if stim.stim_type == 'sequence':
+        instance = ImageSequenceStim(**stim.parameters)
+
+    elif stim.parameters['fill_mode'] == 'checkerboard':
+        instance = board_texture_class(stim_map[stim.stim_type],
+                                       **stim.parameters)
 
     elif stim.parameters['fill_mode'] == 'movie':
-        return movie_stim_class(stim_map[stim.stim_type], **stim.parameters)
+        instance = movie_stim_class(stim_map[stim.stim_type],
+                                    **stim.parameters)
 
     else:
-        return stim_map[stim.stim_type](**stim.parameters)
+        instance = stim_map[stim.stim_type](**stim.parameters)
+
+    instance.number = stim.number
+
+    return instance
+
+
+def compile_plan(to_animate, num_frames):
+    """Compiles render plans of stims, and registered trigger frames into a
+    boolean array indexed by frame.
+
+    :param to_animate: list of stims being animated, after draw_times()
+    :param num_frames: number of frames to animate for
+    :return: boolean array of whether to trigger on each frame
+    """
+    for stim in to_animate:
+        stim.compile(num_frames)
+
+    triggers = numpy.zeros(num_frames, dtype=bool)
+
+    # last value is inf
+    for frame in MyWindow.frame_trigger_list[:-1]:
+        frame = int(ceil(frame))
+        if 0 <= frame < num_frames:
+            triggers[frame] = True
+
+    return triggers
 
 
-def animation_loop(to_animate, num_frames, current_time, save_loc):
+def animation_loop(to_animate, num_frames, triggers, current_time,
+                   capture=None):
     """
     Function where animation logic is carried out, along with other helper tasks
 
     :param to_animate: list of stims being animated
     :param num_frames: number of frames to animate for
+    :param triggers: boolean array of whether to trigger on each frame
     :param current_time: time at call to animate
+    :param capture: CaptureWriter instance to pass frames to instead of
+     flipping, or None
     """
-    index = 0
     reps = 0
     frames = 0
 
@@ -2412,6 +5498,11 @@ def animation_loop(to_animate, num_frames, current_time, save_loc):
     MyWindow.win.recordFrameIntervals = True
     MyWindow.win.frameIntervals = []
 
+    # frames are read back a few frames late, to not stall
+    readback = None
+    if capture is not None:
+        readback = ReadbackRing(MyWindow.win, MyWindow.win.size)
+
     # clock for timing
     elapsed_time_clock = core.MonotonicClock()
 
@@ -2421,26 +5512,22 @@ def animation_loop(to_animate, num_frames, current_time, save_loc):
         for stim in to_animate:
             stim.animate(frame)
 
-        if not GlobalDefaults['capture']:
+        if capture is None:
             MyWindow.flip()
 
         # save as movie?
-        elif GlobalDefaults['capture']:
-            filename = os.path.join(save_loc,
-                                    'capture_' +
-                                    str(frame + 1).zfill(5) + '.png')
-            img = MyWindow.win._getRegionOfFrame(buffer='back')
-            img.save(filename, 'PNG')
+        else:
+            img = readback.read()
+            if img is not None:
+                capture.add(img)
             sys.stdout.write('\r')
             sys.stdout.write(str(int(frame / float(num_frames) * 100) +
                                  1) + '%')
             sys.stdout.flush()
             MyWindow.win.clearBuffer()
 
-        if frame == MyWindow.frame_trigger_list[index]:
+        if triggers[frame]:
             MyWindow.send_trigger()
-            # print frame, 'triggered'
-            index += 1
 
         # escape key breaks if focus on window
         for key in event.getKeys(keyList=['escape']):
@@ -2456,6 +5543,11 @@ def animation_loop(to_animate, num_frames, current_time, save_loc):
     # get elapsed time for fps
     elapsed_time = elapsed_time_clock.getTime()
 
+    if readback is not None:
+        for img in readback.flush():
+            capture.add(img)
+        readback.close()
+
     # MyWindow.win.saveFrameIntervals()
     MyWindow.win.recordFrameIntervals = False
     f = numpy.array(MyWindow.win.frameIntervals)
@@ -2470,8 +5562,7 @@ def animation_loop(to_animate, num_frames, current_time, save_loc):
 
     # stop movies from continuing in background
     for stim in to_animate:
-        if stim.fill_mode == 'movie':
-            stim.stim.pause()
+        stim.stop()
 
     # outer break
     if MyWindow.should_break:
@@ -2506,29 +5597,58 @@ def main(stim_list, verbose=True):
     count_reps = 0
     count_frames = 0
     count_elapsed_time = 0
+    FrameBank.underruns = 0
+    TextureCache.hits = 0
+    TextureCache.misses = 0
 
     # to exit out of nested loops
     MyWindow.should_break = False
     MyWindow.running = True
 
-    # outer loop for number of reps
+    # prep stims once, and rewind them between reps
+    to_animate = []
+    capture = None
+
     try:
-        for x in range(reps):
-            # prep stims
-            to_animate = []
+        for stim in stim_list:
+            to_animate.append(stim_factory(stim))
+
+        # generate stims
+        for stim in to_animate:
+            stim.make_stim()
 
-            for stim in stim_list:
-                to_animate.append(stim_factory(stim))
+        # reset frame trigger times
+        del MyWindow.frame_trigger_list[:-1]
 
-            # generate stims
-            for stim in to_animate:
-                stim.make_stim()
+        # gen draw times and get end time of last stim
+        num_frames = max(stim.draw_times() for stim in to_animate)
 
-            # reset frame trigger times
-            del MyWindow.frame_trigger_list[:-1]
+        # precompute per frame state
+        triggers = compile_plan(to_animate, num_frames)
 
-            # gen draw times and get end time of last stim
-            num_frames = max(stim.draw_times() for stim in to_animate)
+        if GlobalDefaults['record_noise']:
+            for stim in to_animate:
+                stim.record(log_dir(current_time),
+                            strftime('%Y_%m_%d_%H%M%S', current_time))
+
+        # all reps are captured to the same movies
+        if GlobalDefaults['capture']:
+            capture_dir = os.path.abspath(config.get('StimProgram', 'capture_dir'))
+            current_time_string = strftime('%Y_%m_%d_%H%M%S', current_time)
+            save_dir = 'capture_' + current_time_string + '_' + str(to_animate[0])
+            save_loc = os.path.join(capture_dir, save_dir)
+            os.makedirs(save_loc)
+
+            capture = CaptureWriter(save_loc, current_time_string,
+                                    MyWindow.win.size,
+                                    GlobalDefaults['frame_rate'],
+                                    gamma=MyWindow.gamma_lut)
+
+        # outer loop for number of reps
+        for x in range(reps):
+            if x > 0:
+                for stim in to_animate:
+                    stim.reset()
 
             # draw stims and flip window
             if GlobalDefaults['trigger_wait'] != 0:
@@ -2538,17 +5658,8 @@ def main(stim_list, verbose=True):
                 for y in range(GlobalDefaults['trigger_wait'] - 1):
                     MyWindow.flip()
 
-            save_loc = None
-            if GlobalDefaults['capture']:
-                capture_dir = os.path.abspath(config.get('StimProgram', 'capture_dir'))
-                if not os.path.exists(capture_dir):
-                    os.makedirs(capture_dir)
-                current_time_string = strftime('%Y_%m_%d_%H%M%S', current_time)
-                save_dir = 'capture_' + current_time_string + '_' + str(to_animate[0])
-                save_loc = os.path.join(capture_dir, save_dir)
-                os.makedirs(save_loc)
-
-            rep, elapsed_time, frames, dropped = animation_loop(to_animate, num_frames, current_time, save_loc)
+            rep, elapsed_time, frames, dropped = animation_loop(
+                to_animate, num_frames, triggers, current_time, capture)
 
             count_elapsed_time += elapsed_time
             count_reps += rep
@@ -2561,6 +5672,13 @@ def main(stim_list, verbose=True):
         traceback.print_exc()
         return str(e), 'error', None, None
 
+    finally:
+        for stim in to_animate:
+            stim.close()
+
+        if capture is not None:
+            capture.close()
+
     # one last flip to clear window if still open
     try:
 
@@ -2599,8 +5717,11 @@ def main(stim_list, verbose=True):
             format((count_reps * (num_frames) + count_frames) /
                    count_elapsed_time), end=' ')
         print("{} frame(s) missed.".format(dropped))
-        print("Elapsed time: {0:.3f} seconds.\n". \
+        print("Elapsed time: {0:.3f} seconds.". \
             format(count_elapsed_time))
+        print("Texture cache: {hits} hit(s), {misses} miss(es).".
+              format(**TextureCache.stats()), end=' ')
+        print("Frame bank underrun(s): {}.\n".format(FrameBank.underruns))
 
     time_stamp = None
 
@@ -2611,10 +5732,6 @@ def main(stim_list, verbose=True):
 
     fps = (count_reps * num_frames + count_frames) / count_elapsed_time
 
-    # save movie
-    if GlobalDefaults['capture']:
-        save_movie(current_time, save_loc)
-
     MyWindow.running = False
 
     return fps, count_elapsed_time, dropped, time_stamp
@@ -1008,13 +1008,15 @@ class ListPanel(wx.Panel):
                        'MovingStim',
                        'RandomlyMovingStim',
                        'TableStim',
-                       'ImageJumpStim']
+                       'ImageJumpStim',
+                       'ImageSequenceStim']
 
         label_names = ['static',
                        'moving',
                        'random',
                        'table',
-                       'jump']
+                       'jump',
+                       'sequence']
 
         if stim_type in class_names:
             return label_names[class_names.index(stim_type)]
@@ -1902,6 +1904,13 @@ class MyMenuBar(wx.MenuBar):
         if self.frame.parameters.get_param_value('global', 'framepack'):
             self.options_framepack.Toggle()  # default to True
 
+        self.options_record_noise = options_menu.Append(wx.ID_ANY, 'record noise',
+                                                       'Record frames of noise checkerboards',
+                                                       kind=wx.ITEM_CHECK)
+
+        if self.frame.parameters.get_param_value('global', 'record_noise'):
+            self.options_record_noise.Toggle()  # default to True
+
         # options sub menu
         options_tools = wx.Menu()
         tools_rec_map = options_tools.Append(wx.ID_ANY,
@@ -1976,6 +1985,7 @@ class MyMenuBar(wx.MenuBar):
                 mirror_number_three: self.on_mirror_number_three,
                 self.options_override: self.on_options_override,
                 self.options_framepack: self.on_options_framepack,
+                self.options_record_noise: self.on_options_record_noise,
                 tools_rec_map: self.on_options_tools_rec_map,
             }
         }
@@ -2164,6 +2174,18 @@ class MyMenuBar(wx.MenuBar):
         self.frame.parameters.set_param_value('global', 'framepack', val)
         pyStim.GlobalDefaults['framepack'] = val
 
+    def on_options_record_noise(self, event):
+        """
+        Handles toggling recording of noise frames
+
+        :param event:
+        :return:
+        """
+        val = self.options_record_noise.IsChecked()
+
+        self.frame.parameters.set_param_value('global', 'record_noise', val)
+        pyStim.GlobalDefaults['record_noise'] = val
+
     def on_options_tools_rec_map(self, event):
         """
         Handles request to map receptive field_rect
@@ -0,0 +1,154 @@
+"""
+Counter based checkerboard noise. Each check's value is an integer hash of
+(seed, stim, frame, check, channel), so any frame can be made directly, in
+any order, and stims with the same seed show different noise. This is the CPU reference for the noise drawn by the shader board
+backend, which computes the same hash per fragment, so analysis code can
+regenerate displayed frames without replaying a run.
+
+Checks are numbered row by row from the bottom left, i.e. check
+``y * num_check + x``.
+
+Other random content is drawn from counter based Philox streams, one per
+stim and frame, which can likewise be made for any frame directly.
+"""
+
+import numpy
+
+
+def hash32(x):
+    """Integer hash of 32 bit unsigned values (lowbias32). Must match the
+    hash in the board noise shader.
+
+    :param x: array of values, cast to uint32
+    :return: uint32 array of hashes
+    """
+    x = numpy.array(x, dtype=numpy.uint32)
+
+    x ^= x >> numpy.uint32(16)
+    x *= numpy.uint32(0x7feb352d)
+    x ^= x >> numpy.uint32(15)
+    x *= numpy.uint32(0x846ca68b)
+    x ^= x >> numpy.uint32(16)
+
+    return x
+
+
+def noise_key(seed, stim):
+    """Seed word of the noise of a stim, made from the seed and stim number.
+    Must match the key in the board noise shader.
+
+    :param int seed: seed, e.g. fill_seed
+    :param int stim: stim number
+    :return: uint32 key
+    """
+    seed = numpy.uint32(int(seed) & 0xffffffff)
+    stim = numpy.uint32(int(stim) & 0xffffffff)
+
+    return hash32(seed ^ hash32(stim))
+
+
+def noise_bits(seed, stim, frame, num_checks):
+    """Random bits of every check and channel on a frame.
+
+    :param int seed: seed, e.g. fill_seed
+    :param int stim: stim number
+    :param int frame: frame number
+    :param int num_checks: number of checks
+    :return: uint32 array (num_checks x 3)
+    """
+    key = noise_key(seed, stim)
+    frame = numpy.uint32(int(frame) & 0xffffffff)
+
+    counters = numpy.arange(num_checks, dtype=numpy.uint32)[:, numpy.newaxis] \
+        * numpy.uint32(4) + numpy.arange(3, dtype=numpy.uint32)
+
+    return hash32(key ^ hash32(frame ^ hash32(counters)))
+
+
+def noise_levels(seed, stim, frame, num_checks, binary=False):
+    """Levels of every check and channel on a frame, i.e. where between low
+    and high each is.
+
+    Uniform levels are taken from the top 24 bits, in float32, and binary
+    levels are the top bit.
+
+    :param int seed: seed, e.g. fill_seed
+    :param int stim: stim number
+    :param int frame: frame number
+    :param int num_checks: number of checks
+    :param bool binary: whether noise is binary or uniform
+    :return: array of levels (num_checks x 3), bool if binary, else float32
+     in [0, 1)
+    """
+    bits = noise_bits(seed, stim, frame, num_checks)
+
+    if binary:
+        return (bits >> numpy.uint32(31)).astype(bool)
+
+    return (bits >> numpy.uint32(8)).astype(numpy.float32) * \
+        numpy.float32(2 ** -24)
+
+
+def noise_frame(seed, stim, frame, num_checks, low, high, binary=False):
+    """Colors of every check on a frame, before gamma correction.
+
+    Uniform noise is low + u * (high - low), and binary noise is high or
+    low, from the levels of noise_levels(). Both are computed in float32, as
+    in the shader.
+
+    :param int seed: seed, e.g. fill_seed
+    :param int stim: stim number
+    :param int frame: frame number
+    :param int num_checks: number of checks
+    :param low: rgb of low end of noise, in [-1, 1]
+    :param high: rgb of high end of noise, in [-1, 1]
+    :param bool binary: whether noise is binary or uniform
+    :return: float32 array of rgb values (num_checks x 3)
+    """
+    levels = noise_levels(seed, stim, frame, num_checks, binary=binary)
+
+    low = numpy.asarray(low, dtype=numpy.float32)
+    high = numpy.asarray(high, dtype=numpy.float32)
+
+    if binary:
+        return numpy.where(levels, high, low)
+
+    return low + levels * (high - low)
+
+
+def stream(seed, stim, frame=0):
+    """Random generator of one frame of a stim. The Philox key is made from
+    the seed and stim number, so stims with the same seed draw independently,
+    and the frame sets the top word of the counter, so that each frame has
+    its own stream, made without drawing earlier frames.
+
+    :param int seed: seed, e.g. fill_seed or move_seed
+    :param int stim: stim number
+    :param int frame: frame number, or other index, e.g. of jumps
+    :return: numpy Generator
+    """
+    key = (int(seed) & 0xffffffffffffffff) | \
+        (int(stim) & 0xffffffffffffffff) << 64
+    counter = (int(frame) & 0xffffffffffffffff) << 192
+
+    return numpy.random.Generator(numpy.random.Philox(key=key,
+                                                      counter=counter))
+
+
+def sample(state, n, k):
+    """Draws k distinct values of range(n) with Floyd's algorithm, which
+    takes k draws from the generator however large n is.
+
+    :param state: numpy Generator, e.g. from stream()
+    :param int n: number of values to draw from
+    :param int k: number of values to draw, at most n
+    :return: int array of k values, in no particular order
+    """
+    highs = numpy.arange(n - k, n)
+    draws = state.integers(0, highs + 1)
+
+    chosen = set()
+    for high, draw in zip(highs.tolist(), draws.tolist()):
+        chosen.add(high if draw in chosen else draw)
+
+    return numpy.fromiter(chosen, dtype=numpy.intp, count=k)
@@ -0,0 +1,218 @@
+"""
+Vectorized stim trajectories. Positions for every frame are computed at once
+with numpy broadcasting, instead of being built up frame by frame.
+
+Directions are in degrees, clockwise from up, so that a stim moving at 0
+degrees moves towards the top of the window.
+"""
+
+import numpy
+
+
+def line(start, speed, angle, num_frames):
+    """Positions of a stim moving in a straight line.
+
+    :param start: x, y starting position
+    :param speed: distance travelled per frame
+    :param angle: travel direction in degrees
+    :param int num_frames: number of frames
+    :return: float32 array of x, y positions (num_frames x 2)
+    """
+    return path(start, [speed], [angle], [num_frames])
+
+
+def path(start, speeds, angles, num_frames):
+    """Positions of a stim moving through consecutive straight segments. Each
+    segment starts from the last position of the previous one.
+
+    :param start: x, y starting position of the first segment
+    :param speeds: distance travelled per frame, for each segment
+    :param angles: travel direction in degrees, for each segment
+    :param num_frames: number of frames of each segment
+    :return: float32 array of x, y positions (total frames x 2)
+    """
+    angles = numpy.deg2rad(numpy.asarray(angles, dtype=numpy.float64))
+    num_frames = numpy.asarray(num_frames, dtype=int)
+
+    # x, y distance per frame of each segment
+    steps = numpy.asarray(speeds, dtype=numpy.float64)[:, numpy.newaxis] * \
+        numpy.column_stack([numpy.sin(angles), numpy.cos(angles)])
+
+    increments = numpy.repeat(steps, num_frames, axis=0)
+
+    # first frame of each segment doesn't move
+    firsts = numpy.cumsum(num_frames) - num_frames
+    increments[firsts[num_frames > 0]] = 0
+
+    positions = numpy.asarray(start, dtype=numpy.float64) + \
+        numpy.cumsum(increments, axis=0)
+
+    return positions.astype(numpy.float32)
+
+
+def radial_sweeps(start_dir, num_dirs, start_radius, speed, move_delay=0,
+                  off_pos=(0, 0)):
+    """Positions of a stim sweeping through the center from the starting
+    radius, once for each of num_dirs evenly spaced directions.
+
+    :param start_dir: origin direction of the first sweep in degrees, i.e.
+     travel direction is opposite
+    :param int num_dirs: number of sweeps
+    :param start_radius: distance from center to start sweeps from
+    :param speed: distance travelled per frame
+    :param int move_delay: number of frames to hold stim at off_pos after
+     each sweep
+    :param off_pos: x, y position to hold stim at between sweeps
+    :return: tuple of float32 array of x, y positions (num_dirs x num_frames
+     x 2), and origin direction of each sweep in degrees
+    """
+    dirs = start_dir + numpy.arange(num_dirs) * 360. / num_dirs
+    dirs[1:] %= 360
+    radians = numpy.deg2rad(dirs)
+
+    # unit vectors pointing from center to start of each sweep
+    units = numpy.column_stack([numpy.sin(radians), numpy.cos(radians)])
+
+    # round up
+    num_frames = int(abs(start_radius) * 2 / speed + 0.99)
+
+    # travel is towards the center, i.e. opposite of origin direction
+    steps = numpy.arange(num_frames)[:, numpy.newaxis] * speed
+    positions = units[:, numpy.newaxis, :] * (start_radius - steps)
+
+    if move_delay > 0:
+        off = numpy.broadcast_to(numpy.asarray(off_pos, dtype=numpy.float64),
+                                 (num_dirs, move_delay, 2))
+        positions = numpy.concatenate([positions, off], axis=1)
+
+    return positions.astype(numpy.float32), dirs
+
+
+class MappedTrajectory(object):
+    """Frame indexed positions of a table swept once per direction, read from
+    (memory mapped) table columns a window of frames at a time, so that
+    memory use doesn't grow with table length. Each sweep is followed by
+    move_delay frames at off_pos. Windows can be read ahead on another
+    thread, see prefetch().
+
+    :param columns: x and y columns, or radius column if polar
+    :param int first_frame: frame the first sweep starts on
+    :param int num_dirs: number of directions
+    :param thetas: polar angle in degrees of each direction, if polar
+    :param scale: factor to scale table units by
+    :param int move_delay: number of frames to hold stim at off_pos after
+     each sweep
+    :param off_pos: x, y position to hold stim at between sweeps
+    :param int window: number of frames to read at a time
+    """
+    def __init__(self, columns, first_frame=0, num_dirs=1, thetas=None,
+                 scale=1., move_delay=0, off_pos=(0, 0), window=4096):
+        self.columns = columns
+        self.first_frame = first_frame
+        self.num_dirs = num_dirs
+        self.thetas = thetas
+        self.scale = scale
+        self.off_pos = numpy.asarray(off_pos, dtype=numpy.float32)
+        self.window = window
+
+        self.table_frames = len(columns[0])
+        self.sweep_frames = self.table_frames + move_delay
+
+        # currently read window, keyed by sweep and first row
+        self.key = None
+        self.positions = None
+
+        # windows read ahead, and the next one taken from them
+        self.bank = None
+        self.ahead = None
+
+    def __len__(self):
+        """Number of frames in all sweeps."""
+        return self.sweep_frames * self.num_dirs
+
+    def __getitem__(self, frame):
+        """Position on a frame.
+
+        :param int frame: frame number
+        :return: float32 array of x, y position
+        """
+        sweep, i = divmod(frame - self.first_frame, self.sweep_frames)
+
+        if i >= self.table_frames:
+            return self.off_pos
+
+        start = i - i % self.window
+
+        if self.key != (sweep, start):
+            self.positions = self.next_window(sweep, start)
+            self.key = (sweep, start)
+
+        return self.positions[i - start]
+
+    def windows(self):
+        """Reads the windows of every sweep, in the order they're shown.
+
+        :return: generator of ((sweep, first row), positions)
+        """
+        for sweep in range(self.num_dirs):
+            for start in range(0, self.table_frames, self.window):
+                yield (sweep, start), self.read(sweep, start)
+
+    def prefetch(self, bank):
+        """Takes windows from bank instead of reading them while indexed,
+        and forgets the current window, e.g. to replay from the start.
+
+        :param bank: bank with a get() method, returning windows() in order
+         and then None, e.g. a pyStim.FrameBank; or None to read windows
+         when indexed
+        """
+        self.bank = bank
+        self.ahead = None
+        self.key = None
+        self.positions = None
+
+    def next_window(self, sweep, start):
+        """Takes a window from the bank, skipping windows that weren't
+        indexed. Windows that aren't in the bank (e.g. frames after the last
+        sweep, or indexing backwards) are read instead.
+
+        :param int sweep: index of sweep
+        :param int start: first table row of window
+        :return: float32 array of x, y positions (window x 2)
+        """
+        while self.bank is not None:
+            if self.ahead is None:
+                self.ahead = self.bank.get()
+
+                if self.ahead is None:
+                    self.bank = None
+                    break
+
+            key, positions = self.ahead
+            if key > (sweep, start):
+                break
+
+            self.ahead = None
+            if key == (sweep, start):
+                return positions
+
+        return self.read(sweep, start)
+
+    def read(self, sweep, start):
+        """Reads and converts a window of the table.
+
+        :param int sweep: index of sweep
+        :param int start: first table row of window
+        :return: float32 array of x, y positions (window x 2)
+        """
+        stop = start + self.window
+        columns = [numpy.array(column[start:stop], dtype=numpy.float64) *
+                   self.scale for column in self.columns]
+
+        # coordinate tables are the same every direction
+        if self.thetas is not None:
+            theta = numpy.deg2rad(self.thetas[sweep % self.num_dirs])
+            columns = [columns[0] * numpy.cos(theta),
+                       columns[0] * numpy.sin(theta)]
+
+        return numpy.column_stack(columns).astype(numpy.float32)
@@ -2,19 +2,27 @@
 Tests for pystim.
 """
 
+import ctypes
+import itertools
+import json
 import os
 import sys
+import threading
 
 sys.path.append(os.path.abspath('pyStim'))
 
 import pickle
+from random import Random
 
 import numpy as np
 import psychopy
 import pytest
 from mock import Mock, patch
 
+import GammaCorrection
 import pyStim
+import stim_noise
+import trajectory
 
 try:
     import u3
@@ -574,6 +582,1186 @@ class TestGenTexture(object):
                                       np.array([1.0, 1.0, -1.0, -1.0, 1.0]))
 
 
+class TestTextureCache(object):
+
+    def setup_method(self):
+        pyStim.TextureCache.clear()
+        pyStim.GlobalDefaults['background'] = [0., 0., 0.]
+
+    def test_hit(self):
+        stim = pyStim.StaticStim(fill_mode='sine',
+                                 shape='rectangle',
+                                 size=[8, 8])
+        first = stim.gen_texture()
+
+        stim = pyStim.StaticStim(fill_mode='sine',
+                                 shape='rectangle',
+                                 size=[8, 8])
+        second = stim.gen_texture()
+
+        assert first is second
+        assert pyStim.TextureCache.hits == 1
+        assert pyStim.TextureCache.misses == 1
+
+    def test_miss_on_background(self):
+        stim = pyStim.StaticStim(fill_mode='sine',
+                                 shape='rectangle',
+                                 size=[8, 8])
+        first = stim.gen_texture()
+
+        pyStim.GlobalDefaults['background'] = [0.5, 0.5, 0.5]
+        stim = pyStim.StaticStim(fill_mode='sine',
+                                 shape='rectangle',
+                                 size=[8, 8])
+        second = stim.gen_texture()
+
+        assert pyStim.TextureCache.misses == 2
+        assert not np.array_equal(first, second)
+
+    def test_timing_texture_writeable(self):
+        stim = pyStim.StaticStim(timing='sine')
+        stim.gen_texture()
+        tex = stim.gen_texture()
+
+        assert pyStim.TextureCache.hits == 1
+        assert tex.flags.writeable
+
+    def test_eviction(self):
+        pyStim.TextureCache.max_bytes = 8 * 8 * 4 * 4
+        try:
+            for size in [8, 4, 8]:
+                stim = pyStim.StaticStim(fill_mode='sine',
+                                         shape='rectangle',
+                                         size=[size, size])
+                stim.gen_texture()
+        finally:
+            pyStim.TextureCache.max_bytes = 512 * 2 ** 20
+
+        assert pyStim.TextureCache.misses == 3
+        assert pyStim.TextureCache.stats()['textures'] == 1
+
+    def test_disk_cache(self, tmpdir):
+        make = Mock(return_value=np.arange(8, dtype=np.float32))
+
+        pyStim.config.set('StimProgram', 'cache_dir', str(tmpdir))
+        try:
+            first = pyStim.TextureCache.load('key', make)
+            second = pyStim.TextureCache.load('key', make)
+        finally:
+            pyStim.config.remove_option('StimProgram', 'cache_dir')
+
+        assert make.call_count == 1
+        np.testing.assert_array_equal(first, second)
+
+
+class TestLoadImage(object):
+
+    def setup_method(self):
+        pyStim.MyWindow.gamma_mon = None
+
+    def make_image(self, tmpdir):
+        from PIL import Image
+
+        pixels = np.random.RandomState(0).randint(0, 256, (6, 8, 3),
+                                                  dtype=np.uint8)
+        filename = str(tmpdir.join('image.png'))
+        Image.fromarray(pixels).save(filename)
+
+        return filename, pixels
+
+    def test_matches_pixels(self, tmpdir):
+        filename, pixels = self.make_image(tmpdir)
+
+        stim = pyStim.StaticStim(fill_mode='image', image_filename=filename,
+                                 image_size=[8, 8], image_channel='all',
+                                 alpha=0.5)
+        texture = stim.decode_image()
+
+        assert texture.dtype == np.float32
+        assert texture.shape == (6, 8, 4)
+
+        # rotated 180 degrees
+        expected = np.rot90(pixels / 255. * 2 - 1, 2)
+        np.testing.assert_allclose(texture[:, :, :3], expected, atol=1e-6)
+        np.testing.assert_array_equal(texture[:, :, 3], 0.5)
+
+    def test_single_channel(self, tmpdir):
+        filename, pixels = self.make_image(tmpdir)
+
+        stim = pyStim.StaticStim(fill_mode='image', image_filename=filename,
+                                 image_size=[8, 8], image_channel='green')
+        texture = stim.decode_image()
+
+        np.testing.assert_array_equal(texture[:, :, [0, 2]], -1)
+        np.testing.assert_allclose(texture[:, :, 1],
+                                   np.rot90(pixels[:, :, 1] / 255. * 2 - 1, 2),
+                                   atol=1e-6)
+
+    def test_key_on_contents(self, tmpdir):
+        filename, pixels = self.make_image(tmpdir)
+        key = pyStim.TextureCache.hash_file(filename)
+
+        with open(filename, 'ab') as f:
+            f.write(b'0')
+
+        assert pyStim.TextureCache.hash_file(filename) != key
+
+
+class TestIMLImage(object):
+
+    def make_iml(self, tmpdir, shape, sidecar=True, maxi=4095):
+        pixels = np.random.RandomState(0).randint(0, maxi + 1, shape)
+        filename = str(tmpdir.join('image.iml'))
+        pixels.astype('>u2').tofile(filename)
+
+        if sidecar:
+            header = {'width': shape[1], 'height': shape[0]}
+
+            with open(str(tmpdir.join('image.json')), 'w') as f:
+                json.dump(header, f)
+
+        return filename, pixels
+
+    def test_sidecar_shape(self, tmpdir):
+        filename, pixels = self.make_iml(tmpdir, (6, 10))
+        image = pyStim.IMLImage(filename)
+
+        assert image.shape == (6, 10)
+        assert isinstance(image.pixels, np.memmap)
+        np.testing.assert_array_equal(image.pixels, pixels)
+
+    def test_square_from_size(self, tmpdir):
+        filename, pixels = self.make_iml(tmpdir, (8, 8), sidecar=False)
+
+        assert pyStim.IMLImage(filename).shape == (8, 8)
+
+    def test_unknown_shape(self, tmpdir):
+        filename, pixels = self.make_iml(tmpdir, (6, 10), sidecar=False)
+
+        with pytest.raises(IOError):
+            pyStim.IMLImage(filename)
+
+    def test_region_texture(self, tmpdir):
+        filename, pixels = self.make_iml(tmpdir, (6, 10))
+        image = pyStim.IMLImage(filename, rotated=True)
+
+        texture = image.texture(slice(1, 4), slice(2, 7), channel=1,
+                                alpha=0.5)
+
+        expected = np.rot90(pixels, 2)[1:4, 2:7] / 4095.
+        assert texture.dtype == np.float32
+        np.testing.assert_allclose(texture[:, :, 1], expected * 2 - 1,
+                                   atol=1e-6)
+        np.testing.assert_array_equal(texture[:, :, [0, 2]], -1)
+        np.testing.assert_array_equal(texture[:, :, 3], 0.5)
+
+    def test_scaled_by_file_max(self, tmpdir):
+        filename, pixels = self.make_iml(tmpdir, (6, 10), maxi=10000)
+        pixels[0, 0] = 10000
+        pixels.astype('>u2').tofile(filename)
+        image = pyStim.IMLImage(filename)
+
+        # values above 12 bits scale instead of clipping
+        assert image.maxi == 10000
+        np.testing.assert_allclose(image.texture(slice(1, 6)),
+                                   pixels[1:] / 5000. - 1, atol=1e-6)
+
+        gamma = Mock(side_effect=lambda colors: colors)
+        np.testing.assert_allclose(image.texture(gamma=gamma)[:, :, 0],
+                                   pixels / 5000. - 1, atol=1e-6)
+
+    def test_max_cached(self, tmpdir):
+        filename, pixels = self.make_iml(tmpdir, (6, 10), maxi=2000)
+        image = pyStim.IMLImage(filename)
+
+        # scaled by 12 bit range if file max is lower
+        assert image.maxi == 4095
+
+        with patch.object(np.memmap, 'max') as maximum:
+            assert pyStim.IMLImage(filename).maxi == 4095
+
+        maximum.assert_not_called()
+
+    def test_gamma_gray(self, tmpdir):
+        filename, pixels = self.make_iml(tmpdir, (6, 10))
+        image = pyStim.IMLImage(filename)
+        gamma = Mock(side_effect=lambda colors: colors ** 3 *
+                     [1, 0.5, 0.25])
+
+        for i in range(2):
+            texture = image.texture(slice(0, 3), alpha=0.5, gamma=gamma)
+
+        # every value is corrected once, for every gun
+        assert gamma.call_count == 1
+        assert texture.shape == (3, 10, 4)
+        values = pixels[:3, :, np.newaxis] / 4095. * 2 - 1
+        np.testing.assert_allclose(texture[:, :, 0:3],
+                                   values ** 3 * [1, 0.5, 0.25], atol=1e-6)
+        np.testing.assert_array_equal(texture[:, :, 3], 0.5)
+
+        texture = image.texture(channel=1, gamma=gamma)
+        assert gamma.call_count == 2
+        np.testing.assert_allclose(texture[:, :, 0], -1)
+        np.testing.assert_allclose(texture[:, :, 1],
+                                   (pixels / 4095. * 2 - 1) ** 3 * 0.5,
+                                   atol=1e-6)
+
+
+class TestImageSequence(object):
+
+    def setup_method(self):
+        pyStim.GlobalDefaults['frame_rate'] = 60
+        pyStim.MyWindow.gamma_mon = None
+
+    def test_frame_repeat(self, tmpdir):
+        images = np.arange(3 * 2 * 4, dtype=np.uint8).reshape(3, 2, 4)
+        filename = str(tmpdir.join('stack.npy'))
+        np.save(filename, images)
+
+        stim = pyStim.stim_factory(pyStim.StimInfo(
+            'sequence', dict(fill_mode='uniform', image_filename=filename,
+                             image_size=[4, 2], image_channel='green',
+                             frame_repeat=2, duration=0.2), 0))
+        stim.make_stim()
+
+        # first image is shown before the run
+        np.testing.assert_array_equal(stim.stim.data[:, :, 1],
+                                      images[0, ::-1, ::-1])
+        np.testing.assert_array_equal(stim.stim.data[:, :, [0, 2]], 0)
+
+        stim.draw_times()
+        stim.compile(12)
+
+        shown = []
+        for frame in range(12):
+            stim.plan.update(frame)
+            shown.append(stim.stim.data[-1, -1, 1])
+
+        # each image for 2 frames, looping over stack
+        assert shown == [0, 0, 8, 8, 16, 16, 0, 0, 8, 8, 16, 16]
+
+        stim.close()
+        assert stim.frame_bank is None
+
+    def test_first_image_uploaded_once(self, tmpdir):
+        images = np.arange(3 * 2 * 4, dtype=np.uint8).reshape(3, 2, 4)
+        filename = str(tmpdir.join('stack.npy'))
+        np.save(filename, images)
+
+        stim = pyStim.ImageSequenceStim(image_filename=filename,
+                                        image_size=[4, 2], delay=1 / 60.,
+                                        duration=0.1)
+        stim.make_stim()
+        stim.draw_times()
+        stim.compile(8)
+
+        for rep in range(2):
+            if rep > 0:
+                stim.reset()
+
+            # first image is shown before each rep
+            np.testing.assert_array_equal(stim.stim.data[:, :, 0],
+                                          images[0, ::-1, ::-1])
+
+            with patch.object(stim.stim, 'update',
+                              wraps=stim.stim.update) as update:
+                for frame in range(8):
+                    stim.plan.update(frame)
+
+            uploaded = [args[0][-1, -1, 0] for args, _ in
+                        update.call_args_list]
+            assert uploaded == [8, 16, 0, 8, 16]
+
+        stim.close()
+
+    def test_uint16(self, tmpdir):
+        images = np.array([[[0, 257, 32768, 65535]]], dtype=np.uint16)
+        filename = str(tmpdir.join('stack.npy'))
+        np.save(filename, images)
+
+        stim = pyStim.ImageSequenceStim(image_filename=filename,
+                                        image_size=[4, 1])
+        stim.make_stim()
+
+        # scaled, not wrapped
+        np.testing.assert_array_equal(stim.stim.data[0, :, 0],
+                                      [255, 128, 1, 0])
+
+    def test_unsupported_dtype(self, tmpdir):
+        filename = str(tmpdir.join('stack.npy'))
+        np.save(filename, np.zeros((1, 2, 2), dtype=np.int16))
+
+        stim = pyStim.ImageSequenceStim(image_filename=filename)
+
+        with pytest.raises(IOError):
+            stim.load_images()
+
+    def test_float_rgba(self, tmpdir):
+        images = np.zeros((1, 2, 2, 4), dtype=np.float32)
+        images[0, :, :, 0] = 1
+        images[0, 0, 0, 2] = -1
+        images[0, 1, 1, 2] = 0.5
+        filename = str(tmpdir.join('stack.npy'))
+        np.save(filename, images)
+
+        stim = pyStim.ImageSequenceStim(image_filename=filename,
+                                        image_size=[2, 2])
+        stim.make_stim()
+
+        np.testing.assert_array_equal(stim.stim.data[:, :, 0], 255)
+        np.testing.assert_array_equal(stim.stim.data[:, :, 2],
+                                      [[191, 128], [128, 0]])
+
+    def test_directory(self, tmpdir):
+        from PIL import Image
+
+        images = np.random.RandomState(0).randint(0, 256, (3, 2, 4, 3),
+                                                  dtype=np.uint8)
+        directory = tmpdir.mkdir('images')
+        for i, image in enumerate(images):
+            Image.fromarray(image).save(str(directory.join('{}.png'.format(i))))
+        directory.join('notes.txt').write('not an image')
+
+        pyStim.config.set('StimProgram', 'cache_dir', str(tmpdir))
+        try:
+            stim = pyStim.ImageSequenceStim(image_filename=str(directory))
+            stacked = stim.load_images()
+            again = stim.load_images()
+        finally:
+            pyStim.config.remove_option('StimProgram', 'cache_dir')
+
+        assert isinstance(stacked, np.memmap)
+        assert stacked.filename == again.filename
+        np.testing.assert_array_equal(stacked, images)
+
+        Image.fromarray(images[0, :1]).save(str(directory.join('3.png')))
+        with pytest.raises(IOError):
+            pyStim.ImageSequenceStim.stack_images(str(directory))
+
+
+class TestGammaShader(object):
+
+    def test_unsupported_psychopy(self):
+        win = Mock()
+
+        with patch.object(psychopy, '__version__', '2020.2.10',
+                          create=True), \
+                patch.object(pyStim, 'shaders') as shaders:
+            with pytest.raises(RuntimeError):
+                pyStim.MyWindow.install_gamma_shader(win, Mock())
+
+        assert not shaders.compileProgram.called
+
+    def test_replaces_fbo_render(self):
+        win = Mock()
+        prepare = win._prepareFBOrender
+
+        with patch.object(psychopy, '__version__', '1.90.dev3',
+                          create=True), \
+                patch.object(pyStim, 'shaders'), \
+                patch.object(pyStim.MyWindow, 'gen_gamma_lut'), \
+                patch.object(pyStim, 'GL'):
+            pyStim.MyWindow.install_gamma_shader(win, Mock())
+
+        assert win._prepareFBOrender is not prepare
+
+
+class TestTextureQuad(object):
+
+    def test_update_copies(self):
+        data = np.zeros((2, 3, 3), dtype=np.uint8)
+        quad = pyStim.TextureQuad(Mock(), data, size=[30, 20])
+
+        data[:] = 255
+        np.testing.assert_array_equal(quad.data, 0)
+
+        # frame banks hand over their frames
+        quad.update(data, copy=False)
+        assert np.shares_memory(quad.data, data)
+
+        # read only frames are copied before texels are changed
+        data.flags.writeable = False
+        quad.update(data, copy=False)
+        quad.update_texels([0], [1], [[1, 2, 3]])
+        np.testing.assert_array_equal(quad.data[0, 1], [1, 2, 3])
+        np.testing.assert_array_equal(data[0, 1], 255)
+
+    @pytest.mark.parametrize('interpolate', [False, True])
+    def test_draw(self, interpolate):
+        quad = pyStim.TextureQuad(Mock(), np.zeros((2, 3, 3), dtype=np.uint8),
+                                  size=[30, 20], pos=[5, -5], ori=45,
+                                  interpolate=interpolate)
+
+        with patch.object(pyStim, 'GL') as gl:
+            gl.GLuint = ctypes.c_uint
+            quad.draw()
+
+        texture_filter = gl.GL_LINEAR if interpolate else gl.GL_NEAREST
+        gl.glTexParameteri.assert_any_call(gl.GL_TEXTURE_2D,
+                                           gl.GL_TEXTURE_MIN_FILTER,
+                                           texture_filter)
+        gl.glTexParameteri.assert_any_call(gl.GL_TEXTURE_2D,
+                                           gl.GL_TEXTURE_MAG_FILTER,
+                                           texture_filter)
+
+        # rotated clockwise about its center
+        gl.glTranslatef.assert_called_once_with(5, -5, 0)
+        gl.glRotatef.assert_called_once_with(-45, 0, 0, 1)
+        gl.glVertex2f.assert_any_call(-15, -10)
+        gl.glVertex2f.assert_any_call(15, 10)
+        assert gl.glPushMatrix.call_count == gl.glPopMatrix.call_count == 1
+
+
+class TestOffscreenTarget(object):
+
+    def test_restores_window_framebuffer(self):
+        win = Mock(size=[400, 300])
+        target = pyStim.OffscreenTarget(win, [200, 100])
+
+        with patch.object(pyStim, 'GL') as gl:
+            gl.GLuint = ctypes.c_uint
+            gl.glCheckFramebufferStatusEXT.return_value = \
+                gl.GL_FRAMEBUFFER_COMPLETE_EXT
+
+            with target:
+                gl.glViewport.assert_called_with(0, 0, 200, 100)
+                gl.glScalef.assert_called_with(2., 3., 1)
+
+                # modelview is reset too, so window offset and scale don't
+                # apply
+                calls = gl.method_calls
+                names = [name for name, args, kwargs in calls]
+                last = len(names) - 1 - names[::-1].index('glLoadIdentity')
+                assert names[last - 2:last] == ['glMatrixMode',
+                                                'glPushMatrix']
+                assert calls[last - 2][1] == (gl.GL_MODELVIEW,)
+                pixels = target.read()
+
+            # back to window's framebuffer
+            gl.glBindFramebufferEXT.assert_called_with(
+                gl.GL_FRAMEBUFFER_EXT, 0)
+            target.close()
+
+        assert pixels.shape == (100, 200, 3)
+        assert pixels.dtype == np.uint8
+        assert target.fbo_id is None
+
+    def test_incomplete(self):
+        target = pyStim.OffscreenTarget(Mock(size=[400, 300]), [200, 100])
+
+        with patch.object(pyStim, 'GL') as gl:
+            gl.GLuint = ctypes.c_uint
+
+            with pytest.raises(RuntimeError):
+                with target:
+                    pass
+
+
+class TestReadbackRing(object):
+
+    def test_frames_read_late(self):
+        win = Mock(size=[4, 2], useFBO=False)
+        ring = pyStim.ReadbackRing(win, win.size, depth=3)
+
+        screens = [np.random.RandomState(i).randint(0, 256, (2, 4, 4),
+                                                     dtype=np.uint8)
+                   for i in range(5)]
+        buffers = {}
+        state = dict(bound=0, frame=0)
+
+        def gen_buffers(n, ids):
+            for i in range(n):
+                ids[i] = i + 1
+
+        def bind(target, buffer_id):
+            state['bound'] = buffer_id
+
+        def read_pixels(*args):
+            buffers[state['bound']] = screens[state['frame']].copy()
+
+        with patch.object(pyStim, 'GL') as gl:
+            gl.GLuint = ctypes.c_uint
+            gl.glGenBuffers.side_effect = gen_buffers
+            gl.glBindBuffer.side_effect = bind
+            gl.glReadPixels.side_effect = read_pixels
+            gl.glMapBuffer.side_effect = \
+                lambda *args: buffers[state['bound']].ctypes.data
+
+            read = []
+            for frame in range(5):
+                state['frame'] = frame
+                read.append(ring.read())
+            read.extend(ring.flush())
+            ring.close()
+
+            assert gl.glGenBuffers.call_count == 1
+            gl.glDeleteBuffers.assert_called_once()
+
+        # mapped 2 reads later
+        assert read[:2] == [None, None]
+        assert len(read) == 7
+        for frame, pixels in zip(screens, read[2:]):
+            np.testing.assert_array_equal(pixels, frame[::-1, :, :3])
+
+    def test_map_failed(self):
+        ring = pyStim.ReadbackRing(Mock(size=[4, 2]), [4, 2], depth=2)
+
+        with patch.object(pyStim, 'GL') as gl:
+            gl.GLuint = ctypes.c_uint
+            gl.glMapBuffer.return_value = None
+
+            ring.read()
+            with pytest.raises(RuntimeError):
+                ring.read()
+
+            gl.glUnmapBuffer.assert_not_called()
+            gl.glBindBuffer.assert_called_with(gl.GL_PIXEL_PACK_BUFFER, 0)
+
+
+class TestBoard(object):
+
+    def test_random_index_matches_randint(self):
+        stim = pyStim.board_texture_class(pyStim.StaticStim,
+                                          fill_mode='checkerboard',
+                                          check_type='random', fill_seed=3)
+        index = stim.gen_random_index(5000)
+
+        rand = Random()
+        rand.seed(3)
+        expected = [rand.randint(0, 1) for i in range(5000)]
+
+        np.testing.assert_array_equal(index, expected)
+        assert stim.fill_random.getstate() == rand.getstate()
+
+    def test_make_stim_board(self):
+        pyStim.GlobalDefaults['background'] = [0., 0., 0.]
+
+        stim = pyStim.board_texture_class(pyStim.StaticStim,
+                                          fill_mode='checkerboard',
+                                          check_type='board', num_check=4,
+                                          check_size=[10, 20],
+                                          contrast_channel='green')
+        with patch.object(pyStim.visual, 'ElementArrayStim') as board:
+            stim.make_stim()
+
+        xys = board.call_args[1]['xys']
+        np.testing.assert_array_equal(xys[:5], [[-20, -40], [-10, -40],
+                                                [0, -40], [10, -40],
+                                                [-20, -20]])
+        np.testing.assert_array_equal(stim.colors[:5, 1],
+                                      [1, -1, 1, -1, -1])
+
+    def test_texture_backend(self):
+        pyStim.GlobalDefaults['background'] = [0., 0., 0.]
+        pyStim.GlobalDefaults['board_backend'] = 'texture'
+
+        try:
+            stim = pyStim.board_texture_class(pyStim.StaticStim,
+                                              fill_mode='checkerboard',
+                                              check_type='board',
+                                              num_check=4,
+                                              check_size=[10, 20],
+                                              contrast_channel='green')
+            stim.make_stim()
+        finally:
+            pyStim.GlobalDefaults['board_backend'] = 'elements'
+
+        assert isinstance(stim.stim, pyStim.TextureQuad)
+        assert stim.stim.data.shape == (4, 4, 3)
+        np.testing.assert_array_equal(stim.stim.data[0, :, 1],
+                                      [255, 0, 255, 0])
+        np.testing.assert_array_equal(stim.stim.size, [40, 80])
+
+        # quad covers same area as elements centered on their coordinates
+        np.testing.assert_array_equal(stim.stim.pos, [-5, -10])
+        stim.set_pos(100, 50)
+        np.testing.assert_array_equal(stim.stim.pos, [95, 40])
+        np.testing.assert_array_equal(stim.get_pos(), [100, 50])
+
+    def test_shader_backend(self):
+        pyStim.GlobalDefaults['background'] = [0., 0., 0.]
+        pyStim.GlobalDefaults['board_backend'] = 'shader'
+        pyStim.MyWindow.gamma_mon = None
+
+        try:
+            stim = pyStim.board_texture_class(pyStim.StaticStim,
+                                              fill_mode='checkerboard',
+                                              check_type='binary noise',
+                                              num_check=4, fill_seed=7,
+                                              check_size=[10, 20],
+                                              contrast_channel='green',
+                                              duration=1)
+            stim.make_stim()
+        finally:
+            pyStim.GlobalDefaults['board_backend'] = 'elements'
+
+        assert isinstance(stim.stim, pyStim.NoiseQuad)
+        assert stim.stim.binary
+        assert stim.stim.seed == 7
+        assert stim.stim.stim == stim.number
+        np.testing.assert_array_equal(stim.stim.low, [-1, stim.low, -1])
+        np.testing.assert_array_equal(stim.stim.high, [-1, stim.high, -1])
+        np.testing.assert_array_equal(stim.stim.pos, [-5, -10])
+
+        # only the frame number changes, nothing is uploaded
+        stim.draw_times()
+        stim.compile(10)
+        assert stim.frame_bank is None
+
+        stim.gen_timing(3)
+        assert stim.stim.frame == 3
+
+    def test_binary_noise_frames(self):
+        pyStim.GlobalDefaults['background'] = [0., 0., 0.]
+        pyStim.MyWindow.gamma_mon = None
+
+        stim = pyStim.board_texture_class(pyStim.StaticStim,
+                                          fill_mode='checkerboard',
+                                          check_type='binary noise',
+                                          num_check=4, fill_seed=5,
+                                          contrast_channel='green',
+                                          delay=0.05, duration=1)
+        with patch.object(pyStim.visual, 'ElementArrayStim'):
+            stim.make_stim()
+        stim.draw_times()
+        stim.compile(10)
+
+        # frames match shader noise of the drawn frames
+        for frame in range(stim.start_stim, stim.start_stim + 4):
+            stim.gen_timing(frame)
+            colors = stim.stim.setColors.call_args[0][0]
+            np.testing.assert_array_equal(
+                colors,
+                stim_noise.noise_frame(5, stim.number, frame, 16,
+                                       [-1, stim.low, -1],
+                                       [-1, stim.high, -1], binary=True))
+
+        stim.close()
+
+    def test_binary_noise_per_stim(self):
+        levels = []
+        for number in [1, 2]:
+            stim = pyStim.board_texture_class(pyStim.StaticStim,
+                                              fill_mode='checkerboard',
+                                              check_type='binary noise',
+                                              num_check=8, fill_seed=5)
+            stim.number = number
+            with patch.object(pyStim.visual, 'ElementArrayStim'):
+                stim.make_stim()
+            levels.append(stim.gen_noise_levels(3))
+
+        # same seed, but each stim has its own noise
+        assert not np.array_equal(*levels)
+
+    def test_sparse_noise(self, tmpdir):
+        pyStim.GlobalDefaults['background'] = [0., 0., 0.]
+        pyStim.MyWindow.gamma_mon = None
+
+        stim = pyStim.board_texture_class(pyStim.StaticStim,
+                                          fill_mode='checkerboard',
+                                          check_type='sparse noise',
+                                          num_check=8, num_sparse=3,
+                                          fill_seed=2,
+                                          contrast_channel='green',
+                                          duration=1)
+        with patch.object(pyStim.visual, 'ElementArrayStim'):
+            stim.make_stim()
+        stim.draw_times()
+        stim.compile(10)
+        stim.record(str(tmpdir), 'time')
+
+        mid = (stim.low + stim.high) / 2.
+        np.testing.assert_array_equal(stim.colors[:, 1], mid)
+
+        for frame in range(3):
+            stim.gen_timing(frame)
+
+            # only this frame's checks differ from the mean
+            changed = np.flatnonzero(stim.colors[:, 1] != mid)
+            np.testing.assert_array_equal(changed,
+                                          np.sort(stim.sparse_checks))
+        stim.close()
+
+        log = pyStim.SparseRecorder.read(
+            str(tmpdir.join('Sparselog_time_0.npz')))
+        np.testing.assert_array_equal(log['frame'], np.repeat(range(3), 3))
+        np.testing.assert_array_equal(log['check'][-3:], stim.sparse_checks)
+        np.testing.assert_array_equal(
+            stim.colors[log['check'][-3:], 1],
+            np.where(log['color'][-3:], stim.high, stim.low))
+
+        stim.reset()
+        np.testing.assert_array_equal(stim.colors[:, 1], mid)
+
+    def test_sparse_noise_elements(self):
+        pyStim.GlobalDefaults['background'] = [0., 0., 0.]
+        pyStim.MyWindow.gamma_mon = None
+
+        stim = pyStim.board_texture_class(pyStim.StaticStim,
+                                          fill_mode='checkerboard',
+                                          check_type='sparse noise',
+                                          num_check=4, num_sparse=2,
+                                          contrast_channel='green',
+                                          duration=1)
+        with patch.object(pyStim.visual, 'ElementArrayStim'):
+            stim.make_stim()
+        stim.draw_times()
+        stim.compile(10)
+
+        # per vertex colors, as drawn by ElementArrayStim
+        rgbas = np.ones((16, 4, 4))
+        rgbas[:, :, 0:3] = (stim.colors[:, np.newaxis] + 1) / 2.
+        stim.stim._RGBAs = rgbas
+        stim.stim._needColorUpdate = False
+
+        for frame in range(2):
+            stim.gen_timing(frame)
+
+        assert not stim.stim.setColors.called
+        np.testing.assert_array_equal(rgbas[:, :, 0:3],
+                                      np.repeat((stim.colors[:, np.newaxis] +
+                                                 1) / 2., 4, axis=1))
+        np.testing.assert_array_equal(rgbas[:, :, 3], 1)
+
+        # all colors are set if psychopy rebuilds them anyway
+        stim.stim._needColorUpdate = True
+        stim.gen_timing(2)
+        np.testing.assert_array_equal(stim.stim.setColors.call_args[0][0],
+                                      stim.colors)
+
+    def test_sparse_noise_texels(self):
+        pyStim.GlobalDefaults['background'] = [0., 0., 0.]
+        pyStim.GlobalDefaults['board_backend'] = 'texture'
+        pyStim.MyWindow.gamma_mon = None
+
+        try:
+            stim = pyStim.board_texture_class(pyStim.StaticStim,
+                                              fill_mode='checkerboard',
+                                              check_type='sparse noise',
+                                              num_check=8, num_sparse=2,
+                                              contrast_channel='green',
+                                              duration=1)
+            stim.make_stim()
+        finally:
+            pyStim.GlobalDefaults['board_backend'] = 'elements'
+
+        # pretend first frame was uploaded
+        stim.stim.data = None
+        stim.draw_times()
+        stim.compile(10)
+        stim.gen_timing(0)
+
+        assert len(stim.stim.texels) == 2
+        for row, column, value in stim.stim.texels:
+            assert row * 8 + column in stim.sparse_checks
+            assert value[1] in [0, 255]
+
+
+class TestFrameBank(object):
+
+    def test_frames_in_order(self):
+        bank = pyStim.FrameBank(iter(range(100)), size=4)
+
+        assert [bank.get() for i in range(100)] == list(range(100))
+        assert bank.get() is None
+        bank.stop()
+
+    def test_stop(self):
+        bank = pyStim.FrameBank(itertools.count(), size=2)
+        bank.stop()
+
+        assert not bank.thread.is_alive()
+        assert bank.get() is None
+
+    def test_producer_raises(self):
+        def frames():
+            yield 0
+            yield 1
+            raise ValueError('bad frame')
+
+        bank = pyStim.FrameBank(frames(), size=4)
+
+        assert [bank.get(), bank.get()] == [0, 1]
+        with pytest.raises(ValueError):
+            bank.get()
+
+        # ended, rather than waiting forever
+        assert bank.get() is None
+        assert not bank.thread.is_alive()
+
+    def test_producer_raises_on_underrun(self):
+        started = threading.Event()
+
+        def frames():
+            started.wait()
+            raise IOError('no decoder')
+            yield
+
+        bank = pyStim.FrameBank(frames(), size=4)
+        assert bank.get(block=False) is None
+
+        started.set()
+        with pytest.raises(IOError):
+            bank.get()
+
+    def test_noisy_noise_frames(self):
+        pyStim.GlobalDefaults['background'] = [0., 0., 0.]
+        pyStim.MyWindow.gamma_mon = None
+
+        stim = pyStim.board_texture_class(pyStim.StaticStim,
+                                          fill_mode='checkerboard',
+                                          check_type='noisy noise',
+                                          num_check=4, fill_seed=5,
+                                          contrast_channel='green',
+                                          duration=1)
+        with patch.object(pyStim.visual, 'ElementArrayStim'):
+            stim.make_stim()
+        stim.draw_times()
+        stim.compile(10)
+
+        # each frame is drawn from its own stream
+        for frame in range(4):
+            stim.gen_timing(frame)
+            colors = stim.stim.setColors.call_args[0][0]
+            np.testing.assert_array_equal(
+                colors[:, 1],
+                stim_noise.stream(5, 0, frame).uniform(low=stim.low,
+                                                  high=stim.high, size=16))
+
+        stim.close()
+        assert stim.frame_bank is None
+
+    def test_noise_independent_of_other_stims(self):
+        pyStim.GlobalDefaults['background'] = [0., 0., 0.]
+        pyStim.MyWindow.gamma_mon = None
+
+        stims = [pyStim.stim_factory(pyStim.StimInfo(
+            'static', dict(fill_mode='checkerboard', check_type='noise',
+                           num_check=4, fill_seed=5), number))
+            for number in range(2)]
+
+        with patch.object(pyStim.visual, 'ElementArrayStim'):
+            for stim in stims:
+                stim.make_stim()
+
+        assert [stim.number for stim in stims] == [0, 1]
+        assert not np.array_equal(stims[0].colors, stims[1].colors)
+
+        # unaffected by global numpy state
+        np.random.seed(0)
+        np.testing.assert_array_equal(stims[1].gen_noise(0), stims[1].colors)
+
+
+class TestMovieDecoder(object):
+
+    def test_probe(self):
+        output = b'{"streams": [{"width": 4, "height": 2, ' \
+                 b'"avg_frame_rate": "30000/1001"}]}'
+        with patch.object(pyStim.subprocess, 'check_output',
+                          return_value=output):
+            width, height, fps = pyStim.MovieDecoder.probe('movie.mp4')
+
+        assert (width, height) == (4, 2)
+        assert fps == pytest.approx(29.97, abs=0.01)
+
+        with patch.object(pyStim.subprocess, 'check_output',
+                          side_effect=OSError):
+            with pytest.raises(IOError):
+                pyStim.MovieDecoder.probe('movie.mp4')
+
+    def test_frames_gamma_corrected(self):
+        frames = np.arange(2 * 2 * 4 * 3, dtype=np.uint8).reshape(2, 2, 4, 3)
+        lut = np.array([255 - np.arange(256)] * 3, dtype=np.uint8).T
+
+        process = Mock()
+        process.stdout.read.side_effect = [frames[0].tobytes(),
+                                           frames[1].tobytes(), b'']
+
+        with patch.object(pyStim.MovieDecoder, 'probe',
+                          return_value=(4, 2, 30.)):
+            decoder = pyStim.MovieDecoder('movie.mp4', lut=lut)
+
+        with patch.object(pyStim.subprocess, 'Popen', return_value=process):
+            decoded = list(decoder)
+
+        np.testing.assert_array_equal(decoded, 255 - frames)
+        process.kill.assert_called_once_with()
+
+    def test_frame_locked(self):
+        pyStim.GlobalDefaults['frame_rate'] = 60
+        pyStim.MyWindow.gamma_mon = None
+
+        stim = pyStim.movie_stim_class(pyStim.StaticStim, fill_mode='movie',
+                                       movie_filename='movie.mp4',
+                                       duration=1)
+
+        frames = [np.full((2, 4, 3), i, dtype=np.uint8) for i in range(10)]
+
+        try:
+            pyStim.GlobalDefaults['movie_backend'] = 'ffmpeg'
+            with patch.object(pyStim.MovieDecoder, 'probe',
+                              return_value=(4, 2, 20.)), \
+                    patch.object(pyStim.MovieDecoder, '__iter__',
+                                 return_value=iter(frames)):
+                stim.make_stim()
+                stim.draw_times()
+                stim.compile(60)
+
+                assert stim.decoder.display_frames() == 3
+
+                shown = []
+                for frame in range(15):
+                    stim.plan.update(frame)
+                    shown.append(stim.stim.data[0, 0, 0])
+
+            # each movie frame is shown for 3 display frames
+            assert shown == list(np.repeat(np.arange(5), 3))
+
+            stim.close()
+            assert stim.frame_bank is None
+        finally:
+            pyStim.GlobalDefaults['movie_backend'] = 'psychopy'
+
+    @pytest.mark.parametrize('backend', ['ffmpeg', 'cached'])
+    def test_animation_loop(self, tmpdir, backend):
+        pyStim.GlobalDefaults['frame_rate'] = 60
+        pyStim.GlobalDefaults['pix_per_micron'] = 1
+        pyStim.GlobalDefaults['framepack'] = False
+        pyStim.MyWindow.gamma_mon = None
+        pyStim.MyWindow.should_break = False
+
+        movie = tmpdir.join('movie.mp4')
+        movie.write('movie')
+        stim = pyStim.movie_stim_class(pyStim.StaticStim, fill_mode='movie',
+                                       movie_filename=str(movie),
+                                       movie_size=[4, 2], duration=0.1)
+
+        frames = [np.full((2, 4, 3), i, dtype=np.uint8) for i in range(10)]
+
+        pyStim.config.set('StimProgram', 'cache_dir', str(tmpdir))
+        try:
+            pyStim.GlobalDefaults['movie_backend'] = backend
+            with patch.object(pyStim.MovieDecoder, 'probe',
+                              return_value=(4, 2, 60.)), \
+                    patch.object(pyStim.MovieDecoder, '__iter__',
+                                 side_effect=lambda: iter(frames)), \
+                    patch.object(pyStim.MyWindow, 'win', Mock()), \
+                    patch.object(pyStim.MyWindow, 'flip'), \
+                    patch.object(pyStim, 'core'), \
+                    patch.object(pyStim, 'event'), \
+                    patch.object(pyStim, 'GL') as gl:
+                gl.GLuint = ctypes.c_uint
+                stim.make_stim()
+                stim.stim.update = Mock(side_effect=stim.stim.update)
+                num_frames = stim.draw_times()
+                triggers = pyStim.compile_plan([stim], num_frames)
+
+                # every rep plays through, and is rewound for the next
+                for rep in range(2):
+                    if rep > 0:
+                        stim.reset()
+
+                    reps = pyStim.animation_loop([stim], num_frames,
+                                                 triggers, None)[0]
+
+                    assert reps == 1
+                    assert stim.frame_bank is None
+                    assert stim.stim.update.call_args[0][0][0, 0, 0] == \
+                        num_frames - 1
+
+                stim.close()
+        finally:
+            pyStim.GlobalDefaults['movie_backend'] = 'psychopy'
+            pyStim.config.remove_option('StimProgram', 'cache_dir')
+
+    def test_cached(self, tmpdir):
+        movie = tmpdir.join('movie.mp4')
+        movie.write('movie')
+        frames = [np.full((2, 4, 3), i, dtype=np.uint8) for i in range(3)]
+
+        pyStim.config.set('StimProgram', 'cache_dir', str(tmpdir))
+        try:
+            with patch.object(pyStim.MovieDecoder, 'probe',
+                              return_value=(8, 4, 30.)), \
+                    patch.object(pyStim.MovieDecoder, '__iter__',
+                                 side_effect=lambda: iter(frames)) as decode, \
+                    patch.object(pyStim.TextureCache, 'hash_file') as hash_file:
+                first = pyStim.CachedMovie(str(movie), (4.2, 1.9))
+                second = pyStim.CachedMovie(str(movie), (4, 2))
+                other = pyStim.CachedMovie(str(movie), (4, 2), lut=np.zeros(
+                    (256, 3), dtype=np.uint8))
+
+                # changed movies are decoded again
+                os.utime(str(movie), (0, 0))
+                changed = pyStim.CachedMovie(str(movie), (4, 2))
+        finally:
+            pyStim.config.remove_option('StimProgram', 'cache_dir')
+
+        # decoded once per size, gamma and version of movie, without reading
+        # the movie to find cached frames
+        assert decode.call_count == 3
+        hash_file.assert_not_called()
+        assert (second.width, second.height, second.fps) == (4, 2, 30.)
+        np.testing.assert_array_equal(first.frames, frames)
+        np.testing.assert_array_equal(second.frames, frames)
+
+        # loops over frames
+        looped = list(itertools.islice(second, 5))
+        np.testing.assert_array_equal(looped, [frames[i] for i in
+                                               [0, 1, 2, 0, 1]])
+
+
+class TestCaptureWriter(object):
+
+    def make_process(self):
+        process = Mock()
+        process.returncode = 0
+        process.stderr.read.return_value = b''
+
+        written = []
+        process.stdin.write.side_effect = lambda data: written.append(
+            bytes(data))
+
+        return process, written
+
+    def test_single_process(self, tmpdir):
+        process, written = self.make_process()
+        frames = np.random.RandomState(0).randint(0, 256, (3, 2, 4, 3),
+                                                  dtype=np.uint8)
+
+        with patch.object(pyStim.subprocess, 'Popen',
+                          return_value=process) as popen:
+            writer = pyStim.CaptureWriter(str(tmpdir), 'time', (4, 2), 60)
+            for frame in frames:
+                writer.add(frame)
+            writer.close()
+
+        # colour and gray movies from one process
+        args = popen.call_args[0][0]
+        assert popen.call_count == 1
+        assert args[args.index('-s') + 1] == '4x2'
+        assert writer.filenames == [str(tmpdir.join('capture_videotime.mpg')),
+                                    str(tmpdir.join(
+                                        'capture_videotime_gray.mpg'))]
+        assert all(filename in args for filename in writer.filenames)
+
+        assert b''.join(written) == frames.tobytes()
+        process.stdin.close.assert_called_once_with()
+        process.wait.assert_called_once_with()
+
+    def test_gamma_corrected(self, tmpdir):
+        process, written = self.make_process()
+        gamma = Mock()
+        gamma.correct.side_effect = lambda grid, i: grid * [1, 0.5, 2][i]
+        frame = np.array([[[0, 128, 255], [255, 64, 191]]], dtype=np.uint8)
+
+        with patch.object(pyStim.subprocess, 'Popen', return_value=process):
+            writer = pyStim.CaptureWriter(str(tmpdir), 'time', (2, 1), 60,
+                                          gamma=gamma)
+            writer.add(frame)
+            writer.close()
+
+        # as corrected on flip, by 8 bit value of each channel
+        values = frame / 255. * 2 - 1
+        expected = np.rint((np.clip(values * [1, 0.5, 2], -1, 1) + 1) / 2 *
+                           255)
+        assert written[0] == expected.astype(np.uint8).tobytes()
+
+    def test_ffmpeg_exits(self, tmpdir):
+        process, written = self.make_process()
+        process.stdin.write.side_effect = BrokenPipeError
+        process.returncode = 1
+
+        with patch.object(pyStim.subprocess, 'Popen', return_value=process):
+            writer = pyStim.CaptureWriter(str(tmpdir), 'time', (4, 2), 60,
+                                          queue_size=1)
+            # doesn't wait on a full queue
+            for i in range(5):
+                writer.add(np.zeros((2, 4, 3), dtype=np.uint8))
+            writer.close()
+
+        assert writer.failed
+        assert process.stdin.write.call_count == 1
+
+
+class TestNoiseRecorder(object):
+
+    def test_binary_frames_read_back(self, tmpdir):
+        filename = str(tmpdir.join('noise.npz'))
+
+        def gen_levels(frame):
+            return stim_noise.noise_levels(1, 0, frame, 100,
+                                           binary=True)[:, [1]].T
+
+        recorder = pyStim.NoiseRecorder(filename, gen_levels, num_checks=100,
+                                        binary=True, chunk_size=4)
+        for frame in range(10):
+            recorder.add(frame)
+        recorder.close()
+
+        frames, levels = pyStim.NoiseRecorder.read(filename, 3, 7)
+
+        np.testing.assert_array_equal(frames, range(3, 7))
+        assert levels.shape == (4, 1, 100)
+        for frame, level in zip(frames, levels):
+            np.testing.assert_array_equal(level, gen_levels(frame))
+
+    def test_board_uniform_frames(self, tmpdir):
+        pyStim.GlobalDefaults['background'] = [0., 0., 0.]
+        pyStim.MyWindow.gamma_mon = None
+
+        stim = pyStim.board_texture_class(pyStim.StaticStim,
+                                          fill_mode='checkerboard',
+                                          check_type='noisy noise',
+                                          num_check=4, fill_seed=5,
+                                          contrast_channel='green',
+                                          duration=1)
+        with patch.object(pyStim.visual, 'ElementArrayStim'):
+            stim.make_stim()
+        stim.draw_times()
+        stim.compile(10)
+        stim.record(str(tmpdir), 'time')
+
+        for frame in range(3):
+            stim.gen_timing(frame)
+        stim.close()
+
+        frames, levels = pyStim.NoiseRecorder.read(
+            str(tmpdir.join('Noiselog_time_0.npz')))
+        np.testing.assert_array_equal(frames, range(3))
+
+        # quantized levels of displayed colors
+        colors = stim.stim.setColors.call_args[0][0][:, 1]
+        expected = (colors - stim.low) / (stim.high - stim.low)
+        np.testing.assert_allclose(levels[-1, 0] / 256., expected,
+                                   atol=1 / 256.)
+
+    def test_sparse_read_back(self, tmpdir):
+        filename = str(tmpdir.join('sparse.npz'))
+
+        def gen_flashes(frame):
+            return [frame, frame + 1], [frame % 2, 1]
+
+        recorder = pyStim.SparseRecorder(filename, gen_flashes, num_check=4,
+                                         chunk_size=3)
+        for frame in range(8):
+            recorder.add(frame)
+        recorder.close()
+
+        log = pyStim.SparseRecorder.read(filename, 2, 5)
+
+        np.testing.assert_array_equal(log['frame'], [2, 2, 3, 3, 4, 4])
+        np.testing.assert_array_equal(log['check'], [2, 3, 3, 4, 4, 5])
+        np.testing.assert_array_equal(log['color'], [0, 1, 1, 1, 0, 1])
+        assert log['check'].dtype == np.int32
+        assert log['color'].dtype == np.uint8
+
+        with np.load(filename) as archive:
+            assert int(archive['num_check']) == 4
+
+        assert pyStim.SparseRecorder.read(filename, 10)['frame'].size == 0
+
+
 class TestGenTiming(object):
 
     # TODO: test at other background levels
@@ -1448,6 +2636,70 @@ class TestGenTiming(object):
         stim.gen_texture()
 
 
+class TestGenColorSchedule(object):
+
+    def test_step_no_schedule(self):
+        stim = pyStim.StaticStim(timing='step')
+        stim.draw_times()
+
+        assert stim.color_schedule is None
+
+    def test_schedule_shape(self):
+        pyStim.GlobalDefaults['background'] = [0., 0., 0.]
+        pyStim.GlobalDefaults['frame_rate'] = 60
+
+        stim = pyStim.StaticStim(fill_mode='uniform',
+                                 contrast_channel='red',
+                                 timing='sawtooth',
+                                 alpha=0.5,
+                                 duration=1)
+        stim.draw_times()
+
+        assert stim.color_schedule.shape == (60, 4)
+        assert stim.color_schedule.dtype == np.float32
+        np.testing.assert_array_equal(stim.color_schedule[:, 3], 0.5)
+
+    def test_schedule_matches_out_of_range(self):
+        pyStim.GlobalDefaults['background'] = [0., 0., 0.]
+        pyStim.GlobalDefaults['frame_rate'] = 60
+
+        stim = pyStim.StaticStim(fill_mode='uniform',
+                                 contrast_channel='all',
+                                 timing='sine',
+                                 duration=1,
+                                 force_stop=2)
+        stim.draw_times()
+        stim.stim = Mock()
+        stim.stim.tex = stim.gen_texture()
+
+        # past the draw duration, colors are calculated on the fly
+        stim.gen_timing(75)
+        np.testing.assert_almost_equal(stim.stim.tex[0, 0],
+                                       stim.color_schedule[15],
+                                       decimal=6)
+
+
+    def test_gpu_gamma_sets_color(self):
+        pyStim.GlobalDefaults['background'] = [0., 0., 0.]
+        pyStim.GlobalDefaults['frame_rate'] = 60
+
+        stim = pyStim.StaticStim(fill_mode='uniform',
+                                 contrast_channel='all',
+                                 timing='linear',
+                                 duration=1)
+        stim.draw_times()
+        stim.stim = Mock()
+
+        pyStim.MyWindow.gamma_lut = Mock()
+        try:
+            stim.gen_timing(30)
+        finally:
+            pyStim.MyWindow.gamma_lut = None
+
+        color = stim.stim.setColor.call_args[0][0]
+        np.testing.assert_array_equal(color, stim.color_schedule[30, 0:3])
+
+
 class TestGenPhase(object):
 
     def test_no_phase(self):
@@ -1471,6 +2723,407 @@ class TestGenPhase(object):
                                       np.array([1., 2.]))
 
 
+class TestCompile(object):
+
+    def test_compile_triggers(self):
+        pyStim.GlobalDefaults['frame_rate'] = 100
+        del pyStim.MyWindow.frame_trigger_list[:-1]
+
+        stim = pyStim.StaticStim(delay=1, duration=2, trigger=True)
+        num_frames = stim.draw_times()
+        triggers = pyStim.compile_plan([stim], num_frames)
+
+        assert np.flatnonzero(triggers).tolist() == [100]
+        np.testing.assert_array_equal(np.flatnonzero(stim.plan.draw),
+                                      np.arange(100, 300))
+        del pyStim.MyWindow.frame_trigger_list[:-1]
+
+    def test_compile_phase(self):
+        pyStim.GlobalDefaults['frame_rate'] = 60
+
+        stim = pyStim.StaticStim(phase=[0.5, 0], phase_speed=[60, 120],
+                                 duration=1)
+        stim.draw_times()
+        stim.compile(60)
+
+        stim.stim = Mock()
+        stim.stim.phase = np.array([0.5, 0.])
+        for frame in range(3):
+            stim.gen_phase()
+
+        np.testing.assert_allclose(stim.plan.phase[2], stim.stim.phase)
+
+    def test_compile_color(self):
+        pyStim.GlobalDefaults['frame_rate'] = 60
+
+        stim = pyStim.StaticStim(timing='sine', frequency=1, duration=1)
+        stim.draw_times()
+        stim.compile(60)
+
+        np.testing.assert_array_equal(stim.plan.color,
+                                      stim.color_schedule)
+
+    def test_compile_random_movement(self):
+        pyStim.GlobalDefaults['frame_rate'] = 60
+
+        stim = pyStim.RandomlyMovingStim(duration=1, speed=100,
+                                         travel_distance=50, move_seed=3)
+        stim.stim = Mock()
+        stim.stim.pos = np.array([0., 0.])
+        num_frames = stim.draw_times()
+        stim.compile(num_frames)
+
+        # whole walk generated up front, new direction whenever travel
+        # distance is reached
+        assert len(stim.x_array) >= 60
+        assert stim.log[1] == [0] + list(range(stim.num_frames, 60,
+                                               stim.num_frames))
+        assert len(stim.log[0]) == len(stim.log[1]) == len(stim.log[2])
+        np.testing.assert_array_equal(stim.plan.pos[:60, 0],
+                                      stim.x_array[:60])
+
+        # segments continue from end of last
+        seg = stim.num_frames
+        np.testing.assert_allclose(stim.log[2][1],
+                                   [stim.x_array[seg - 1],
+                                    stim.y_array[seg - 1]])
+
+        rand = Random(3)
+        assert stim.log[0] == [rand.randint(0, 360) for i in
+                               range(len(stim.log[0]))]
+
+    def test_compile_movement(self):
+        pyStim.GlobalDefaults['frame_rate'] = 60
+        pyStim.GlobalDefaults['pix_per_micron'] = 1
+        pyStim.GlobalDefaults['display_size'] = [100, 100]
+
+        stim = pyStim.MovingStim(delay=0.1, speed=600, start_radius=100,
+                                 num_dirs=2, start_dir=90, move_delay=0.05,
+                                 ori_with_dir=True, force_stop=1)
+        stim.stim = Mock()
+        stim.stim.pos = np.array([0., 0.])
+        stim.stim.size = [10, 10]
+        num_frames = stim.draw_times()
+        stim.compile(num_frames)
+
+        drawn = np.flatnonzero(stim.plan.draw)
+        assert stim.num_frames == 23
+        assert drawn.tolist() == list(range(6, 60))
+
+        # sweeps repeat once every direction has been drawn
+        positions = stim.sweeps.reshape(-1, 2)
+        np.testing.assert_array_equal(stim.plan.pos[6:52], positions)
+        np.testing.assert_array_equal(stim.plan.pos[52:60], positions[:8])
+        np.testing.assert_allclose(stim.plan.pos[[6, 29]],
+                                   [[100, 0], [-100, 0]], atol=1e-4)
+
+        np.testing.assert_array_equal(
+            np.flatnonzero(~np.isnan(stim.plan.ori)), [6, 29, 52])
+        np.testing.assert_array_equal(stim.plan.ori[[6, 29, 52]],
+                                      [90, 270, 90])
+
+        assert stim.log[0] == [270, 90, 270]
+        assert stim.log[1] == [0, 29, 52]
+        np.testing.assert_allclose(stim.log[2][1], stim.gen_off_pos())
+
+
+class TestGammaValues(object):
+
+    @pytest.fixture
+    def gamma(self):
+        from scipy import interpolate
+
+        x = np.linspace(0, 1, 11)
+        splines = [(interpolate.InterpolatedUnivariateSpline(x, x ** p), 0.5,
+                    0.5) for p in (2.2, 2, 1.8)]
+        return GammaCorrection.GammaValues(*splines)
+
+    def test_lut_matches_spline(self, gamma):
+        color = np.linspace(-1, 1, 1001)
+
+        for i, (spline, slope, intercept) in enumerate(
+                [(gamma.r_spline, gamma.r_slope, gamma.r_int),
+                 (gamma.g_spline, gamma.g_slope, gamma.g_int),
+                 (gamma.b_spline, gamma.b_slope, gamma.b_int)]):
+            np.testing.assert_allclose(gamma.correct(color, i),
+                                       spline(color * slope + intercept),
+                                       atol=1e-4)
+
+    def test_out_of_range_clipped(self, gamma):
+        np.testing.assert_allclose(gamma.correct([-2, 2], 0),
+                                   gamma.correct([-1, 1], 0))
+
+    def test_in_place(self, gamma):
+        texture = np.random.RandomState(0).uniform(
+            -1, 1, (8, 6, 4)).astype(np.float32)
+        expected = gamma(texture)
+
+        adj_texture = gamma(texture, copy=False)
+
+        assert adj_texture is texture
+        np.testing.assert_array_equal(texture, expected)
+
+    def test_copy(self, gamma):
+        texture = np.random.RandomState(0).uniform(
+            -1, 1, (8, 6, 4)).astype(np.float32)
+        original = texture.copy()
+
+        adj_texture = gamma(texture)
+
+        assert adj_texture is not texture
+        np.testing.assert_array_equal(texture, original)
+        # alpha is not corrected
+        np.testing.assert_array_equal(adj_texture[..., 3], original[..., 3])
+
+    def test_chunked(self, gamma):
+        texture = np.random.RandomState(0).uniform(
+            -1, 1, (50, 7, 4)).astype(np.float32)
+        expected = gamma(texture)
+        expected_r = gamma.correct(texture[..., 0], 0)
+
+        # small chunks to go through the thread pool
+        gamma.chunk_size = 16
+
+        np.testing.assert_array_equal(gamma(texture), expected)
+        np.testing.assert_array_equal(gamma.correct(texture[..., 0], 0),
+                                      expected_r)
+
+    def test_old_pickle(self, gamma):
+        # gamma tables pickled before lookup tables existed only have splines
+        old = GammaCorrection.GammaValues.__new__(GammaCorrection.GammaValues)
+        old.__dict__.update({k: v for k, v in vars(gamma).items()
+                             if k != 'luts'})
+
+        with patch.object(GammaCorrection.GammaValues, '__getstate__',
+                          lambda self: self.__dict__):
+            loaded = pickle.loads(pickle.dumps(old))
+
+        assert loaded.luts.shape == (3, loaded.lut_size)
+        np.testing.assert_array_equal(loaded([0.2, -0.4, 0.6]),
+                                      gamma([0.2, -0.4, 0.6]))
+
+
+class TestLoadTable(object):
+
+    def test_polar(self, tmp_path):
+        pyStim.GlobalDefaults['pix_per_micron'] = 2
+        table = tmp_path / 'polar.txt'
+        table.write_text(u'10 0\n20 1\n30 0\n40 0\n')
+
+        stim = pyStim.TableStim(table_filename=str(table),
+                                table_type='polar', start_dir=0)
+        x, y = stim.gen_pos_array()
+
+        assert stim.num_frames == 4
+        assert stim.trigger_frames == [0, 1, 3]
+        np.testing.assert_allclose(np.hypot(x, y), [20, 40, 60, 80])
+
+    def test_directions(self, tmp_path):
+        pyStim.GlobalDefaults['pix_per_micron'] = 1
+        pyStim.GlobalDefaults['frame_rate'] = 10
+        pyStim.GlobalDefaults['pref_dir'] = -1
+        table = tmp_path / 'directions.txt'
+        table.write_text(u'10 90 300\n20 $ 200\n')
+
+        stim = pyStim.TableStim(table_filename=str(table),
+                                table_type='directions', location=[0, 0])
+        x, y = stim.gen_pos_array()
+
+        assert stim.trigger_frames == [0, 3, 4]
+        np.testing.assert_allclose(x, [0, 1, 2, 2, 2], atol=1e-5)
+        np.testing.assert_allclose(y, [0, 0, 0, 0, 2], atol=1e-5)
+
+    def test_mapped_matches_text(self, tmp_path):
+        pyStim.GlobalDefaults['pix_per_micron'] = 2
+        pyStim.GlobalDefaults['display_size'] = [100, 100]
+        table = tmp_path / 'polar.txt'
+        table.write_text(u''.join('{} {}\n'.format(r, int(r % 7 == 0))
+                                  for r in range(-50, 50)))
+        mapped = pyStim.TableStim.convert_table(str(table), 'polar')
+
+        plans = []
+        for filename in [str(table), mapped]:
+            stim = pyStim.TableStim(table_filename=filename,
+                                    table_type='polar', num_dirs=3,
+                                    move_delay=2, start_dir=10,
+                                    ori_with_dir=True)
+            stim.stim = Mock()
+            stim.stim.size = [10, 10]
+            num_frames = stim.draw_times()
+            stim.compile(num_frames)
+            plans.append((stim.plan, stim.trigger_frames, num_frames))
+
+        text, text_triggers, text_frames = plans[0]
+        npy, npy_triggers, npy_frames = plans[1]
+
+        assert isinstance(npy.pos, trajectory.MappedTrajectory)
+        assert isinstance(npy.draw, pyStim.LazyFrames)
+        assert isinstance(npy.ori, pyStim.LazyFrames)
+        assert text_triggers == npy_triggers
+        assert text_frames == npy_frames
+        np.testing.assert_array_equal(np.asarray(npy.draw), text.draw)
+        np.testing.assert_allclose([npy.ori[i] for i in range(npy_frames)],
+                                   text.ori)
+        np.testing.assert_allclose([npy.pos[i] for i in range(npy_frames)],
+                                   text.pos, atol=1e-3)
+
+        stim.close()
+        assert stim.table_bank is None
+
+    def test_cached(self, tmp_path):
+        table = tmp_path / 'coordinate.txt'
+        table.write_text(u'1 2 1\n3 4 0\n')
+
+        columns = pyStim.TableStim.load_table(str(table), 'coordinate')
+
+        assert pyStim.TableStim.load_table(str(table),
+                                           'coordinate') is columns
+        np.testing.assert_array_equal(columns[1], [2, 4])
+
+    def test_bad_format(self, tmp_path):
+        table = tmp_path / 'coordinate.txt'
+        table.write_text(u'1 2\n3 4\n')
+
+        with pytest.raises(IOError):
+            pyStim.TableStim.load_table(str(table), 'coordinate')
+
+
+class TestTrajectory(object):
+
+    def test_radial_sweeps(self):
+        positions, dirs = trajectory.radial_sweeps(0, 4, 10, 5, move_delay=2,
+                                                   off_pos=(50, 60))
+
+        assert positions.shape == (4, 6, 2)
+        assert positions.dtype == np.float32
+        np.testing.assert_array_equal(dirs, [0, 90, 180, 270])
+
+        # from top, through center
+        np.testing.assert_allclose(positions[0, :4],
+                                   [[0, 10], [0, 5], [0, 0], [0, -5]],
+                                   atol=1e-5)
+        np.testing.assert_array_equal(positions[:, 4:],
+                                      np.tile([50, 60], (4, 2, 1)))
+
+    def test_path_continues_segments(self):
+        positions = trajectory.path((10, 20), [2, 3], [0, 90], [3, 2])
+
+        np.testing.assert_allclose(positions,
+                                   [[10, 20], [10, 22], [10, 24],
+                                    [10, 24], [13, 24]], atol=1e-5)
+
+
+    def test_mapped_prefetch(self):
+        columns = [np.arange(10.), np.arange(10.) * 2]
+        unread = trajectory.MappedTrajectory(columns, first_frame=1,
+                                             num_dirs=2, move_delay=1,
+                                             window=4)
+        expected = [unread[i] for i in range(len(unread) + 1)]
+
+        mapped = trajectory.MappedTrajectory(columns, first_frame=1,
+                                             num_dirs=2, move_delay=1,
+                                             window=4)
+        bank = pyStim.FrameBank(mapped.windows(), size=2)
+        mapped.prefetch(bank)
+
+        read = mapped.read
+        threads = []
+
+        def read_thread(sweep, start):
+            threads.append(threading.current_thread())
+            return read(sweep, start)
+
+        with patch.object(mapped, 'read', side_effect=read_thread):
+            # skips windows of frames that aren't indexed
+            positions = [mapped[i] for i in range(len(mapped) + 1)
+                         if not 6 <= i < 12]
+
+        # windows are read by the bank, not while indexed
+        assert threading.current_thread() not in threads
+        np.testing.assert_array_equal(
+            positions, [p for i, p in enumerate(expected)
+                        if not 6 <= i < 12])
+
+        # indexing backwards reads windows no longer in the bank
+        np.testing.assert_array_equal(mapped[1], [0, 0])
+        bank.stop()
+
+
+class TestNoise(object):
+
+    def test_hash32_matches_reference(self):
+        def lowbias32(x):
+            x ^= x >> 16
+            x = (x * 0x7feb352d) & 0xffffffff
+            x ^= x >> 15
+            x = (x * 0x846ca68b) & 0xffffffff
+            x ^= x >> 16
+            return x
+
+        values = [0, 1, 12345, 2**31, 2**32 - 1]
+        np.testing.assert_array_equal(stim_noise.hash32(values),
+                                      [lowbias32(x) for x in values])
+
+    def test_frames_reproducible(self):
+        low, high = [-1, -1, -1], [1, 1, 1]
+        first = stim_noise.noise_frame(3, 0, 100, 64, low, high)
+
+        np.testing.assert_array_equal(
+            first, stim_noise.noise_frame(3, 0, 100, 64, low, high))
+        assert not np.array_equal(
+            first, stim_noise.noise_frame(3, 0, 101, 64, low, high))
+        assert not np.array_equal(
+            first, stim_noise.noise_frame(4, 0, 100, 64, low, high))
+        assert not np.array_equal(
+            first, stim_noise.noise_frame(3, 1, 100, 64, low, high))
+
+    def test_uniform_range(self):
+        colors = stim_noise.noise_frame(1, 0, 0, 10000, [-1, -0.5, -1],
+                                        [-1, 0.5, -1])
+
+        assert colors.shape == (10000, 3)
+        assert colors.dtype == np.float32
+        np.testing.assert_array_equal(colors[:, [0, 2]], -1)
+        assert colors[:, 1].min() >= -0.5
+        assert colors[:, 1].max() < 0.5
+        assert abs(colors[:, 1].mean()) < 0.02
+
+    def test_stream_seekable(self):
+        # frame streams don't depend on drawing earlier frames
+        later = stim_noise.stream(1, 2, 1000).uniform(size=5)
+        np.testing.assert_array_equal(
+            later, stim_noise.stream(1, 2, 1000).uniform(size=5))
+
+        assert not np.array_equal(later,
+                                  stim_noise.stream(1, 3, 1000).uniform(size=5))
+        assert not np.array_equal(later,
+                                  stim_noise.stream(1, 2, 999).uniform(size=5))
+
+    def test_binary_high_low(self):
+        colors = stim_noise.noise_frame(1, 0, 0, 10000, [-1, -0.5, -1],
+                                        [-1, 0.5, -1], binary=True)
+
+        assert set(np.unique(colors[:, 1])) == {-0.5, 0.5}
+        assert abs((colors[:, 1] > 0).mean() - 0.5) < 0.02
+
+    def test_sample_distinct(self):
+        state = stim_noise.stream(1, 0)
+        counts = np.zeros(10)
+
+        for i in range(2000):
+            values = stim_noise.sample(state, 10, 3)
+
+            assert len(set(values.tolist())) == 3
+            counts[values] += 1
+
+        # every value equally likely
+        np.testing.assert_allclose(counts / 2000., 0.3, atol=0.05)
+
+        np.testing.assert_array_equal(np.sort(stim_noise.sample(state, 5, 5)),
+                                      range(5))
+        assert stim_noise.sample(state, 5, 0).size == 0
+
+
 @pytest.mark.xfail
 class TestSetRGB(object):
 